@@ -0,0 +1,81 @@
+"""Blue/green loads for full-replace imports.
+
+A replace import writes into ``ad_reports__load_<load_id>`` and matching
+staged rollups while the live collections keep serving queries. The staged
+ad_reports has no secondary indexes during the load; they are built once
+the data is in place, which is much cheaper than maintaining every index on
+each insert. ``publish`` then renames the staged collections over the live
+ones (renameCollection with dropTarget, atomic per collection), so readers
+switch from the old data to the new without ever seeing it empty or partial.
+
+The load id is the job id plus the attempt (``load_id``), so a worker that
+lost its lease but hasn't noticed yet never writes into, publishes or drops
+the collections of the attempt that took the job over.
+
+The staged ad_reports gets every index the live one has, including those
+added by the index advisor, plus the ones declared on AdReport.
+"""
+from pymongo import IndexModel
+from typing import List
+from .models import AdReport
+from . import rollups
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+LOAD_SUFFIX = "__load_"
+
+
+def load_id(job: dict) -> str:
+    return f"{job['job_id']}_{job.get('attempts', 1)}"
+
+
+def suffix(load_id: str) -> str:
+    return f"{LOAD_SUFFIX}{load_id}"
+
+
+def staged_collection(load_id: str):
+    live = AdReport.get_pymongo_collection()
+    return live.database[live.name + suffix(load_id)]
+
+
+async def prepare(load_id: str):
+    """Create empty staged collections for a load, returns the staged ad_reports."""
+    await discard(load_id)
+    # Rollup rows are upserted by key, so their unique index is needed while loading
+    await rollups.ensure_indexes(suffix(load_id))
+    return staged_collection(load_id)
+
+
+async def _index_models(live) -> List[IndexModel]:
+    models = {}
+    for model in AdReport.Settings.indexes:
+        models[model.document["name"]] = model
+    async for spec in live.list_indexes():
+        if spec["name"] != "_id_":
+            options = {key: value for key, value in spec.items() if key not in ("v", "key", "ns")}
+            models[spec["name"]] = IndexModel(list(spec["key"].items()), **options)
+    return list(models.values())
+
+
+async def publish(load_id: str):
+    """Index the staged ad_reports and swap it and the staged rollups in."""
+    live, staged = AdReport.get_pymongo_collection(), staged_collection(load_id)
+    started = time.perf_counter()
+    models = await _index_models(live)
+    await staged.create_indexes(models)
+    logger.info(f"Built {len(models)} indexes for load {load_id} in {time.perf_counter() - started:.2f}s")
+    # Raw rows answer every query until the swapped rollups are marked ready
+    await rollups.invalidate([])
+    await staged.rename(live.name, dropTarget=True)
+    await rollups.publish(suffix(load_id))
+    logger.info(f"Swapped in the data of load {load_id}")
+
+
+async def discard(load_id: str):
+    with contextlib.suppress(Exception):
+        await staged_collection(load_id).drop()
+    with contextlib.suppress(Exception):
+        await rollups.drop(suffix(load_id))
@@ -0,0 +1,102 @@
+"""In-process LRU cache for grouped report results.
+
+Entries are keyed on the data generation (see meta.py) plus a canonical form
+of the query, so an import or delete anywhere makes every older entry
+unreachable. Size is bounded by an estimate of each entry's JSON size.
+"""
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import json
+import os
+import time
+
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", 300))
+# Grouped results with more rows than this are paged by MongoDB and not cached
+QUERY_CACHE_MAX_ROWS = int(os.getenv("QUERY_CACHE_MAX_ROWS", 10000))
+
+
+def fingerprint(request) -> str:
+    """Canonical key for a report request, ignoring page and limit.
+
+    Filters are sorted by field and by value and empty filters dropped, so
+    equivalent requests share one entry. Dimension and metric order is kept
+    because it decides the sort key and the column order of the result.
+    """
+    filters = {key: sorted(set(values)) for key, values in sorted((request.filters or {}).items()) if values}
+    date_range = request.date_range
+    return json.dumps({
+        "dimensions": list(request.dimensions),
+        "metrics": list(request.metrics),
+        "filters": filters,
+        "date_range": [date_range.start.isoformat(), date_range.end.isoformat()] if date_range else None,
+    }, sort_keys=True, separators=(",", ":"))
+
+
+class QueryCache:
+    def __init__(self, max_bytes: int = QUERY_CACHE_MAX_BYTES, ttl_seconds: float = QUERY_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.generation = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[2] < time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (value, size, time.monotonic() + self.ttl_seconds)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def sync_generation(self, generation: int):
+        """Drop every entry once the data generation has moved on."""
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def _drop(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "generation": self.generation,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+query_cache = QueryCache()
+
+# Totals of results too large for query_cache, so deep pages skip the count
+total_cache = QueryCache()
@@ -0,0 +1,303 @@
+"""Catalog of dimension values with occurrence counts, for filter pickers.
+
+The dimension_values collection holds one document per (dim, report_id,
+value) with the number of ad_reports rows carrying that value. Import jobs
+keep it current:
+
+- replace: the parse pool counts each block's values next to its rollup
+  partials (ingest.block_values), and the upload's counts become the whole
+  catalog. They are upserted stamped with the job, then the other documents
+  are deleted, so lookups never find the catalog empty.
+- upsert and partition: rows of older reports are replaced too, but only on
+  the dates in the upload. The job counts those dates per report_id before
+  writing to them (``counts_on``) and again at the end, and $incs the
+  difference (``apply``).
+
+Only one process writes the catalog at a time: the writer holds a lease in
+app_meta, which also records the generation the catalog matches. Deltas
+are only applied when that is the generation the import started from and
+the import's own bumps are the only ones since. Otherwise the catalog is
+re-counted from the stored data (``refresh``), from a ready rollup covering
+the dimension when there is one (summing its row_count), or ad_reports. A
+failed import empties the catalog, and the first lookup afterwards
+re-counts it, unless an import holds the lease, in which case the lookup
+skips the backfill rather than race it.
+
+Each API process serves lookups from an in-memory ``ValueIndex`` per
+dimension and report_id (or all reports): values sorted case-insensitively
+for bisecting a prefix range, plus the order by count for the empty prefix.
+Indexes are loaded on first use, kept for CATALOG_CACHE_ENTRIES (dimension,
+report) pairs and dropped whenever the data generation (meta.py) moves.
+Imports write the catalog before bumping the generation, so an index loaded
+after the bump always sees it.
+"""
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from .models import AdReport
+from .ingest import STRING_FIELDS
+from . import dictionaries, meta, partitions, rollups
+import asyncio
+import bisect
+import heapq
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CATALOG_COLLECTION = "dimension_values"
+
+# Dimensions with a value catalog; dates are picked with date_range instead
+CATALOG_DIMENSIONS = STRING_FIELDS
+
+# (dimension, report) indexes kept in memory per process
+CATALOG_CACHE_ENTRIES = int(os.getenv("CATALOG_CACHE_ENTRIES", 64))
+
+CATALOG_INSERT_BATCH = 5000
+
+# app_meta document holding the writer lease and the generation the catalog matches
+CATALOG_WRITER = "catalog_writer"
+# Longest a writer may hold the catalog, a crashed one blocks others no longer than this
+CATALOG_LEASE_SECONDS = int(os.getenv("CATALOG_LEASE_SECONDS", 600))
+CATALOG_LEASE_POLL_SECONDS = 1
+
+# Sorts after every other character, closing the range of keys starting with a prefix
+_PREFIX_END = "\U0010ffff"
+
+_indexes: "OrderedDict[Tuple[str, Optional[str]], ValueIndex]" = OrderedDict()
+_state = {"generation": None}
+_backfill_lock = asyncio.Lock()
+
+
+def _collection():
+    return AdReport.get_pymongo_collection().database[CATALOG_COLLECTION]
+
+
+def _writer():
+    return AdReport.get_pymongo_collection().database[meta.META_COLLECTION]
+
+
+async def _acquire(owner: str, wait: bool = True) -> bool:
+    """Take the writer lease, waiting for the current holder unless ``wait`` is off."""
+    while True:
+        now = datetime.utcnow()
+        try:
+            # Matches a free or expired lease; when it is held the upsert collides with the document
+            await _writer().update_one(
+                {"_id": CATALOG_WRITER, "$or": [{"until": {"$lt": now}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "until": now + timedelta(seconds=CATALOG_LEASE_SECONDS)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            if not wait:
+                return False
+            await asyncio.sleep(CATALOG_LEASE_POLL_SECONDS)
+
+
+async def _release(owner: str, generation: Optional[int]):
+    """Give the lease back, recording the generation the catalog now matches (None: unknown)."""
+    await _writer().update_one({"_id": CATALOG_WRITER, "owner": owner},
+                               {"$set": {"until": datetime.utcnow(), "generation": generation}})
+
+
+async def _matched_generation() -> Optional[int]:
+    doc = await _writer().find_one({"_id": CATALOG_WRITER})
+    return doc.get("generation") if doc else None
+
+
+async def ensure_indexes():
+    await _collection().create_indexes([
+        IndexModel([("dim", ASCENDING), ("report_id", ASCENDING), ("value", ASCENDING)], unique=True),
+    ])
+
+
+def add(counts: Dict[str, Counter], values: Dict[str, Dict[str, int]]):
+    """Add one block's ``values`` to the running ``counts``."""
+    for dim, occurrences in values.items():
+        counts.setdefault(dim, Counter()).update(occurrences)
+
+
+def add_reports(deltas: Dict[str, Dict[str, Counter]], counts_by_report: Dict[str, Dict[str, Dict[str, int]]],
+                sign: int = 1):
+    """Add (or with ``sign=-1`` subtract) ``{report_id: {dim: {value: count}}}`` to the running ``deltas``."""
+    for report_id, counts in counts_by_report.items():
+        for dim, occurrences in counts.items():
+            running = deltas.setdefault(report_id, {}).setdefault(dim, Counter())
+            for value, count in occurrences.items():
+                running[value] += sign * count
+
+
+async def _write(requests: List[UpdateOne]):
+    for i in range(0, len(requests), CATALOG_INSERT_BATCH):
+        await _collection().bulk_write(requests[i:i + CATALOG_INSERT_BATCH], ordered=False)
+
+
+async def store(counts_by_report: Dict[str, Dict[str, Dict[str, int]]]):
+    """Replace the whole catalog with ``{report_id: {dim: {value: count}}}``."""
+    stamp = uuid.uuid4().hex
+    requests = [UpdateOne({"dim": dim, "report_id": report_id, "value": value},
+                          {"$set": {"count": count, "stamp": stamp}}, upsert=True)
+                for report_id, counts in counts_by_report.items()
+                for dim, occurrences in counts.items()
+                for value, count in occurrences.items()]
+    await _write(requests)
+    # Only now drop what the new counts don't have, so lookups never see an empty catalog
+    await _collection().delete_many({"stamp": {"$ne": stamp}})
+    logger.info(f"Stored {len(requests)} dimension values of {len(counts_by_report)} reports")
+
+
+async def apply(deltas: Dict[str, Dict[str, Dict[str, int]]]):
+    """Add ``{report_id: {dim: {value: count change}}}`` to the stored counts."""
+    requests = [UpdateOne({"dim": dim, "report_id": report_id, "value": value}, {"$inc": {"count": count}}, upsert=True)
+                for report_id, counts in deltas.items()
+                for dim, occurrences in counts.items()
+                for value, count in occurrences.items() if count]
+    await _write(requests)
+    await _collection().delete_many({"report_id": {"$in": list(deltas)}, "count": {"$lte": 0}})
+    logger.info(f"Applied {len(requests)} dimension value count changes of {len(deltas)} reports")
+
+
+async def _count(stages: List[Dict], rollup_sources: bool) -> Dict[str, Dict[str, Dict[str, int]]]:
+    """``{report_id: {dim: {value: count}}}`` of the rows passing ``stages``."""
+    counts_by_report: Dict[str, Dict[str, Dict[str, int]]] = {}
+    for dim in CATALOG_DIMENSIONS:
+        source = await rollups.route({dim}) if rollup_sources else None
+        weight = "$row_count" if source is not None else 1
+        if source is None:
+            source = AdReport.get_pymongo_collection()
+        cursor = source.aggregate(await partitions.visible(source, stages + [
+            {"$group": {"_id": {"report_id": "$report_id", "value": f"${dim}"}, "count": {"$sum": weight}}},
+        ]), allowDiskUse=True)
+        rows = await cursor.to_list(length=None)
+        values = [row["_id"]["value"] for row in rows]
+        if dictionaries.compact():
+            values = await dictionaries.names(dim, values)
+        for row, value in zip(rows, values):
+            counts_by_report.setdefault(row["_id"]["report_id"], {}).setdefault(dim, {})[str(value)] = row["count"]
+    return counts_by_report
+
+
+async def counts_on(dates) -> Dict[str, Dict[str, Dict[str, int]]]:
+    """Value counts per report_id of the stored rows on ``dates``."""
+    return await _count([{"$match": {"date": {"$in": list(dates)}}}], rollup_sources=False)
+
+
+async def refresh():
+    """Re-count every cataloged dimension from the stored data and replace the catalog."""
+    await store(await _count([], rollup_sources=True))
+
+
+async def write(owner: str, counts_by_report: Dict[str, Dict[str, Dict[str, int]]] = None,
+                deltas: Dict[str, Dict[str, Dict[str, int]]] = None, start_generation: int = None, bumps: int = 0):
+    """Update the catalog for an import about to bump the generation, holding the writer lease.
+
+    ``counts_by_report`` becomes the whole catalog. Otherwise ``deltas`` are
+    applied if the catalog matched ``start_generation`` and the import's own
+    ``bumps`` are the only ones since, and the catalog is re-counted if not.
+    """
+    await _acquire(owner)
+    generation = None
+    try:
+        current = await meta.current_generation()
+        if counts_by_report is not None:
+            await store(counts_by_report)
+        elif start_generation is not None and current == start_generation + bumps \
+                and await _matched_generation() == start_generation:
+            await apply(deltas or {})
+        else:
+            logger.info(f"Dimension value catalog changed since import {owner} started, re-counting it")
+            await refresh()
+        # What the import's bump will make current
+        generation = current + 1
+    finally:
+        await _release(owner, generation)
+
+
+async def invalidate(owner: str):
+    """Empty the catalog after a failed import, so the next lookup re-counts it."""
+    await _acquire(owner)
+    try:
+        await clear()
+    finally:
+        await _release(owner, None)
+
+
+async def clear():
+    await _collection().delete_many({})
+
+
+class ValueIndex:
+    """Values of one dimension with their counts, searchable by case-insensitive prefix."""
+
+    def __init__(self, counts: Dict[str, int]):
+        items = sorted(counts.items(), key=lambda item: (item[0].casefold(), item[0]))
+        self.keys = [value.casefold() for value, _ in items]
+        self.values = [value for value, _ in items]
+        self.counts = [count for _, count in items]
+        # Positions by count, most frequent first, for lookups without a prefix
+        self.top = sorted(range(len(items)), key=lambda i: -self.counts[i])
+
+    def search(self, prefix: str, limit: int) -> Tuple[List[Tuple[str, int]], int]:
+        """The ``limit`` most frequent values starting with ``prefix``, and how many values match."""
+        if not prefix:
+            picked, matches = self.top[:limit], len(self.values)
+        else:
+            prefix = prefix.casefold()
+            low = bisect.bisect_left(self.keys, prefix)
+            high = bisect.bisect_left(self.keys, prefix + _PREFIX_END, low)
+            picked, matches = heapq.nlargest(limit, range(low, high), key=self.counts.__getitem__), high - low
+        return [(self.values[i], self.counts[i]) for i in picked], matches
+
+
+async def _load(dim: str, report_id: Optional[str]) -> ValueIndex:
+    if report_id:
+        docs = await _collection().find({"dim": dim, "report_id": report_id}, {"_id": 0, "value": 1, "count": 1}).to_list(length=None)
+    else:
+        docs = await _collection().aggregate([
+            {"$match": {"dim": dim}},
+            {"$group": {"_id": "$value", "count": {"$sum": "$count"}}},
+            {"$project": {"_id": 0, "value": "$_id", "count": 1}},
+        ], allowDiskUse=True).to_list(length=None)
+    return ValueIndex({doc["value"]: doc["count"] for doc in docs})
+
+
+async def _backfill():
+    """Catalog data imported before the catalog existed (or after a failed import), once."""
+    async with _backfill_lock:
+        if await _collection().estimated_document_count() == 0 and await meta.has_data():
+            owner = f"backfill-{uuid.uuid4().hex[:8]}"
+            if not await _acquire(owner, wait=False):
+                # An import is writing the catalog right now and bumps the generation when done
+                return
+            try:
+                logger.info("Dimension value catalog is empty, counting values of the stored data")
+                await refresh()
+            finally:
+                # Rows written meanwhile by an import that hasn't taken the lease yet may be counted,
+                # so the next import re-counts rather than applying its changes on top
+                await _release(owner, None)
+
+
+async def search(dim: str, prefix: str, limit: int, report_id: Optional[str] = None) -> Tuple[List[Tuple[str, int]], int]:
+    """Most frequent values of ``dim`` starting with ``prefix``, within one report when ``report_id`` is set."""
+    generation = await meta.get_generation()
+    if generation != _state["generation"]:
+        _indexes.clear()
+        _state["generation"] = generation
+    key = (dim, report_id)
+    index = _indexes.get(key)
+    if index is None:
+        if not _indexes:
+            await _backfill()
+        index = await _load(dim, report_id)
+        if _state["generation"] == generation:
+            _indexes[key] = index
+            while len(_indexes) > CATALOG_CACHE_ENTRIES:
+                _indexes.popitem(last=False)
+    else:
+        _indexes.move_to_end(key)
+    return index.search(prefix, limit)
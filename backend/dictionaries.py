@@ -0,0 +1,153 @@
+"""Compact storage mode: dimension strings stored as small integer codes.
+
+With STORAGE_MODE=compact, import jobs replace every string dimension of
+the ad_reports rows and the rollup rows with an integer code. The
+value <-> code pairs live in the ``dimension_dictionaries`` collection,
+one document per (dimension, value), unique on both. Codes are allocated
+from per-dimension counters in app_meta, so concurrent workers never hand
+out the same code. If two workers add the same value at once, the loser of
+the unique index simply reads back the winner's code.
+
+Queries translate ``$in`` filters to codes and group and sort on the codes.
+Only the rows actually returned (one /query page, each export batch) are
+decoded back to names. Results are therefore ordered by code (first-seen
+order), not alphabetically, and the keyset cursor carries codes.
+
+Switching modes does not convert stored data; re-import after a switch.
+"""
+from typing import Dict, Iterable, List, AsyncIterator
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError
+from .ingest import STRING_FIELDS
+from .meta import META_COLLECTION
+from .models import AdReport
+import copy
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# strings (default) or compact
+STORAGE_MODE = os.getenv("STORAGE_MODE", "strings")
+
+DICTIONARY_COLLECTION = "dimension_dictionaries"
+DUPLICATE_KEY = 11000
+ENCODED_DIMENSIONS = STRING_FIELDS
+
+# Per-process caches: dimension -> value -> code and dimension -> code -> value
+_codes: Dict[str, Dict[str, int]] = {dim: {} for dim in ENCODED_DIMENSIONS}
+_values: Dict[str, Dict[int, str]] = {dim: {} for dim in ENCODED_DIMENSIONS}
+
+
+def compact() -> bool:
+    return STORAGE_MODE == "compact"
+
+
+def _collection():
+    return AdReport.get_pymongo_collection().database[DICTIONARY_COLLECTION]
+
+
+def _remember(dim: str, value: str, code: int):
+    _codes[dim][value] = code
+    _values[dim][code] = value
+
+
+async def ensure_indexes():
+    await _collection().create_indexes([
+        IndexModel([("dim", ASCENDING), ("value", ASCENDING)], unique=True),
+        IndexModel([("dim", ASCENDING), ("code", ASCENDING)], unique=True),
+    ])
+
+
+async def _fetch(dim: str, field: str, keys: List):
+    cursor = _collection().find({"dim": dim, field: {"$in": keys}}, {"_id": 0, "value": 1, "code": 1})
+    for doc in await cursor.to_list(length=None):
+        _remember(dim, doc["value"], doc["code"])
+
+
+async def lookup(dim: str, values: Iterable[str]) -> Dict[str, int]:
+    """Codes of the known ``values``; values never imported have no code."""
+    values = set(values)
+    missing = [value for value in values if value not in _codes[dim]]
+    if missing:
+        await _fetch(dim, "value", missing)
+    return {value: _codes[dim][value] for value in values if value in _codes[dim]}
+
+
+async def encode(dim: str, values: Iterable[str]) -> Dict[str, int]:
+    """Codes of ``values``, assigning new codes to values seen for the first time."""
+    values = set(values)
+    known = await lookup(dim, values)
+    new = sorted(value for value in values if value not in known)
+    if new:
+        counters = await AdReport.get_pymongo_collection().database[META_COLLECTION].find_one_and_update(
+            {"_id": "dimension_codes"}, {"$inc": {dim: len(new)}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        first = counters[dim] - len(new)
+        docs = [{"dim": dim, "value": value, "code": first + i} for i, value in enumerate(new)]
+        try:
+            await _collection().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Only another worker adding some of these first is expected, its codes win
+            write_errors = e.details.get("writeErrors", [])
+            if not write_errors or any(error.get("code") != DUPLICATE_KEY for error in write_errors):
+                raise
+        await _fetch(dim, "value", new)
+        known.update({value: _codes[dim][value] for value in new})
+    return known
+
+
+async def encode_records(records: List[Dict]):
+    """Replace the string dimensions of ``records`` (rows or rollup rows) with codes, in place."""
+    if not records:
+        return
+    for dim in ENCODED_DIMENSIONS:
+        if dim not in records[0]:
+            continue
+        codes = await encode(dim, {record[dim] for record in records})
+        for record in records:
+            record[dim] = codes[record[dim]]
+
+
+async def translate_match(pipeline: List[Dict]) -> List[Dict]:
+    """Copy of a pipeline whose leading $match filters dimensions by code instead of name."""
+    pipeline = copy.deepcopy(pipeline)
+    match = pipeline[0]["$match"]
+    for dim in ENCODED_DIMENSIONS:
+        condition = match.get(dim)
+        if isinstance(condition, dict) and "$in" in condition:
+            codes = await lookup(dim, condition["$in"])
+            condition["$in"] = sorted(codes.values())
+    return pipeline
+
+
+async def names(dim: str, codes: List[int]) -> List[str]:
+    """Names for ``codes`` of one dimension, in order."""
+    missing = [code for code in set(codes) if code not in _values[dim]]
+    if missing:
+        await _fetch(dim, "code", missing)
+    return [_values[dim].get(code, code) for code in codes]
+
+
+async def decode_rows(rows: List[Dict], dimensions: Iterable[str]) -> List[Dict]:
+    """Copies of ``rows`` with dimension codes turned back into names."""
+    dims = [dim for dim in dimensions if dim in _values]
+    if not rows or not dims:
+        return rows
+    for dim in dims:
+        missing = list({row[dim] for row in rows if isinstance(row.get(dim), int) and row[dim] not in _values[dim]})
+        if missing:
+            await _fetch(dim, "code", missing)
+    decoded = []
+    for row in rows:
+        row = dict(row)
+        for dim in dims:
+            if isinstance(row.get(dim), int):
+                row[dim] = _values[dim].get(row[dim], row[dim])
+        decoded.append(row)
+    return decoded
+
+
+async def decode_batches(batches: AsyncIterator[List[Dict]], dimensions: List[str]) -> AsyncIterator[List[Dict]]:
+    async for batch in batches:
+        yield await decode_rows(batch, dimensions)
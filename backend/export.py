@@ -0,0 +1,198 @@
+"""Streaming writers for /api/reports/export.
+
+Rows are pulled from the aggregation cursor in batches and encoded batch by
+batch, so memory and time-to-first-byte do not grow with the report size.
+CSV and NDJSON are plain text; Parquet and the Arrow IPC stream carry typed
+columns (date32 dates, int64 counts, float64 money and ratios) and need
+pyarrow.
+"""
+from datetime import datetime, time
+from io import StringIO
+from typing import AsyncIterator, Dict, List
+import csv
+import json
+import os
+import zlib
+
+from .ingest import INT_FIELDS, FLOAT_FIELDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - only the columnar formats need it
+    pa = pq = None
+
+# Rows fetched from the cursor and encoded per chunk
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", 2000))
+# Parquet row groups are buffered up to this many rows before being written
+EXPORT_PARQUET_ROW_GROUP_ROWS = int(os.getenv("EXPORT_PARQUET_ROW_GROUP_ROWS", 64000))
+
+# format -> (media type, file extension, whether gzip Content-Encoding applies)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv", True),
+    "ndjson": ("application/x-ndjson", "ndjson", True),
+    "parquet": ("application/vnd.apache.parquet", "parquet", False),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", False),
+}
+COLUMNAR_FORMATS = {"parquet", "arrow"}
+
+
+async def batches(first: List[Dict], cursor) -> AsyncIterator[List[Dict]]:
+    """Yield the already fetched first batch, then the rest of the cursor in batches."""
+    if first:
+        yield first
+    while True:
+        batch = await cursor.to_list(length=EXPORT_BATCH_ROWS)
+        if not batch:
+            break
+        yield batch
+
+
+class ListCursor:
+    """Cursor-like view over rows already in memory, e.g. from the columnar engine."""
+
+    def __init__(self, rows: List[Dict]):
+        self._rows = rows
+        self._position = 0
+
+    async def to_list(self, length: int) -> List[Dict]:
+        batch = self._rows[self._position:self._position + length]
+        self._position += len(batch)
+        return batch
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        # Report dates are stored as midnight datetimes, write them as plain dates
+        return value.date().isoformat() if value.time() == time.min else value.isoformat(sep=" ")
+    return "" if value is None else value
+
+
+async def csv_stream(rows: AsyncIterator[List[Dict]], columns: List[str]) -> AsyncIterator[bytes]:
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    async for batch in rows:
+        writer.writerows([[_csv_value(row.get(column)) for column in columns] for row in batch])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return _csv_value(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def ndjson_stream(rows: AsyncIterator[List[Dict]], columns: List[str]) -> AsyncIterator[bytes]:
+    async for batch in rows:
+        lines = [json.dumps({column: row.get(column) for column in columns}, default=_json_value) for row in batch]
+        yield ("\n".join(lines) + "\n").encode()
+
+
+def arrow_schema(columns: List[str]):
+    """Typed schema for an export: dates as date32, counts int64, other metrics float64."""
+    fields = []
+    for column in columns:
+        if column == "date":
+            fields.append(pa.field(column, pa.date32()))
+        elif column in INT_FIELDS:
+            fields.append(pa.field(column, pa.int64()))
+        elif column in FLOAT_FIELDS:
+            fields.append(pa.field(column, pa.float64()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+
+def record_batch(batch: List[Dict], schema):
+    arrays = []
+    for field in schema:
+        values = [row.get(field.name) for row in batch]
+        if field.name == "date":
+            values = [value.date() if isinstance(value, datetime) else value for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back in chunks.
+
+    tell() reports the total written so far, which is all the Parquet and
+    IPC writers need to compute offsets without a seekable file.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._written = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._written += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def arrow_stream(rows: AsyncIterator[List[Dict]], columns: List[str]) -> AsyncIterator[bytes]:
+    """Arrow IPC stream with one record batch per cursor batch."""
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    async for batch in rows:
+        writer.write_batch(record_batch(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+async def parquet_stream(rows: AsyncIterator[List[Dict]], columns: List[str]) -> AsyncIterator[bytes]:
+    """Parquet file written row group by row group as the cursor is consumed."""
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="snappy")
+    pending, pending_rows = [], 0
+    async for batch in rows:
+        pending.append(record_batch(batch, schema))
+        pending_rows += len(batch)
+        if pending_rows >= EXPORT_PARQUET_ROW_GROUP_ROWS:
+            writer.write_table(pa.Table.from_batches(pending, schema=schema))
+            pending, pending_rows = [], 0
+            yield sink.drain()
+    if pending:
+        writer.write_table(pa.Table.from_batches(pending, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {"csv": csv_stream, "ndjson": ndjson_stream, "parquet": parquet_stream, "arrow": arrow_stream}
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    return any(part.split(";")[0].strip() == "gzip" for part in (accept_encoding or "").split(","))
@@ -0,0 +1,212 @@
+"""Background export jobs for reports too large to stream within one request.
+
+``POST /api/reports/export/jobs`` returns an export id right away. The
+aggregation then runs in a task of the API process that accepted it, and the
+file is written chunk by chunk to ``<EXPORT_DIR>/<export_id>.<ext>.partial``,
+renamed into place once complete. Clients poll the job for rows and bytes
+written and download the artifact when it is done, in byte ranges if they
+want to resume an interrupted transfer.
+
+Jobs are keyed on the query fingerprint (cache.fingerprint), the format and
+the data generation (meta.py). Asking again for the same report while the
+data is unchanged returns the existing job, finished or still running,
+instead of aggregating again. A running job refreshes updated_at. One that
+stops doing so for EXPORT_STALE_SECONDS (its process died) is failed, and
+the next request for it starts over. Jobs and their artifacts are deleted
+EXPORT_RETENTION_SECONDS after they last changed. With several API hosts,
+EXPORT_DIR must be storage shared between them.
+"""
+from pymongo import ReturnDocument
+from starlette.concurrency import run_in_threadpool
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from .models import ExportJob
+from .export import EXPORT_FORMATS, WRITERS
+from . import meta, metrics
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "adreport-exports"))
+EXPORT_STALE_SECONDS = int(os.getenv("EXPORT_STALE_SECONDS", 60))
+EXPORT_RETENTION_SECONDS = int(os.getenv("EXPORT_RETENTION_SECONDS", 24 * 3600))
+# Rows and bytes written are saved on the job at most this often
+EXPORT_PROGRESS_SECONDS = float(os.getenv("EXPORT_PROGRESS_SECONDS", 1))
+
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+_running = set()
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised for a byte range that starts past the end of the artifact."""
+
+
+def _collection():
+    return ExportJob.get_pymongo_collection()
+
+
+def job_key(query_fingerprint: str, format: str) -> str:
+    return hashlib.sha256(f"{format}:{query_fingerprint}".encode()).hexdigest()
+
+
+def _remove(path: Optional[str]):
+    if path:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+async def _update(export_id: str, **fields):
+    fields["updated_at"] = datetime.utcnow()
+    await _collection().update_one({"export_id": export_id}, {"$set": fields})
+
+
+async def _expire():
+    """Fail jobs whose process stopped, delete jobs past their retention."""
+    now = datetime.utcnow()
+    await _collection().update_many(
+        {"status": {"$in": ["pending", "running"]}, "updated_at": {"$lt": now - timedelta(seconds=EXPORT_STALE_SECONDS)}},
+        {"$set": {"status": "failed", "error": "Export abandoned: its process stopped", "updated_at": now}},
+    )
+    expired = await _collection().find(
+        {"updated_at": {"$lt": now - timedelta(seconds=EXPORT_RETENTION_SECONDS)}}, {"export_id": 1, "path": 1}
+    ).to_list(length=None)
+    for doc in expired:
+        _remove(doc.get("path"))
+    if expired:
+        await _collection().delete_many({"export_id": {"$in": [doc["export_id"] for doc in expired]}})
+        logger.info(f"Deleted {len(expired)} expired exports")
+
+
+async def submit(query_fingerprint: str, format: str,
+                 produce: Callable[[], Awaitable[AsyncIterator[List[Dict]]]]) -> Tuple[dict, bool]:
+    """Return the export job of this query on the current data, and whether it was just started.
+
+    ``produce`` opens the report's rows as an iterator of batches; it is only
+    called when no job can be reused.
+    """
+    await _expire()
+    generation = await meta.get_generation()
+    key = job_key(query_fingerprint, format)
+    export_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    job = await _collection().find_one_and_update(
+        {"key": key, "generation": generation, "status": {"$ne": "failed"}},
+        {"$setOnInsert": {
+            "export_id": export_id, "key": key, "generation": generation, "status": "pending",
+            "format": format, "query": json.loads(query_fingerprint), "rows": 0, "bytes": 0,
+            "path": os.path.join(EXPORT_DIR, f"{export_id}.{EXPORT_FORMATS[format][1]}"),
+            "created_at": now, "updated_at": now,
+        }},
+        upsert=True, return_document=ReturnDocument.AFTER, projection={"_id": 0},
+    )
+    if job["export_id"] != export_id:
+        if job["status"] == "completed" and not os.path.exists(job["path"]):
+            # The artifact was deleted from EXPORT_DIR behind our back, build it again
+            await _update(job["export_id"], status="failed", error="Export artifact is missing")
+            return await submit(query_fingerprint, format, produce)
+        metrics.EXPORT_JOBS.inc(outcome="reused")
+        return job, False
+
+    metrics.EXPORT_JOBS.inc(outcome="started")
+    task = asyncio.create_task(_run(job, produce))
+    _running.add(task)
+    task.add_done_callback(_running.discard)
+    return job, True
+
+
+async def _keep_alive(export_id: str):
+    while True:
+        await asyncio.sleep(EXPORT_STALE_SECONDS / 3)
+        try:
+            await _update(export_id)
+        except Exception as e:
+            logger.warning(f"Heartbeat failed for export {export_id}: {str(e)}")
+
+
+async def _run(job: dict, produce: Callable[[], Awaitable[AsyncIterator[List[Dict]]]]):
+    export_id, path = job["export_id"], job["path"]
+    partial = f"{path}.partial"
+    progress = {"rows": 0, "bytes": 0}
+    started = time.perf_counter()
+
+    async def counted(batches: AsyncIterator[List[Dict]]) -> AsyncIterator[List[Dict]]:
+        async for batch in batches:
+            progress["rows"] += len(batch)
+            yield batch
+
+    heartbeat = asyncio.create_task(_keep_alive(export_id))
+    try:
+        with metrics.BACKGROUND_JOBS.track(kind="export"):
+            await _update(export_id, status="running")
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            columns = job["query"]["dimensions"] + job["query"]["metrics"]
+            body = WRITERS[job["format"]](counted(await produce()), columns)
+            saved_at = time.monotonic()
+            with open(partial, "wb") as fh:
+                async for chunk in body:
+                    await run_in_threadpool(fh.write, chunk)
+                    progress["bytes"] += len(chunk)
+                    if time.monotonic() - saved_at >= EXPORT_PROGRESS_SECONDS:
+                        await _update(export_id, **progress)
+                        saved_at = time.monotonic()
+            os.replace(partial, path)
+        await _update(export_id, status="completed", completed_at=datetime.utcnow(), **progress)
+        logger.info(f"Export {export_id} wrote {progress['rows']} rows, {progress['bytes']} bytes "
+                    f"in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.error(f"Export {export_id} failed: {str(e)}")
+        with contextlib.suppress(Exception):
+            await _update(export_id, status="failed", error=str(e), **progress)
+    finally:
+        heartbeat.cancel()
+        _remove(partial)
+
+
+async def get_job(export_id: str) -> Optional[dict]:
+    return await _collection().find_one({"export_id": export_id}, {"_id": 0})
+
+
+def byte_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single ``Range: bytes=`` header, None to send the whole file.
+
+    Malformed and multi-range headers are ignored, as HTTP allows.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            # Suffix range: the last ``end`` bytes
+            length = int(end)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise RangeNotSatisfiable()
+    return first, min(last, size - 1)
+
+
+async def read(path: str, first: int, last: int) -> AsyncIterator[bytes]:
+    """Stream bytes ``first`` to ``last`` (inclusive) of an artifact."""
+    with open(path, "rb") as fh:
+        fh.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = await run_in_threadpool(fh.read, min(DOWNLOAD_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
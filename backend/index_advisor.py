@@ -0,0 +1,273 @@
+"""Index advisor: learns the filter shapes reports run and suggests indexes.
+
+Every aggregation /query and /export send to MongoDB is recorded as a shape:
+the collection, which fields the ``$match`` tests for equality (plain values
+and ``$in``) and which it tests with a range. Reports only sort after
+``$group``, never straight from the collection, so sorts are not part of a
+shape. Shapes are buffered in memory and periodically folded into
+the ``query_shapes`` collection with a count, total latency and one example
+filter, so the data survives restarts and covers every API process. The
+fold runs in a background task of each API process (``flush_periodically``),
+never inside the request that recorded the shape.
+
+Recommendations follow the ESR rule without the sort: equality fields
+first, then range fields. Recommendations that an existing index already
+serves as a prefix are skipped. Each candidate is explained against its
+example filter, so the current plan (COLLSCAN or the index it uses, docs
+examined vs returned) is reported next to it.
+
+CLI: python -m backend.index_advisor [shapes|recommend|apply|unused]
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+from beanie import init_beanie
+from dotenv import load_dotenv
+from pymongo import ASCENDING, UpdateOne
+from .models import AdReport, SavedReport, ImportJob
+from . import rollups
+import asyncio
+import json
+import logging
+import motor.motor_asyncio
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+SHAPES_COLLECTION = "query_shapes"
+
+INDEX_ADVISOR_ENABLED = os.getenv("INDEX_ADVISOR_ENABLED", "1") != "0"
+# How often recorded shapes are written to the query_shapes collection
+INDEX_ADVISOR_FLUSH_SECONDS = float(os.getenv("INDEX_ADVISOR_FLUSH_SECONDS", 30))
+# Shapes seen fewer times than this are not worth an index
+INDEX_ADVISOR_MIN_QUERIES = int(os.getenv("INDEX_ADVISOR_MIN_QUERIES", 10))
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+_buffer: Dict[str, dict] = {}
+
+
+def _database():
+    return AdReport.get_pymongo_collection().database
+
+
+def classify(match: Dict) -> tuple:
+    """Split a $match filter into (equality fields, range fields)."""
+    equality, ranges = [], []
+    for field, condition in match.items():
+        if field.startswith("$"):
+            continue  # $or/$and (keyset pages) run after $group, not on the collection
+        if isinstance(condition, dict) and RANGE_OPERATORS & condition.keys():
+            ranges.append(field)
+        else:
+            equality.append(field)
+    return sorted(equality), sorted(ranges)
+
+
+def shape_id(collection: str, equality: List[str], ranges: List[str]) -> str:
+    return f"{collection}|eq={','.join(equality)}|range={','.join(ranges)}"
+
+
+def record(collection: str, match: Dict, elapsed_ms: float):
+    """Remember one query against ``collection``; ``flush`` writes it later."""
+    if not INDEX_ADVISOR_ENABLED:
+        return
+    equality, ranges = classify(match)
+    key = shape_id(collection, equality, ranges)
+    entry = _buffer.setdefault(key, {
+        "collection": collection, "equality": equality, "range": ranges, "count": 0, "total_ms": 0.0,
+    })
+    entry["count"] += 1
+    entry["total_ms"] += elapsed_ms
+    entry["example"] = match
+
+
+async def flush():
+    """Fold buffered shapes into the query_shapes collection."""
+    if not _buffer:
+        return
+    entries = list(_buffer.items())
+    _buffer.clear()
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne({"_id": key}, {
+            "$inc": {"count": entry["count"], "total_ms": entry["total_ms"]},
+            "$set": {"example": entry["example"], "last_seen": now},
+            "$setOnInsert": {field: entry[field] for field in ("collection", "equality", "range")},
+        }, upsert=True)
+        for key, entry in entries
+    ]
+    try:
+        await _database()[SHAPES_COLLECTION].bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.warning(f"Failed to save {len(operations)} query shapes: {e}")
+
+
+async def flush_periodically():
+    """Flush every INDEX_ADVISOR_FLUSH_SECONDS, until cancelled."""
+    while True:
+        await asyncio.sleep(INDEX_ADVISOR_FLUSH_SECONDS)
+        await flush()
+
+
+async def shapes() -> List[Dict]:
+    await flush()
+    cursor = _database()[SHAPES_COLLECTION].find().sort("count", -1)
+    result = []
+    for doc in await cursor.to_list(length=None):
+        doc["avg_ms"] = doc["total_ms"] / doc["count"] if doc["count"] else 0.0
+        result.append(doc)
+    return result
+
+
+def esr_key(shape: Dict) -> List[tuple]:
+    """Compound index key for a shape: equality, then range fields."""
+    # report_id first: almost every filter has it and it's shared by the most shapes
+    fields = sorted(shape["equality"], key=lambda field: (field != "report_id", field))
+    fields += [f for f in shape["range"] if f not in fields]
+    return [(field, ASCENDING) for field in fields]
+
+
+def _is_prefix(prefix: List[tuple], key: List[tuple]) -> bool:
+    return len(prefix) <= len(key) and [f for f, _ in key[:len(prefix)]] == [f for f, _ in prefix]
+
+
+def _plan_summary(explain: Dict) -> Dict:
+    """Pull plan stages, index names and docs examined/returned out of explain output."""
+    stats = explain.get("executionStats")
+    for stage in explain.get("stages", []):
+        stats = stats or stage.get("$cursor", {}).get("executionStats")
+    stages, indexes = [], []
+
+    def walk(node):
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            if "indexName" in node:
+                indexes.append(node["indexName"])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(explain.get("queryPlanner") or [s.get("$cursor", {}).get("queryPlanner") for s in explain.get("stages", [])])
+    stats = stats or {}
+    return {
+        "collscan": "COLLSCAN" in stages,
+        "indexes": sorted(set(indexes)),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "returned": stats.get("nReturned"),
+        "millis": stats.get("executionTimeMillis"),
+    }
+
+
+async def explain(collection: str, match: Dict, pipeline: Optional[List[Dict]] = None) -> Dict:
+    """Plan summary of ``$match`` on ``match`` against a collection, or of a whole ``pipeline``."""
+    result = await _database().command(
+        "explain", {"aggregate": collection, "pipeline": pipeline or [{"$match": match}], "cursor": {}},
+        verbosity="executionStats"
+    )
+    return _plan_summary(result)
+
+
+async def recommend(min_queries: int = INDEX_ADVISOR_MIN_QUERIES) -> List[Dict]:
+    """ESR compound indexes for the recorded shapes that no index serves yet."""
+    database = _database()
+    existing: Dict[str, List[List[tuple]]] = {}
+    candidates: Dict[tuple, Dict] = {}
+    for shape in await shapes():
+        key = esr_key(shape)
+        if shape["count"] < min_queries or not key:
+            continue
+        collection = shape["collection"]
+        if collection not in existing:
+            info = await database[collection].index_information()
+            existing[collection] = [list(index["key"]) for index in info.values()]
+        if any(_is_prefix(key, index) for index in existing[collection]):
+            continue
+        candidate = candidates.setdefault((collection, tuple(key)), {
+            "collection": collection, "keys": key, "queries": 0, "total_ms": 0.0, "example": shape["example"],
+        })
+        candidate["queries"] += shape["count"]
+        candidate["total_ms"] += shape["total_ms"]
+
+    # An index whose key starts with another candidate's key serves both
+    kept: List[Dict] = []
+    for candidate in sorted(candidates.values(), key=lambda c: len(c["keys"]), reverse=True):
+        wider = next((k for k in kept if k["collection"] == candidate["collection"]
+                      and _is_prefix(candidate["keys"], k["keys"])), None)
+        if wider:
+            wider["queries"] += candidate["queries"]
+            wider["total_ms"] += candidate["total_ms"]
+        else:
+            kept.append(candidate)
+
+    recommendations = []
+    for candidate in sorted(kept, key=lambda c: c["total_ms"], reverse=True):
+        try:
+            candidate["current_plan"] = await explain(candidate["collection"], candidate["example"])
+        except Exception as e:
+            candidate["current_plan"] = {"error": str(e)}
+        candidate["avg_ms"] = candidate["total_ms"] / candidate["queries"]
+        candidate["name"] = index_name(candidate["keys"])
+        recommendations.append(candidate)
+    return recommendations
+
+
+def index_name(keys: List[tuple]) -> str:
+    return "esr_" + "_".join(field for field, _ in keys)
+
+
+async def apply(recommendations: List[Dict] = None) -> List[Dict]:
+    """Create the recommended indexes and report the plan each example now gets."""
+    if recommendations is None:
+        recommendations = await recommend()
+    created = []
+    for recommendation in recommendations:
+        collection = _database()[recommendation["collection"]]
+        name = await collection.create_index(recommendation["keys"], name=recommendation["name"])
+        logger.info(f"Created index {name} on {recommendation['collection']}")
+        created.append({
+            "collection": recommendation["collection"],
+            "name": name,
+            "keys": recommendation["keys"],
+            "plan": await explain(recommendation["collection"], recommendation["example"]),
+        })
+    return created
+
+
+async def unused(collections: List[str] = None) -> List[Dict]:
+    """Indexes with no recorded use since the server (or index) started, per $indexStats."""
+    database = _database()
+    if collections is None:
+        collections = [AdReport.get_pymongo_collection().name, *rollups.ROLLUPS]
+    result = []
+    for name in collections:
+        stats = await database[name].aggregate([{"$indexStats": {}}]).to_list(length=None)
+        for index in stats:
+            if index["name"] == "_id_" or index["accesses"]["ops"]:
+                continue
+            result.append({
+                "collection": name,
+                "name": index["name"],
+                "keys": list(index["key"].items()),
+                "since": index["accesses"]["since"],
+            })
+    return result
+
+
+async def main(command: str = "recommend"):
+    load_dotenv()
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    await init_beanie(database=client.get_database("adtech_reports"), document_models=[AdReport, SavedReport, ImportJob])
+    commands = {"shapes": shapes, "recommend": recommend, "apply": apply, "unused": unused}
+    if command not in commands:
+        raise SystemExit(f"usage: python -m backend.index_advisor [{'|'.join(commands)}]")
+    print(json.dumps(await commands[command](), indent=2, default=str))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(*sys.argv[1:2]))
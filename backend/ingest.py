@@ -0,0 +1,278 @@
+import pandas as pd
+import numpy as np
+import io
+import os
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from .rollups import ADDITIVE_METRICS, partial_rollups
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks an uploaded CSV is parsed in, bounds import memory per job
+IMPORT_CHUNK_BYTES = int(os.getenv("IMPORT_CHUNK_BYTES", 8 * 1024 * 1024))
+
+# Worker processes for CSV parsing and coercion, kept off the API event loop
+IMPORT_POOL_SIZE = int(os.getenv("IMPORT_POOL_SIZE", 2))
+
+_executor = None
+
+# Map CSV columns to internal field names
+COLUMN_MAPPING = {
+    'Date': 'date',
+    'App ID': 'mobile_app_resolved_id',
+    'App Name': 'mobile_app_name',
+    'Domain': 'domain',
+    'Ad Unit': 'ad_unit_name',
+    'Ad Unit ID': 'ad_unit_id',
+    'Inventory Format': 'inventory_format_name',
+    'OS Version': 'operating_system_version_name',
+    'Total Requests': 'ad_exchange_total_requests',
+    'Responses Served': 'ad_exchange_responses_served',
+    'Match Rate': 'ad_exchange_match_rate',
+    'Impressions': 'ad_exchange_line_item_level_impressions',
+    'Clicks': 'ad_exchange_line_item_level_clicks',
+    'CTR': 'ad_exchange_line_item_level_ctr',
+    'Average eCPM': 'average_ecpm',
+    'Payout': 'payout'
+}
+
+STRING_FIELDS = [
+    'mobile_app_resolved_id', 'mobile_app_name', 'domain', 'ad_unit_name',
+    'ad_unit_id', 'inventory_format_name', 'operating_system_version_name'
+]
+
+# Dimension columns are read as text under either of their names, so IDs don't depend on a block's inferred dtype
+STRING_DTYPES = {
+    **{header: str for header, field in COLUMN_MAPPING.items() if field in STRING_FIELDS},
+    **{field: str for field in STRING_FIELDS},
+}
+
+# Identifies a row across uploads: the same day of the same ad unit, OS and format
+NATURAL_KEY = ['date', 'mobile_app_resolved_id', 'ad_unit_id', 'operating_system_version_name', 'inventory_format_name']
+
+INT_FIELDS = [
+    'ad_exchange_total_requests', 'ad_exchange_responses_served',
+    'ad_exchange_line_item_level_impressions', 'ad_exchange_line_item_level_clicks'
+]
+
+FLOAT_FIELDS = [
+    'ad_exchange_match_rate', 'ad_exchange_line_item_level_ctr', 'average_ecpm', 'payout'
+]
+
+
+def _coerce_dates(df: pd.DataFrame) -> pd.Series:
+    """Parse the date column once; blank or unparseable dates fall back to today."""
+    today = pd.Timestamp(datetime.now().date())
+    if 'date' not in df:
+        return pd.Series(today, index=df.index)
+
+    raw = df['date']
+    parsed = pd.to_datetime(raw, errors='coerce')
+    # A single inferred format is used for the fast path, retry stragglers one by one
+    retry = parsed.isna() & raw.notna() & (raw.astype(str).str.strip() != '')
+    if retry.any():
+        parsed[retry] = pd.to_datetime(raw[retry], errors='coerce', format='mixed')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    # BSON has no date type, store midnight datetimes like Beanie does
+    return parsed.fillna(today).dt.normalize()
+
+
+def _coerce_numeric(df: pd.DataFrame, field: str, integer: bool) -> Tuple[pd.Series, pd.Series]:
+    """Return the coerced column and a mask of rows whose value could not be converted."""
+    if field not in df:
+        default = 0 if integer else 0.0
+        return pd.Series(default, index=df.index), pd.Series(False, index=df.index)
+
+    raw = df[field]
+    values = pd.to_numeric(raw, errors='coerce')
+    invalid = values.isna() & raw.notna()
+    if integer:
+        invalid |= ~np.isfinite(values.fillna(0))
+        values = values.where(~invalid, 0).fillna(0).astype('int64')
+    else:
+        values = values.fillna(0.0).astype('float64')
+    return values, invalid
+
+
+def coerce_columns(df: pd.DataFrame, first_row: int = 1) -> Tuple[pd.DataFrame, List[str]]:
+    """Coerce a CSV frame into typed AdReport columns.
+
+    Every mapped column is converted with one vectorized operation. Rows with a
+    numeric value that cannot be converted are dropped and reported in the
+    returned error list, numbered from ``first_row``.
+    """
+    df = df.rename(columns=COLUMN_MAPPING)
+    columns: Dict[str, pd.Series] = {'date': _coerce_dates(df)}
+
+    for field in STRING_FIELDS:
+        if field in df:
+            columns[field] = df[field].fillna('').astype(str)
+        else:
+            columns[field] = pd.Series('', index=df.index)
+
+    invalid_by_field: Dict[str, pd.Series] = {}
+    for field in INT_FIELDS + FLOAT_FIELDS:
+        columns[field], invalid = _coerce_numeric(df, field, integer=field in INT_FIELDS)
+        if invalid.any():
+            invalid_by_field[field] = invalid
+
+    errors: List[str] = []
+    valid = pd.Series(True, index=df.index)
+    if invalid_by_field:
+        positions = {}
+        for field, invalid in invalid_by_field.items():
+            for pos in np.flatnonzero(invalid.to_numpy()):
+                positions.setdefault(pos, field)
+            valid &= ~invalid
+        for pos in sorted(positions):
+            field = positions[pos]
+            errors.append(f"Row {first_row + pos}: Invalid data - could not convert {field} value {df[field].iloc[pos]!r}")
+
+    frame = pd.DataFrame(columns)[valid.to_numpy()].reset_index(drop=True)
+    return frame, errors
+
+
+def to_records(frame: pd.DataFrame, report_id: str) -> List[Dict]:
+    """Turn coerced columns into BSON-ready AdReport dicts."""
+    keys = ['report_id', 'date'] + STRING_FIELDS + INT_FIELDS + FLOAT_FIELDS
+    values = [repeat(report_id), list(frame['date'].dt.to_pydatetime())]
+    values += [frame[field].tolist() for field in keys[2:]]
+    return [dict(zip(keys, row)) for row in zip(*values)]
+
+
+def coerce_frame(df: pd.DataFrame, report_id: str, first_row: int = 1) -> Tuple[List[Dict], List[str]]:
+    """Coerce a CSV frame into BSON-ready AdReport dicts and row errors."""
+    frame, errors = coerce_columns(df, first_row)
+    return to_records(frame, report_id), errors
+
+
+def _record_end(data: bytes) -> int:
+    """Offset just past the last complete record of ``data``, 0 if there is none.
+
+    ``data`` starts at a record, so a newline ends one only after an even
+    number of quote characters (doubled quotes inside a field count twice).
+    """
+    if b'"' not in data:
+        return data.rfind(b'\n') + 1
+    parts = data.split(b'"')
+    end = len(data)
+    for i in range(len(parts) - 1, -1, -1):
+        end -= len(parts[i])
+        if i % 2 == 0:
+            pos = parts[i].rfind(b'\n')
+            if pos >= 0:
+                return end + pos + 1
+        end -= 1  # the quote before this part
+    return 0
+
+
+def _count_records(block: bytes) -> int:
+    if b'"' not in block:
+        return block.count(b'\n')
+    return sum(part.count(b'\n') for part in block.split(b'"')[0::2])
+
+
+def iter_csv_blocks(fh: BinaryIO, block_bytes: int) -> Iterator[Tuple[bytes, bytes, int, int]]:
+    """Read a CSV file in record-aligned blocks of roughly ``block_bytes``.
+
+    Yields ``(header, block, first_row, bytes_consumed)`` so each block can be
+    parsed on its own and progress reported without knowing the row count.
+    Blocks only end on a newline outside quotes, so a quoted field spanning
+    several lines stays in one block.
+    """
+    header = fh.readline()
+    consumed = len(header)
+    first_row = 1
+    carry = b''
+    while True:
+        data = fh.read(block_bytes)
+        if not data:
+            break
+        data = carry + data
+        cut = _record_end(data)
+        if cut == 0:
+            carry = data
+            continue
+        block, carry = data[:cut], data[cut:]
+        consumed += len(block)
+        yield header, block, first_row, consumed
+        first_row += _count_records(block)
+    if carry.strip():
+        consumed += len(carry)
+        yield header, carry, first_row, consumed
+
+
+def block_columns(frame: pd.DataFrame) -> Dict:
+    """Column arrays of a coerced block for the on-disk snapshot (see snapshots.py).
+
+    Dimensions are factorized here, in the pool, as ``(codes, values)`` so the
+    parent only remaps a handful of distinct values per block.
+    """
+    columns = {"rows": len(frame)}
+    for field in STRING_FIELDS:
+        codes, uniques = pd.factorize(frame[field], use_na_sentinel=False)
+        columns[field] = (codes.astype(np.int32), list(uniques))
+    columns['date'] = (frame['date'].to_numpy().astype('datetime64[D]') - np.datetime64('1970-01-01', 'D')).astype(np.int32)
+    for field in ADDITIVE_METRICS:
+        columns[field] = frame[field].to_numpy(dtype=np.float64 if field in FLOAT_FIELDS else np.int64)
+    return columns
+
+
+def block_values(frame: pd.DataFrame) -> Dict[str, Dict[str, int]]:
+    """Occurrences of every dimension value in a block, for the value catalog (catalog.py)."""
+    return {field: frame[field].value_counts(sort=False).to_dict() for field in STRING_FIELDS}
+
+
+def parse_block(header: bytes, block: bytes, report_id: str, first_row: int,
+                columns: bool = False) -> Tuple[List[Dict], List[str], Dict]:
+    """Parse one block from iter_csv_blocks.
+
+    Returns the AdReport dicts, the row errors and the block's pre-aggregated
+    rows (rollup partials, metric totals, dimension value counts, and
+    snapshot columns when ``columns`` is set) so the parent only has to
+    write them. ``aggregates["timings"]`` holds the
+    seconds spent parsing, coercing and aggregating, for the import metrics.
+    """
+    started = time.perf_counter()
+    df = pd.read_csv(io.BytesIO(header + block), header=0, encoding='utf-8-sig', dtype=STRING_DTYPES)
+    parsed = time.perf_counter()
+    frame, errors = coerce_columns(df, first_row)
+    records = to_records(frame, report_id)
+    coerced = time.perf_counter()
+    aggregates = {
+        "rollups": partial_rollups(frame, report_id),
+        # Block totals for the materialized summary (summaries.py)
+        "totals": {field: frame[field].sum().item() for field in ADDITIVE_METRICS},
+        "values": block_values(frame),
+    }
+    if columns:
+        aggregates["columns"] = block_columns(frame)
+    aggregates["timings"] = {
+        "parse": parsed - started,
+        "coerce": coerced - parsed,
+        "aggregate": time.perf_counter() - coerced,
+    }
+    return records, errors, aggregates
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Return the shared parse pool, starting it on first use."""
+    global _executor
+    if _executor is None:
+        # spawn, not fork: the parent already runs the event loop and driver threads
+        _executor = ProcessPoolExecutor(max_workers=IMPORT_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Started import parse pool with {IMPORT_POOL_SIZE} processes")
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,157 @@
+"""Import job queue backed by the import_jobs collection.
+
+The API enqueues a job after spooling the upload to GridFS. Workers claim
+jobs atomically with find_one_and_update, hold a lease they extend with a
+heartbeat while processing, and a job whose lease runs out (its worker died)
+becomes claimable again until it has used up IMPORT_MAX_ATTEMPTS.
+"""
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument
+from bson import ObjectId
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from .models import ImportJob
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMPORT_LEASE_SECONDS = int(os.getenv("IMPORT_LEASE_SECONDS", 60))
+IMPORT_MAX_ATTEMPTS = int(os.getenv("IMPORT_MAX_ATTEMPTS", 3))
+
+# How uploads are applied to ad_reports unless the upload asks otherwise, see worker.py
+IMPORT_MODES = ["replace", "upsert", "partition"]
+IMPORT_MODE = os.getenv("IMPORT_MODE", "replace")
+
+# Only the first errors are kept on the job document to stay far below 16 MB
+MAX_STORED_ERRORS = 1000
+
+UPLOAD_READ_BYTES = 1024 * 1024
+
+PROGRESS_FIELDS = ["status", "progress", "errors", "inserted", "processed_records", "total_records", "bytes_processed"]
+
+
+class LeaseLost(Exception):
+    """Raised when another worker has taken over a job."""
+
+
+def _collection():
+    return ImportJob.get_pymongo_collection()
+
+
+def _uploads() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(_collection().database, bucket_name="import_uploads")
+
+
+async def enqueue(job_id: str, file, mode: str = IMPORT_MODE) -> dict:
+    """Spool an UploadFile to GridFS and create its pending job, imported in ``mode``."""
+    grid_in = _uploads().open_upload_stream(file.filename, metadata={"job_id": job_id})
+    size = 0
+    while chunk := await file.read(UPLOAD_READ_BYTES):
+        await grid_in.write(chunk)
+        size += len(chunk)
+    await grid_in.close()
+
+    job = ImportJob(job_id=job_id, status="pending", progress=0, errors=[], inserted=0,
+                    created_at=datetime.utcnow(), filename=file.filename,
+                    file_id=str(grid_in._id), bytes_total=size, mode=mode)
+    await job.insert()
+    return {"job_id": job_id, "bytes_total": size, "mode": mode}
+
+
+async def download(job: dict, fh):
+    """Copy a job's spooled upload from GridFS into the open binary file ``fh``."""
+    grid_out = await _uploads().open_download_stream(ObjectId(job["file_id"]))
+    while chunk := await grid_out.readchunk():
+        fh.write(chunk)
+    fh.flush()
+
+
+async def discard_upload(job: dict):
+    try:
+        await _uploads().delete(ObjectId(job["file_id"]))
+    except Exception as e:
+        logger.warning(f"Could not delete upload for job {job['job_id']}: {str(e)}")
+
+
+async def claim(worker_id: str) -> Optional[dict]:
+    """Atomically take the oldest pending job, or one whose lease expired."""
+    now = datetime.utcnow()
+    return await _collection().find_one_and_update(
+        {
+            "$or": [
+                {"status": "pending"},
+                {"status": "processing", "lease_expires_at": {"$lt": now}},
+            ],
+            "attempts": {"$lt": IMPORT_MAX_ATTEMPTS},
+        },
+        {
+            "$set": {
+                "status": "processing",
+                "worker_id": worker_id,
+                "lease_expires_at": now + timedelta(seconds=IMPORT_LEASE_SECONDS),
+                "heartbeat_at": now,
+                "updated_at": now,
+                # A retried job starts over, process_csv replaces the data anyway
+                "progress": 0,
+                "errors": [],
+                "inserted": 0,
+                "processed_records": 0,
+                "bytes_processed": 0,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def fail_exhausted() -> int:
+    """Mark stale jobs that have no attempts left as failed, returns how many."""
+    now = datetime.utcnow()
+    result = await _collection().update_many(
+        {"status": "processing", "lease_expires_at": {"$lt": now}, "attempts": {"$gte": IMPORT_MAX_ATTEMPTS}},
+        {"$set": {"status": "failed", "updated_at": now},
+         "$push": {"errors": "Job abandoned: worker lease expired too many times"}},
+    )
+    return result.modified_count
+
+
+async def heartbeat(job_id: str, worker_id: str):
+    """Extend the lease on a job, raising LeaseLost if another worker owns it."""
+    now = datetime.utcnow()
+    result = await _collection().update_one(
+        {"job_id": job_id, "worker_id": worker_id, "status": "processing"},
+        {"$set": {"heartbeat_at": now, "lease_expires_at": now + timedelta(seconds=IMPORT_LEASE_SECONDS)}},
+    )
+    if result.matched_count == 0:
+        raise LeaseLost(job_id)
+
+
+async def save_progress(job: dict):
+    """Write the job's progress fields back, only while this worker holds it."""
+    update = {field: job.get(field) for field in PROGRESS_FIELDS if field in job}
+    if "errors" in update:
+        update["errors"] = update["errors"][:MAX_STORED_ERRORS]
+    update["updated_at"] = datetime.utcnow()
+    result = await _collection().update_one(
+        {"job_id": job["job_id"], "worker_id": job["worker_id"]},
+        {"$set": update},
+    )
+    if result.matched_count == 0:
+        raise LeaseLost(job["job_id"])
+
+
+async def count_by_status() -> Dict[str, int]:
+    """Number of pending and processing jobs, for the metrics endpoint."""
+    cursor = _collection().aggregate([
+        {"$match": {"status": {"$in": ["pending", "processing"]}}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+    ])
+    counts = {"pending": 0, "processing": 0}
+    counts.update({doc["_id"]: doc["count"] for doc in await cursor.to_list(length=None)})
+    return counts
+
+
+async def get_job(job_id: str) -> Optional[dict]:
+    return await _collection().find_one({"job_id": job_id}, {"_id": 0})
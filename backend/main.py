@@ -1,10 +1,12 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
 import sys
 import motor.motor_asyncio
 from beanie import init_beanie
+import asyncio
 import logging
 
 # Configure logging
@@ -18,13 +20,14 @@ logger = logging.getLogger(__name__)
 # Import your Beanie model and routers
 try:
     logger.info("Attempting to import models")
-    from .models import AdReport, SavedReport, ImportJob
+    from .models import AdReport, SavedReport, ImportJob, ExportJob
     logger.info("Models imported successfully")
 except Exception as e:
     logger.error(f"Failed to import models: {e}")
     AdReport = None
     SavedReport = None
     ImportJob = None
+    ExportJob = None
 
 try:
     logger.info("Attempting to import data router")
@@ -42,6 +45,18 @@ except Exception as e:
     logger.error(f"Failed to import reports router: {e}")
     reports_router = None
 
+try:
+    logger.info("Attempting to import admin router")
+    from .routers.admin import router as admin_router
+    logger.info("Admin router imported successfully")
+except Exception as e:
+    logger.error(f"Failed to import admin router: {e}")
+    admin_router = None
+
+from .ingest import shutdown_executor
+from .worker import run_worker
+from . import catalog, dictionaries, index_advisor, jobs, metrics, olap, rollups
+
 load_dotenv()
 
 db_connected = False
@@ -59,12 +74,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.on_event("startup")
 async def on_startup():
     """Initialize database connection and Beanie ODM on app startup."""
     logger.info("Startup event triggered")
+    app.state.loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
     mongodb_url = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
     logger.info(f"Connecting to MongoDB at {mongodb_url}")
     client = motor.motor_asyncio.AsyncIOMotorClient(
@@ -73,11 +90,22 @@ async def on_startup():
 
     # Initialize Beanie with the AdReport document model
     try:
-        if AdReport and SavedReport and ImportJob:
-            await init_beanie(database=database, document_models=[AdReport, SavedReport, ImportJob])
+        if AdReport and SavedReport and ImportJob and ExportJob:
+            await init_beanie(database=database, document_models=[AdReport, SavedReport, ImportJob, ExportJob])
             global db_connected
             db_connected = True
             logger.info("Database connection and Beanie initialization completed")
+            await rollups.ensure_indexes()
+            await dictionaries.ensure_indexes()
+            await catalog.ensure_indexes()
+            if index_advisor.INDEX_ADVISOR_ENABLED:
+                app.state.shape_flusher = asyncio.create_task(index_advisor.flush_periodically())
+            if olap.enabled():
+                # Load the columnar engine in the background and keep it current, queries wait for the first load
+                app.state.olap_watcher = asyncio.create_task(olap.engine.watch())
+            # Run an import worker in this process unless dedicated workers are deployed
+            if os.getenv("IMPORT_EMBEDDED_WORKER", "1") != "0":
+                app.state.import_worker = asyncio.create_task(run_worker())
         else:
             logger.warning("Skipping Beanie init due to missing models")
             db_connected = False
@@ -85,6 +113,17 @@ async def on_startup():
         logger.error(f"Failed to initialize database: {e}")
         # Continue without raising to allow app to start
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Stop the embedded import worker and the parse pool with the app."""
+    for name in ("import_worker", "loop_monitor", "shape_flusher", "olap_watcher"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+    shutdown_executor()
+    if db_connected:
+        await index_advisor.flush()
+
 @app.get("/")
 async def root():
     return {"message": "Adtech Reporting API"}
@@ -92,9 +131,20 @@ async def root():
 
 @app.get("/health")
 async def health():
-    logger.info("Health endpoint called")
+    metrics.sampled_debug(logger, "Health endpoint called")
     return {"status": "healthy" if db_connected else "unhealthy", "db_connected": db_connected}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics of this process."""
+    if db_connected:
+        try:
+            for status, count in (await jobs.count_by_status()).items():
+                metrics.IMPORT_JOBS.set(count, status=status)
+        except Exception as e:
+            logger.warning(f"Could not count import jobs: {str(e)}")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Include the routers in the application
 if data_router:
     logger.info("Including data router")
@@ -107,3 +157,9 @@ if reports_router:
     app.include_router(reports_router, prefix="/api/reports", tags=["reports"])
 else:
     logger.warning("Skipping reports router include due to import failure")
+
+if admin_router:
+    logger.info("Including admin router")
+    app.include_router(admin_router, prefix="/api/admin", tags=["admin"])
+else:
+    logger.warning("Skipping admin router include due to import failure")
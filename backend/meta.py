@@ -0,0 +1,118 @@
+"""Shared bookkeeping about the ad_reports data, kept in the app_meta collection.
+
+The data generation is a counter bumped whenever ad_reports changes (imports,
+deletes). Caches key their entries on it, so a bump from any process, API or
+import worker, invalidates them everywhere. The same document carries a
+has_data flag so requests never have to count the collection to know
+whether anything was imported.
+
+Imports also stamp every report_id whose rows they changed with a new
+version in the report_versions collection, before they bump the
+generation. The columnar engine (olap.py) reloads exactly the report_ids
+whose version moved.
+"""
+from pymongo import ReturnDocument, UpdateOne
+from typing import Dict, Iterable
+from .models import AdReport
+import os
+import time
+
+META_COLLECTION = "app_meta"
+VERSIONS_COLLECTION = "report_versions"
+
+# Version given to report_ids imported before versions were recorded
+INITIAL_VERSION = "initial"
+
+# How long a process trusts its last read of the state before re-reading it
+GENERATION_POLL_SECONDS = float(os.getenv("GENERATION_POLL_SECONDS", 1))
+
+_state = {"generation": None, "has_data": None, "fetched_at": 0.0}
+
+
+def _collection():
+    return AdReport.get_pymongo_collection().database[META_COLLECTION]
+
+
+def _versions():
+    return AdReport.get_pymongo_collection().database[VERSIONS_COLLECTION]
+
+
+def _remember(doc: dict):
+    _state.update(generation=doc.get("generation", 0), has_data=doc.get("has_data"), fetched_at=time.monotonic())
+
+
+async def _read() -> dict:
+    if _state["generation"] is None or time.monotonic() - _state["fetched_at"] > GENERATION_POLL_SECONDS:
+        _remember(await _collection().find_one({"_id": "data"}) or {})
+    return _state
+
+
+async def bump_generation(has_data: bool = None) -> int:
+    """Bump the generation, optionally recording whether ad_reports now has rows."""
+    update = {"$inc": {"generation": 1}}
+    if has_data is not None:
+        update["$set"] = {"has_data": has_data}
+    doc = await _collection().find_one_and_update(
+        {"_id": "data"}, update, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    _remember(doc)
+    return doc["generation"]
+
+
+async def get_generation() -> int:
+    return (await _read())["generation"]
+
+
+async def current_generation() -> int:
+    """The generation as stored right now, bypassing this process's cached read."""
+    _remember(await _collection().find_one({"_id": "data"}) or {})
+    return _state["generation"]
+
+
+async def has_data() -> bool:
+    """O(1) check whether any report data is loaded."""
+    state = await _read()
+    if state["has_data"] is None:
+        # Data imported before the flag existed, estimate once from collection metadata
+        present = await AdReport.get_pymongo_collection().estimated_document_count() > 0
+        doc = await _collection().find_one_and_update(
+            {"_id": "data", "has_data": {"$exists": False}}, {"$set": {"has_data": present}},
+            upsert=False, return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            _remember(doc)
+        else:
+            _state["has_data"] = present
+        return present
+    return state["has_data"]
+
+
+async def stamp_reports(report_ids: Iterable[str], version: str, exclusive: bool = False):
+    """Record that the rows of ``report_ids`` changed, as ``version``.
+
+    With ``exclusive`` every other report_id is forgotten, for imports that
+    replace all data.
+    """
+    report_ids = list(report_ids)
+    if report_ids:
+        await _versions().bulk_write(
+            [UpdateOne({"_id": report_id}, {"$set": {"version": version}}, upsert=True) for report_id in report_ids],
+            ordered=False,
+        )
+    if exclusive:
+        await _versions().delete_many({"_id": {"$nin": report_ids}})
+
+
+async def clear_versions():
+    await _versions().delete_many({})
+
+
+async def report_versions() -> Dict[str, str]:
+    """Version of every report_id with data."""
+    versions = {doc["_id"]: doc["version"] for doc in await _versions().find().to_list(length=None)}
+    if not versions and await has_data():
+        # Data imported before versions were recorded, stamp it once
+        report_ids = await AdReport.get_pymongo_collection().distinct("report_id")
+        await stamp_reports(report_ids, INITIAL_VERSION)
+        versions = dict.fromkeys(report_ids, INITIAL_VERSION)
+    return versions
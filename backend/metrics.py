@@ -0,0 +1,290 @@
+"""Prometheus metrics for the API and the import workers.
+
+A small in-process registry of counters, gauges and histograms, rendered in
+the Prometheus text format by ``GET /metrics`` on the API and, when
+WORKER_METRICS_PORT is set, by a standalone worker on that port. Each
+process exposes its own values; Prometheus scrapes every instance and
+aggregates them.
+
+Recorded:
+
+- HTTP request latency per route template, method and status (middleware)
+- aggregation time per endpoint and collection. A sample of aggregations
+  (METRICS_EXPLAIN_SAMPLE_RATE) is re-run with explain in the background
+  for docs examined vs returned.
+- import stage timings (parse, coerce, encode, insert, rollups, snapshot,
+  swap, catalog, summaries) and rows imported
+- event-loop lag, sampled every METRICS_LOOP_INTERVAL_SECONDS
+- background jobs in flight in this process, and queued imports
+- report requests coalesced onto an identical in-flight one (singleflight.py)
+
+Hot-path logging (pipelines, results) goes through ``sampled_debug``, which
+formats nothing unless DEBUG logging is on and the sample hits.
+"""
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# Fraction of aggregations re-run with explain for docs examined vs returned
+METRICS_EXPLAIN_SAMPLE_RATE = float(os.getenv("METRICS_EXPLAIN_SAMPLE_RATE", 0.01))
+# Fraction of hot-path debug messages (pipelines, results) actually logged
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+METRICS_LOOP_INTERVAL_SECONDS = float(os.getenv("METRICS_LOOP_INTERVAL_SECONDS", 1))
+# Standalone import workers serve /metrics on this port when set
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, le: str = None) -> str:
+    pairs = list(zip(names, values))
+    if le is not None:
+        pairs.append(("le", le))
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+        _registry.append(self)
+
+    def _key(self, labels: Dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """Count the block as in flight while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state["buckets"][i] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, state["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, bound)} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, '+Inf')} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {state['count']}")
+        return lines
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "adreport_http_request_duration_seconds", "Time to serve a request, including streamed bodies.",
+    ("method", "route", "status"))
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "adreport_http_requests_in_progress", "Requests being served.", ("method", "route"))
+AGGREGATION_SECONDS = Histogram(
+    "adreport_aggregation_duration_seconds", "MongoDB aggregation time until the first batch arrived.",
+    ("endpoint", "collection"))
+EXPLAIN_DOCS_EXAMINED = Counter(
+    "adreport_explain_docs_examined_total", "Documents examined by explained sample aggregations.",
+    ("endpoint", "collection"))
+EXPLAIN_DOCS_RETURNED = Counter(
+    "adreport_explain_docs_returned_total", "Documents returned by the first stage of explained sample aggregations.",
+    ("endpoint", "collection"))
+EXPLAIN_SAMPLES = Counter(
+    "adreport_explain_samples_total", "Aggregations re-run with explain.", ("endpoint", "collection", "plan"))
+IMPORT_STAGE_SECONDS = Histogram(
+    "adreport_import_stage_duration_seconds", "Time per import block (or per job for swap and rebuild) in each stage.",
+    ("stage",))
+IMPORT_ROWS = Counter("adreport_import_rows_total", "Rows imported, by outcome.", ("outcome",))
+IMPORT_ROWS_PER_SECOND = Gauge(
+    "adreport_import_rows_per_second", "Throughput of the last import job finished by this process.")
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "adreport_event_loop_lag_seconds", "How late the event loop woke a sleeping task.", buckets=LAG_BUCKETS)
+BACKGROUND_JOBS = Gauge(
+    "adreport_background_jobs_in_flight", "Background jobs running in this process.", ("kind",))
+EXPORT_JOBS = Counter(
+    "adreport_export_jobs_total", "Export job requests, by whether a job was started or reused.", ("outcome",))
+SUMMARY_REQUESTS = Counter(
+    "adreport_summary_requests_total", "Dashboard summaries, by whether a materialized row or a live aggregation served them.",
+    ("source",))
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "adreport_single_flight_requests_total",
+    "Report requests that started an aggregation (leader) or awaited an identical one in flight (shared).",
+    ("endpoint", "outcome"))
+IMPORT_JOBS = Gauge("adreport_import_jobs", "Import jobs in the queue, by status.", ("status",))
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def sampled_debug(log: logging.Logger, message: str, *args):
+    """``log.debug(message % args)`` for a LOG_SAMPLE_RATE sample of calls, formatting lazily."""
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        log.debug(message, *args)
+
+
+_explaining = set()
+
+
+async def _explain(endpoint: str, collection, pipeline: List[Dict]):
+    from .index_advisor import explain
+    try:
+        plan = await explain(collection.name, None, pipeline)
+    except Exception as e:
+        logger.debug(f"Sample explain failed: {str(e)}")
+        return
+    labels = {"endpoint": endpoint, "collection": collection.name}
+    EXPLAIN_SAMPLES.inc(plan="collscan" if plan["collscan"] else "index", **labels)
+    EXPLAIN_DOCS_EXAMINED.inc(plan["docs_examined"] or 0, **labels)
+    EXPLAIN_DOCS_RETURNED.inc(plan["returned"] or 0, **labels)
+
+
+def observe_aggregation(endpoint: str, collection, pipeline: List[Dict], seconds: float):
+    """Record one aggregation; a sample of them is explained in the background."""
+    AGGREGATION_SECONDS.observe(seconds, endpoint=endpoint, collection=collection.name)
+    sampled_debug(logger, "%s aggregation on %s took %.3fs: %s", endpoint, collection.name, seconds, pipeline)
+    if METRICS_ENABLED and random.random() < METRICS_EXPLAIN_SAMPLE_RATE:
+        task = asyncio.create_task(_explain(endpoint, collection, pipeline))
+        _explaining.add(task)
+        task.add_done_callback(_explaining.discard)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request under its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _route(scope) -> str:
+        from starlette.routing import Match
+        for route in getattr(scope.get("app"), "routes", []):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "unmatched")
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        route, method = self._route(scope), scope["method"]
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            with HTTP_REQUESTS_IN_PROGRESS.track(method=method, route=route):
+                await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, route=route,
+                                         status=status["code"])
+
+
+async def monitor_event_loop():
+    """Measure how late the loop wakes this task up, until cancelled."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(METRICS_LOOP_INTERVAL_SECONDS)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - METRICS_LOOP_INTERVAL_SECONDS))
+
+
+async def _serve_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"Not Found\n", "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(port: int = WORKER_METRICS_PORT) -> Optional[asyncio.AbstractServer]:
+    """Expose /metrics on ``port`` for processes without the API (import workers)."""
+    if not port or not METRICS_ENABLED:
+        return None
+    server = await asyncio.start_server(_serve_request, port=port)
+    logger.info(f"Serving metrics on port {port}")
+    return server
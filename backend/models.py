@@ -34,8 +34,12 @@ class AdReport(Document):
             IndexModel([("domain", ASCENDING)]),
             IndexModel([("ad_unit_name", ASCENDING)]),
             IndexModel([("inventory_format_name", ASCENDING)]),
-            # Index for report_id filtering
-            IndexModel([("report_id", ASCENDING)]),
+            # Equality on report_id then a date range (ESR order), also serves report_id alone
+            IndexModel([("report_id", ASCENDING), ("date", ASCENDING)]),
+            # Natural key (ingest.NATURAL_KEY) matched by upsert imports
+            IndexModel([("date", ASCENDING), ("mobile_app_resolved_id", ASCENDING), ("ad_unit_id", ASCENDING),
+                        ("operating_system_version_name", ASCENDING), ("inventory_format_name", ASCENDING)],
+                       name="natural_key"),
         ]
 class ImportJob(BaseModel):
     job_id: str
@@ -54,9 +58,49 @@ class ImportJob(Document):
     errors: List[str] = []
     inserted: int = 0
     created_at: datetime
+    # Queue bookkeeping, see backend/jobs.py
+    filename: Optional[str] = None
+    file_id: Optional[str] = None  # GridFS id of the spooled upload
+    bytes_total: Optional[int] = None
+    mode: str = "replace"  # replace, upsert or partition, see backend/worker.py
+    bytes_processed: int = 0
+    attempts: int = 0
+    worker_id: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
     class Settings:
         name = "import_jobs"
+        indexes = [
+            IndexModel([("job_id", ASCENDING)], unique=True),
+            # Index for claiming the oldest pending or stale job
+            IndexModel([("status", ASCENDING), ("created_at", ASCENDING)]),
+        ]
+
+class ExportJob(Document):
+    export_id: str
+    key: str  # hash of the query fingerprint and format, see backend/export_jobs.py
+    generation: int  # data generation the export was computed on
+    status: str  # pending, running, completed, failed
+    format: str
+    query: dict
+    rows: int = 0
+    bytes: int = 0
+    path: str
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    completed_at: Optional[datetime] = None
+
+    class Settings:
+        name = "export_jobs"
+        indexes = [
+            IndexModel([("export_id", ASCENDING)], unique=True),
+            # Index for reusing the export of the same query on the same data
+            IndexModel([("key", ASCENDING), ("generation", ASCENDING)]),
+            IndexModel([("updated_at", ASCENDING)]),
+        ]
 
 class SavedReport(Document):
     name: str
@@ -0,0 +1,287 @@
+"""Columnar in-process query engine, an alternative to MongoDB aggregation.
+
+Enabled with QUERY_ENGINE=columnar. ad_reports is loaded into memory as
+one segment per report_id:
+
+- string dimensions are int32 codes into the segment's own dictionaries,
+  plus a code map translating them to engine-wide codes
+- dates are int32 days since 1970-01-01
+- the additive metrics are contiguous int64/float64 arrays
+
+A segment comes from a memory-mapped snapshot (snapshots.py) when one
+matches the data, otherwise from the collection. A report masks each
+segment's rows with the filters (np.isin on codes, a range on days) and
+gathers the matching rows with engine-wide codes. It sorts the group codes
+with np.lexsort and sums each run with np.add.reduceat. Ratio metrics are
+derived from the sums exactly like the Mongo pipeline does. Rows come back
+in the same dimension order, so callers can page them like a cached result.
+
+Imports stamp every report_id they change with a new version (meta.py).
+Each API process runs ``watch``, which reloads the segments whose version
+moved as soon as the data generation does (any import or delete), so no
+query pays for the reload. Queries arriving meanwhile are answered from the
+segments already loaded.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+from . import dictionaries, meta, partitions, rollups, snapshots
+from .ingest import STRING_FIELDS
+from .models import AdReport
+from .pipeline import RATIO_METRICS, summed_fields
+import asyncio
+import logging
+import numpy as np
+import os
+import pandas as pd
+import time
+
+logger = logging.getLogger(__name__)
+
+# mongo (default) or columnar
+QUERY_ENGINE = os.getenv("QUERY_ENGINE", "mongo")
+# Documents fetched per batch while loading a segment
+OLAP_LOAD_BATCH_ROWS = int(os.getenv("OLAP_LOAD_BATCH_ROWS", 100000))
+
+ADDITIVE_METRICS = rollups.ADDITIVE_METRICS
+INT_METRICS = [m for m in ADDITIVE_METRICS if m != "payout"]
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def enabled() -> bool:
+    return QUERY_ENGINE == "columnar"
+
+
+class Dictionary:
+    """Grow-only mapping between dimension values and int codes."""
+
+    def __init__(self):
+        self.values: List = []
+        self.codes: Dict = {}
+
+    def _code(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values) -> np.ndarray:
+        local, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+        mapping = np.fromiter((self._code(value) for value in uniques), dtype=np.int32, count=len(uniques))
+        return mapping[local]
+
+    def lookup(self, values) -> np.ndarray:
+        """Codes of the known ``values``; unknown values can't match anything."""
+        return np.array([self.codes[value] for value in values if value in self.codes], dtype=np.int32)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(self.values, dtype=object)[codes]
+
+
+class Segment:
+    def __init__(self, report_id: str, version: str, columns: Dict[str, np.ndarray],
+                 dictionaries: Dict[str, List], source: str):
+        self.report_id = report_id
+        self.version = version
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.source = source  # "snapshot" (memory-mapped) or "mongo"
+        self.rows = len(columns["date"])
+        # Segment code -> engine code, per dimension; set by the engine
+        self.code_maps: Dict[str, np.ndarray] = {}
+
+
+class ColumnarEngine:
+    def __init__(self):
+        self.dictionaries = {dim: Dictionary() for dim in STRING_FIELDS}
+        self.segments: Dict[str, Segment] = {}
+        self.generation = None
+        self.refreshed_at = None
+        self.last_refresh_seconds = None
+        self.queries = 0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _empty_columns() -> Dict[str, np.ndarray]:
+        columns = {dim: np.empty(0, dtype=np.int32) for dim in STRING_FIELDS}
+        columns["date"] = np.empty(0, dtype=np.int32)
+        columns.update({m: np.empty(0, dtype=np.int64) for m in INT_METRICS})
+        columns["payout"] = np.empty(0, dtype=np.float64)
+        return columns
+
+    async def _load_segment(self, report_id: str, version: str) -> Segment:
+        manifest = snapshots.find(report_id, version)
+        if manifest:
+            columns, values = snapshots.load(manifest)
+            segment = Segment(report_id, version, columns, values, "snapshot")
+        else:
+            segment = await self._read_segment(report_id, version)
+        segment.code_maps = {
+            dim: self.dictionaries[dim].encode(segment.dictionaries[dim]) if segment.dictionaries[dim]
+            else np.empty(0, dtype=np.int32)
+            for dim in STRING_FIELDS
+        }
+        return segment
+
+    async def _read_segment(self, report_id: str, version: str) -> Segment:
+        projection = {"_id": 0, "date": 1, **{field: 1 for field in STRING_FIELDS + ADDITIVE_METRICS}}
+        match = {"report_id": report_id, **await partitions.hidden_match()}
+        cursor = AdReport.get_pymongo_collection().find(match, projection, batch_size=OLAP_LOAD_BATCH_ROWS)
+        local = {dim: Dictionary() for dim in STRING_FIELDS}
+        empty = self._empty_columns()
+        parts: Dict[str, list] = {name: [] for name in empty}
+        while True:
+            batch = await cursor.to_list(length=OLAP_LOAD_BATCH_ROWS)
+            if not batch:
+                break
+            frame = pd.DataFrame(batch)
+            for dim in STRING_FIELDS:
+                parts[dim].append(local[dim].encode(frame[dim].to_numpy() if dim in frame else [None] * len(frame)))
+            days = pd.to_datetime(frame["date"]).to_numpy().astype("datetime64[D]") - EPOCH
+            parts["date"].append(days.astype(np.int32))
+            for metric in ADDITIVE_METRICS:
+                dtype = np.float64 if metric == "payout" else np.int64
+                values = frame[metric] if metric in frame else pd.Series(0, index=frame.index)
+                parts[metric].append(values.fillna(0).to_numpy(dtype=dtype))
+        columns = {name: np.concatenate(arrays) if arrays else empty[name] for name, arrays in parts.items()}
+        values = {dim: local[dim].values for dim in STRING_FIELDS}
+        if dictionaries.compact():
+            # Compact storage holds codes, the engine works on names
+            for dim in STRING_FIELDS:
+                values[dim] = await dictionaries.names(dim, values[dim])
+        return Segment(report_id, version, columns, values, "mongo")
+
+    async def load(self, versions: Dict[str, str]) -> int:
+        """Bring the segments in line with ``versions`` (report_id -> version), returns how many were reloaded."""
+        segments = {rid: segment for rid, segment in self.segments.items() if versions.get(rid) == segment.version}
+        changed = [rid for rid in versions if rid not in segments]
+        for report_id in changed:
+            segments[report_id] = await self._load_segment(report_id, versions[report_id])
+        self.segments = segments
+        return len(changed)
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Reload the segments that changed since the last refresh; True if the generation moved."""
+        async with self._lock:
+            generation = await meta.get_generation()
+            if generation == self.generation and not force:
+                return False
+            started = time.perf_counter()
+            changed = await self.load(await meta.report_versions())
+            self.generation = generation
+            self.refreshed_at = datetime.utcnow()
+            self.last_refresh_seconds = time.perf_counter() - started
+            logger.info(f"Columnar engine at generation {generation}: reloaded {changed} of "
+                        f"{len(self.segments)} segments in {self.last_refresh_seconds:.2f}s")
+            return True
+
+    async def watch(self):
+        """Refresh whenever the data generation moves, until cancelled."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Columnar engine refresh failed: {str(e)}")
+            await asyncio.sleep(meta.GENERATION_POLL_SECONDS)
+
+    async def query(self, request) -> List[Dict]:
+        """Every row of a report, sorted on its dimensions like the Mongo path returns them."""
+        if self.generation is None:
+            # Only until the first load; later changes are picked up by watch()
+            await self.refresh()
+        self.queries += 1
+        return await asyncio.to_thread(self._query, request, list(self.segments.values()))
+
+    def _select(self, request, segment: Segment) -> Optional[np.ndarray]:
+        """Positions of the segment's rows matching the request's filters, None for all of them."""
+        columns = segment.columns
+        mask = None
+        for key, values in (request.filters or {}).items():
+            if not values or key not in self.dictionaries and key != "date":
+                continue
+            if key == "date":
+                # The stored dates are datetimes, string values never equal them
+                selected = np.zeros(segment.rows, dtype=bool)
+            else:
+                local = np.flatnonzero(np.isin(segment.code_maps[key], self.dictionaries[key].lookup(values)))
+                selected = np.isin(columns[key], local)
+            mask = selected if mask is None else mask & selected
+        if request.date_range:
+            start = (np.datetime64(request.date_range.start, "D") - EPOCH).astype(np.int32)
+            end = (np.datetime64(request.date_range.end, "D") - EPOCH).astype(np.int32)
+            selected = (columns["date"] >= start) & (columns["date"] <= end)
+            mask = selected if mask is None else mask & selected
+        return None if mask is None else np.flatnonzero(mask)
+
+    def _gather(self, name: str, parts: List[tuple]) -> np.ndarray:
+        """One column of every selected row across segments, dimensions as engine codes."""
+        arrays = []
+        for segment, index in parts:
+            values = segment.columns[name] if index is None else segment.columns[name][index]
+            arrays.append(segment.code_maps[name][values] if name in segment.code_maps else np.asarray(values))
+        return np.concatenate(arrays)
+
+    def _query(self, request, segments: List[Segment]) -> List[Dict]:
+        dimensions, metrics = list(request.dimensions), list(request.metrics)
+        parts = [(segment, self._select(request, segment)) for segment in segments if segment.rows]
+        parts = [(segment, index) for segment, index in parts if index is None or len(index)]
+        if not parts:
+            return []
+
+        keys = [self._gather(dim, parts) for dim in dimensions]
+        if keys:
+            order = np.lexsort(keys[::-1])
+            sorted_keys = [key[order] for key in keys]
+            change = np.zeros(len(order), dtype=bool)
+            change[0] = True
+            for key in sorted_keys:
+                change[1:] |= key[1:] != key[:-1]
+            starts = np.flatnonzero(change)
+        else:
+            # No dimensions: everything matched is one group
+            order = np.arange(sum(segment.rows if index is None else len(index) for segment, index in parts))
+            sorted_keys, starts = [], np.zeros(1, dtype=np.intp)
+
+        sums = {field: np.add.reduceat(self._gather(field, parts)[order], starts) for field in summed_fields(metrics)}
+        output = {}
+        for dim, key in zip(dimensions, sorted_keys):
+            codes = key[starts]
+            if dim == "date":
+                days = EPOCH + codes.astype("timedelta64[D]")
+                output[dim] = days.astype("datetime64[ms]").astype(object)
+            else:
+                output[dim] = self.dictionaries[dim].decode(codes)
+        for metric in metrics:
+            if metric in RATIO_METRICS:
+                numerator, denominator, scale = RATIO_METRICS[metric]
+                num, den = sums[numerator], sums[denominator]
+                ratio = np.divide(num, den, out=np.zeros(len(den)), where=den != 0)
+                if scale is not None:
+                    ratio = ratio * scale
+                # Mongo's $cond yields the integer 0 for an empty denominator
+                output[metric] = [value if d else 0 for value, d in zip(ratio.tolist(), den.tolist())]
+            else:
+                output[metric] = sums[metric].tolist()
+
+        columns_out = dimensions + metrics
+        rows = [dict(zip(columns_out, values)) for values in zip(*(output[c] for c in columns_out))]
+        if dimensions:
+            rows.sort(key=lambda row: tuple(row[dim] for dim in dimensions))
+        return rows
+
+    def stats(self) -> dict:
+        return {
+            "engine": QUERY_ENGINE,
+            "generation": self.generation,
+            "segments": {rid: {"rows": segment.rows, "source": segment.source, "version": segment.version}
+                         for rid, segment in self.segments.items()},
+            "rows": sum(segment.rows for segment in self.segments.values()),
+            "bytes": sum(int(array.nbytes) for segment in self.segments.values() for array in segment.columns.values()),
+            "dictionary_sizes": {dim: len(d.values) for dim, d in self.dictionaries.items()},
+            "refreshed_at": self.refreshed_at,
+            "last_refresh_seconds": self.last_refresh_seconds,
+            "queries": self.queries,
+        }
+
+
+engine = ColumnarEngine()
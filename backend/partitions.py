@@ -0,0 +1,146 @@
+"""Date-partition imports: replace only the days an upload contains.
+
+A partition import first loads the whole upload into a scratch collection,
+``ad_reports_staging__<load_id>``, so a bad file never touches ad_reports.
+Then each date in it is swapped in on its own. The staged rows are streamed
+in IMPORT_BATCH_SIZE batches, so a swap never holds more than one batch in
+memory, whatever the size of the date. Copied rows carry the import's
+``load`` marker.
+
+A date with up to PARTITION_TRANSACTION_ROWS staged rows is swapped inside
+one transaction: its old rows are deleted and the staged ones inserted, and
+readers see either the old day or the new one. Larger dates are not worth a
+transaction of that size (the oplog entry and the server's transaction
+limits grow with it), and a standalone server has none, so those are
+swapped through a record in ``partition_swaps``:
+
+1. the record hides the date's rows carrying the import's marker,
+2. the new rows are copied in batch by batch, hidden,
+3. the record is flipped to hide the date's other rows instead,
+4. the old rows are deleted and the record removed.
+
+Every reader of ad_reports applies the records (``visible``,
+``hidden_match``), so the date reads as the old rows until the flip and as
+the new ones after it, never empty or mixed. A reader trusts its last read
+of the records for up to GENERATION_POLL_SECONDS, so the swap waits that
+long after changing the record before the next step.
+"""
+from pymongo.errors import OperationFailure
+from datetime import datetime
+from typing import Dict, List
+from .models import AdReport
+from .meta import GENERATION_POLL_SECONDS
+from .writer import IMPORT_BATCH_SIZE
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STAGING_PREFIX = "ad_reports_staging__"
+SWAPS_COLLECTION = "partition_swaps"
+
+# Largest date swapped inside one transaction; bigger ones are swapped through a partition_swaps record
+PARTITION_TRANSACTION_ROWS = int(os.getenv("PARTITION_TRANSACTION_ROWS", 50000))
+
+# Server error for transactions on a standalone mongod
+ILLEGAL_OPERATION = 20
+
+_transactions = {"supported": None}
+_hidden = {"match": None, "fetched_at": 0.0}
+
+
+def staging_collection(load_id: str):
+    """Staging collection of one attempt at a job, see ``bluegreen.load_id``."""
+    return AdReport.get_pymongo_collection().database[f"{STAGING_PREFIX}{load_id}"]
+
+
+def _swaps():
+    return AdReport.get_pymongo_collection().database[SWAPS_COLLECTION]
+
+
+async def hidden_match() -> Dict:
+    """Filter leaving out the rows of dates being swapped that readers must not see yet (or anymore)."""
+    if _hidden["match"] is None or time.monotonic() - _hidden["fetched_at"] > GENERATION_POLL_SECONDS:
+        hidden = []
+        for swap in await _swaps().find().to_list(length=None):
+            load = {"$ne": swap["load"]} if swap["live"] else swap["load"]
+            hidden.append({"date": swap["date"], "load": load})
+        _hidden.update(match={"$nor": hidden} if hidden else {}, fetched_at=time.monotonic())
+    return _hidden["match"]
+
+
+async def visible(source, pipeline: List[Dict]) -> List[Dict]:
+    """``pipeline`` with the rows of dates being swapped filtered out, when ``source`` is ad_reports."""
+    if source.name != AdReport.get_pymongo_collection().name:
+        return pipeline
+    match = await hidden_match()
+    if not match:
+        return pipeline
+    # Right after the pipeline's own $match, which MongoDB merges it into
+    at = 1 if pipeline and "$match" in pipeline[0] else 0
+    return pipeline[:at] + [{"$match": match}] + pipeline[at:]
+
+
+async def _copy(staging, target, date: datetime, load_id: str, session=None) -> int:
+    copied = 0
+    cursor = staging.find({"date": date}, session=session, batch_size=IMPORT_BATCH_SIZE)
+    while docs := await cursor.to_list(length=IMPORT_BATCH_SIZE):
+        for doc in docs:
+            doc["load"] = load_id
+        await target.insert_many(docs, ordered=False, session=session)
+        copied += len(docs)
+    return copied
+
+
+async def _switch(staging, target, date: datetime, load_id: str) -> int:
+    """Swap a date without a transaction, readers see one version of it throughout."""
+    record = {"_id": f"{load_id}:{date:%Y-%m-%d}"}
+    await _swaps().replace_one(record, {**record, "date": date, "load": load_id, "live": False}, upsert=True)
+    _hidden["match"] = None
+    await asyncio.sleep(GENERATION_POLL_SECONDS)
+    copied = await _copy(staging, target, date, load_id)
+    await _swaps().update_one(record, {"$set": {"live": True}})
+    _hidden["match"] = None
+    await asyncio.sleep(GENERATION_POLL_SECONDS)
+    await target.delete_many({"date": date, "load": {"$ne": load_id}})
+    await _swaps().delete_one(record)
+    _hidden["match"] = None
+    return copied
+
+
+async def abandon(load_id: str):
+    """Settle the swaps an import left behind: finish flipped ones, drop the hidden rows of the rest."""
+    target = AdReport.get_pymongo_collection()
+    async for swap in _swaps().find({"load": load_id}):
+        if swap["live"]:
+            await target.delete_many({"date": swap["date"], "load": {"$ne": load_id}})
+        else:
+            await target.delete_many({"date": swap["date"], "load": load_id})
+        await _swaps().delete_one({"_id": swap["_id"]})
+        _hidden["match"] = None
+
+
+async def _replace(staging, target, date: datetime, load_id: str, session=None) -> int:
+    await target.delete_many({"date": date}, session=session)
+    return await _copy(staging, target, date, load_id, session)
+
+
+async def swap(staging, date: datetime, load_id: str) -> int:
+    """Replace the rows of ``date`` in ad_reports with the staged ones, returns how many."""
+    target = AdReport.get_pymongo_collection()
+    if _transactions["supported"] is not False and \
+            await staging.count_documents({"date": date}) <= PARTITION_TRANSACTION_ROWS:
+        try:
+            async with await target.database.client.start_session() as session:
+                async with session.start_transaction():
+                    swapped = await _replace(staging, target, date, load_id, session)
+            _transactions["supported"] = True
+            return swapped
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+            _transactions["supported"] = False
+            logger.warning("MongoDB has no transaction support, date partitions are swapped through partition_swaps")
+    return await _switch(staging, target, date, load_id)
@@ -0,0 +1,95 @@
+"""Aggregation pipeline compiler shared by the report endpoints.
+
+A report is always the same shape: ``$match`` on the filters, keep only the
+fields the request touches, ``$group`` by the dimensions summing the additive
+metrics, derive the ratio metrics from those sums, then flatten the group key.
+Everything after the ``$match`` depends only on the requested dimensions and
+metrics, so that part is compiled once per shape and reused.
+
+Compiled stages are shared between requests and must not be mutated; build
+new lists around them instead.
+"""
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+import os
+
+# Distinct (dimensions, metrics) shapes whose compiled stages are kept
+PIPELINE_CACHE_SIZE = int(os.getenv("PIPELINE_CACHE_SIZE", 512))
+
+
+# Ratio metrics can't be summed; they are recomputed from summed components.
+# metric -> (numerator, denominator, scale)
+RATIO_METRICS = {
+    "ad_exchange_match_rate": ("ad_exchange_responses_served", "ad_exchange_total_requests", None),
+    "ad_exchange_line_item_level_ctr": ("ad_exchange_line_item_level_clicks", "ad_exchange_line_item_level_impressions", None),
+    "average_ecpm": ("payout", "ad_exchange_line_item_level_impressions", 1000),
+}
+
+
+def _ratio(numerator: str, denominator: str, scale: float = None) -> Dict:
+    value = {"$divide": [f"${numerator}", f"${denominator}"]}
+    if scale is not None:
+        value = {"$multiply": [value, scale]}
+    return {"$cond": [{"$eq": [f"${denominator}", 0]}, 0, value]}
+
+
+def summed_fields(metrics: Sequence[str]) -> List[str]:
+    """Additive fields that have to be summed to produce ``metrics``, in a stable order."""
+    fields = {}
+    for metric in metrics:
+        for field in RATIO_METRICS[metric][:2] if metric in RATIO_METRICS else [metric]:
+            fields[field] = True
+    return list(fields)
+
+
+@lru_cache(maxsize=PIPELINE_CACHE_SIZE)
+def _compile(dimensions: tuple, metrics: tuple) -> tuple:
+    sums = summed_fields(metrics)
+    stages = [
+        # Drop every other field before grouping so documents stay small
+        {"$project": {"_id": 0, **{field: 1 for field in (*dimensions, *sums)}}},
+        {"$group": {
+            "_id": {dim: f"${dim}" for dim in dimensions},
+            **{field: {"$sum": f"${field}"} for field in sums},
+        }},
+    ]
+    derived = {metric: _ratio(*RATIO_METRICS[metric]) for metric in metrics if metric in RATIO_METRICS}
+    if derived:
+        stages.append({"$addFields": derived})
+    stages.append({"$project": {
+        "_id": 0,
+        **{dim: f"$_id.{dim}" for dim in dimensions},
+        **{metric: f"${metric}" for metric in metrics},
+    }})
+    return tuple(stages)
+
+
+def group_stages(dimensions: Sequence[str], metrics: Sequence[str]) -> List[Dict]:
+    """Stages turning matched rows into one flat row per dimension combination."""
+    return list(_compile(tuple(dimensions), tuple(metrics)))
+
+
+def sort_stage(dimensions: Sequence[str]) -> Optional[Dict]:
+    """Sort on every dimension so each row has a unique, stable position."""
+    return {"$sort": {dim: 1 for dim in dimensions}} if dimensions else None
+
+
+def build_pipeline(match_stages: List[Dict], dimensions: Sequence[str], metrics: Sequence[str],
+                   sort: bool = True) -> List[Dict]:
+    pipeline = match_stages + group_stages(dimensions, metrics)
+    if sort and dimensions:
+        pipeline.append(sort_stage(dimensions))
+    return pipeline
+
+
+def count_pipeline(match_stages: List[Dict], dimensions: Sequence[str]) -> List[Dict]:
+    """Pipeline returning ``{"total": n}``, the number of rows a report has."""
+    return match_stages + [
+        {"$group": {"_id": {dim: f"${dim}" for dim in dimensions}}},
+        {"$count": "total"},
+    ]
+
+
+def cache_stats() -> dict:
+    info = _compile.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "entries": info.currsize, "max_entries": info.maxsize}
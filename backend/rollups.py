@@ -0,0 +1,210 @@
+"""Pre-aggregated rollups of ad_reports, maintained at import time.
+
+Each rollup collection holds the additive metrics of ad_reports summed over
+report_id plus a configured subset of the dimensions. Rate metrics (match
+rate, CTR, eCPM) are derived from the sums after grouping, so a query that
+only touches dimensions in a rollup gets exactly the same answer from it as
+from the raw rows, while scanning far fewer documents.
+
+Rollups are configured with ROLLUP_DIMENSIONS, e.g.
+``date,mobile_app_name;date,inventory_format_name``.
+"""
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from .models import AdReport
+from . import partitions
+import pandas as pd
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+ADDITIVE_METRICS = [
+    "ad_exchange_total_requests", "ad_exchange_responses_served",
+    "ad_exchange_line_item_level_impressions", "ad_exchange_line_item_level_clicks", "payout"
+]
+
+DEFAULT_ROLLUPS = "date,mobile_app_name;date,inventory_format_name;date,operating_system_version_name"
+
+
+def _parse_rollups(spec: str) -> List[Tuple[str, ...]]:
+    return [tuple(d.strip() for d in group.split(",") if d.strip()) for group in spec.split(";") if group.strip()]
+
+
+def collection_name(dimensions: Iterable[str]) -> str:
+    return "ad_reports_rollup__" + "__".join(dimensions)
+
+
+ROLLUPS: Dict[str, Tuple[str, ...]] = {
+    collection_name(dims): dims for dims in _parse_rollups(os.getenv("ROLLUP_DIMENSIONS", DEFAULT_ROLLUPS))
+}
+
+STATE_COLLECTION = "ad_reports_rollup_state"
+
+# Seconds routing information is reused before it is re-read from the database
+ROUTE_CACHE_SECONDS = 5
+SIZE_CACHE_SECONDS = 60
+
+# Rollup rows inserted per batch when rebuilding from ad_reports
+ROLLUP_REBUILD_BATCH_ROWS = int(os.getenv("ROLLUP_REBUILD_BATCH_ROWS", 5000))
+
+_ready = {"names": None, "fetched_at": 0.0}
+_sizes: Dict[str, Tuple[int, float]] = {}
+
+
+def _collection(name: str):
+    return AdReport.get_pymongo_collection().database[name]
+
+
+def partial_rollups(frame: pd.DataFrame, report_id: str) -> Dict[str, List[Dict]]:
+    """Sum a block of coerced rows per rollup, ready for ``apply``."""
+    partials = {}
+    if frame.empty:
+        return partials
+    for name, dims in ROLLUPS.items():
+        grouped = frame.groupby(list(dims), sort=False)
+        rows = grouped[ADDITIVE_METRICS].sum()
+        rows["row_count"] = grouped.size()
+        rows = rows.reset_index()
+        if "date" in dims:
+            rows["date"] = pd.Series(list(rows["date"].dt.to_pydatetime()), dtype=object)
+        rows["report_id"] = report_id
+        partials[name] = rows.to_dict("records")
+    return partials
+
+
+async def apply(partials: Dict[str, List[Dict]], suffix: str = ""):
+    """Add block partials to the rollup collections (their ``suffix`` copies) with upserted $inc updates."""
+    for name, rows in partials.items():
+        if name not in ROLLUPS or not rows:
+            continue
+        keys = ("report_id",) + ROLLUPS[name]
+        ops = [
+            UpdateOne(
+                {key: row[key] for key in keys},
+                {"$inc": {field: row[field] for field in ADDITIVE_METRICS + ["row_count"]}},
+                upsert=True,
+            )
+            for row in rows
+        ]
+        await _collection(name + suffix).bulk_write(ops, ordered=False)
+
+
+async def _set_ready(names: List[str]):
+    await _collection(STATE_COLLECTION).update_one({"_id": "state"}, {"$set": {"ready": names}}, upsert=True)
+    _ready.update(names=list(names), fetched_at=time.monotonic())
+
+
+async def clear(ready: bool = False):
+    """Empty every rollup. With ready=False they are ignored until mark_ready()."""
+    if not ready:
+        await _set_ready([])
+    for name in ROLLUPS:
+        await _collection(name).delete_many({})
+    await _collection(STATE_COLLECTION).update_one({"_id": "state"}, {"$set": {"stale_dates": []}}, upsert=True)
+    if ready:
+        await _set_ready(list(ROLLUPS))
+
+
+async def mark_ready():
+    """Declare the rollups in sync with ad_reports, called when an import completes cleanly."""
+    await _set_ready(list(ROLLUPS))
+
+
+async def invalidate(dates: Iterable[datetime]):
+    """Stop routing to the rollups until ``rebuild`` has recomputed ``dates``.
+
+    Used by imports that change rows in place, which $inc partials can't
+    express. The dates are kept in the state document, so a failed import
+    leaves them for the next rebuild.
+    """
+    await _collection(STATE_COLLECTION).update_one(
+        {"_id": "state"}, {"$set": {"ready": []}, "$addToSet": {"stale_dates": {"$each": list(dates)}}}, upsert=True
+    )
+    _ready.update(names=[], fetched_at=time.monotonic())
+
+
+async def _recompute(name: str, dims: Tuple[str, ...], match: Dict):
+    keys = ("report_id",) + dims
+    await _collection(name).delete_many(match)
+    cursor = AdReport.get_pymongo_collection().aggregate([
+        {"$match": {**match, **await partitions.hidden_match()}},
+        {"$group": {
+            "_id": {key: f"${key}" for key in keys},
+            **{field: {"$sum": f"${field}"} for field in ADDITIVE_METRICS},
+            "row_count": {"$sum": 1},
+        }},
+        {"$project": {"_id": 0, **{key: f"$_id.{key}" for key in keys}, **{field: 1 for field in ADDITIVE_METRICS + ["row_count"]}}},
+    ], allowDiskUse=True, batch_size=ROLLUP_REBUILD_BATCH_ROWS)
+    while rows := await cursor.to_list(length=ROLLUP_REBUILD_BATCH_ROWS):
+        await _collection(name).insert_many(rows, ordered=False)
+
+
+async def rebuild():
+    """Recompute the stale dates of every rollup from ad_reports, then mark them ready.
+
+    Rollups without a date dimension can't be patched per date and are
+    recomputed whole.
+    """
+    state = await _collection(STATE_COLLECTION).find_one({"_id": "state"}) or {}
+    dates = state.get("stale_dates", [])
+    if dates:
+        for name, dims in ROLLUPS.items():
+            await _recompute(name, dims, {"date": {"$in": dates}} if "date" in dims else {})
+        state = await _collection(STATE_COLLECTION).find_one_and_update(
+            {"_id": "state"}, {"$pull": {"stale_dates": {"$in": dates}}}, return_document=ReturnDocument.AFTER
+        )
+        logger.info(f"Rebuilt rollups for {len(dates)} dates")
+    # Another import may have invalidated more dates meanwhile, its own rebuild marks them ready
+    if not state.get("stale_dates"):
+        await mark_ready()
+
+
+async def publish(suffix: str):
+    """Rename the rollups built under ``name + suffix`` over the live ones.
+
+    Call ``invalidate`` first; the rollups serve queries again after ``mark_ready``.
+    """
+    for name in ROLLUPS:
+        await _collection(name + suffix).rename(name, dropTarget=True)
+    await _collection(STATE_COLLECTION).update_one({"_id": "state"}, {"$set": {"stale_dates": []}}, upsert=True)
+
+
+async def drop(suffix: str):
+    for name in ROLLUPS:
+        await _collection(name + suffix).drop()
+
+
+async def ensure_indexes(suffix: str = ""):
+    for name, dims in ROLLUPS.items():
+        await _collection(name + suffix).create_indexes([
+            IndexModel([("report_id", ASCENDING)] + [(dim, ASCENDING) for dim in dims], unique=True)
+        ])
+
+
+async def _ready_names() -> List[str]:
+    if _ready["names"] is None or time.monotonic() - _ready["fetched_at"] > ROUTE_CACHE_SECONDS:
+        state = await _collection(STATE_COLLECTION).find_one({"_id": "state"})
+        _ready.update(names=(state or {}).get("ready", []), fetched_at=time.monotonic())
+    return _ready["names"]
+
+
+async def _size(name: str) -> int:
+    cached = _sizes.get(name)
+    if cached and time.monotonic() - cached[1] < SIZE_CACHE_SECONDS:
+        return cached[0]
+    size = await _collection(name).estimated_document_count()
+    _sizes[name] = (size, time.monotonic())
+    return size
+
+
+async def route(fields: Iterable[str]) -> Optional[object]:
+    """Return the smallest ready rollup collection covering ``fields``, or None for raw data."""
+    fields = set(fields)
+    candidates = [name for name in await _ready_names() if name in ROLLUPS and fields <= set(ROLLUPS[name])]
+    if not candidates:
+        return None
+    sizes = {name: await _size(name) for name in candidates}
+    return _collection(min(candidates, key=lambda name: (sizes[name], len(ROLLUPS[name]))))
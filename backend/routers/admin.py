@@ -0,0 +1,38 @@
+from fastapi import APIRouter
+from pydantic import BaseModel
+from typing import List, Optional
+from .. import index_advisor, olap
+
+router = APIRouter()
+
+class ApplyIndexesRequest(BaseModel):
+    # Names from /indexes/recommendations to create; all of them when omitted
+    names: Optional[List[str]] = None
+    min_queries: int = index_advisor.INDEX_ADVISOR_MIN_QUERIES
+
+@router.get("/indexes/shapes")
+async def get_query_shapes():
+    """Filter shapes seen by /query and /export, most frequent first."""
+    return await index_advisor.shapes()
+
+@router.get("/indexes/recommendations")
+async def get_index_recommendations(min_queries: int = index_advisor.INDEX_ADVISOR_MIN_QUERIES):
+    """ESR compound indexes for frequent shapes, with the plan each one gets today."""
+    return await index_advisor.recommend(min_queries)
+
+@router.post("/indexes/apply")
+async def apply_index_recommendations(request: ApplyIndexesRequest):
+    recommendations = await index_advisor.recommend(request.min_queries)
+    if request.names is not None:
+        recommendations = [r for r in recommendations if r["name"] in request.names]
+    return await index_advisor.apply(recommendations)
+
+@router.get("/indexes/unused")
+async def get_unused_indexes():
+    """Indexes on ad_reports and the rollups that $indexStats reports no use of."""
+    return await index_advisor.unused()
+
+@router.get("/engine")
+async def get_engine_stats():
+    """Which query engine serves reports, and what the columnar engine has loaded."""
+    return olap.engine.stats()
@@ -1,10 +1,19 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request
 from ..models import AdReport, SavedReport
+from .. import catalog, dictionaries, export_jobs, index_advisor, meta, metrics, olap, partitions, rollups, summaries
+from ..export import COLUMNAR_FORMATS, EXPORT_BATCH_ROWS, EXPORT_FORMATS, WRITERS, ListCursor, accepts_gzip, batches, gzip_stream, pa
+from ..pipeline import build_pipeline, count_pipeline, group_stages, sort_stage, cache_stats as pipeline_cache_stats
+from ..cache import QUERY_CACHE_MAX_ROWS, fingerprint, query_cache, total_cache
+from ..singleflight import query_flights, summary_flights
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional, Tuple
 from datetime import date, datetime
-import pandas as pd
-from io import StringIO
+from bson import json_util
+import asyncio
+import base64
+import bisect
+import os
+import time
 from starlette.responses import StreamingResponse
 
 router = APIRouter()
@@ -21,6 +30,17 @@ METRICS = [
     "ad_exchange_line_item_level_ctr", "average_ecpm", "payout"
 ]
 
+# Metrics shown on the dashboard summary
+SUMMARY_METRICS = [
+    "ad_exchange_total_requests", "ad_exchange_line_item_level_impressions",
+    "ad_exchange_line_item_level_clicks", "payout", "average_ecpm"
+]
+
+# Most report requests one /query/batch call may carry
+QUERY_BATCH_MAX_QUERIES = int(os.getenv("QUERY_BATCH_MAX_QUERIES", 20))
+# Most rows (page * limit, summed over branches) one /query/batch $facet may return; its result is one 16MB document
+QUERY_BATCH_FACET_ROWS = int(os.getenv("QUERY_BATCH_FACET_ROWS", 5000))
+
 # Pydantic models for request validation
 class DateRange(BaseModel):
     start: date
@@ -33,6 +53,11 @@ class ReportQueryRequest(BaseModel):
     date_range: Optional[DateRange] = None
     page: int = 1
     limit: int = 50
+    # Opaque next_cursor from a previous response; when set, page is ignored
+    cursor: Optional[str] = None
+
+class BatchQueryRequest(BaseModel):
+    queries: List[ReportQueryRequest]
 
 def validate_and_build_pipeline(request: ReportQueryRequest) -> List[Dict]:
     """A dependency to validate input and build the core aggregation pipeline."""
@@ -64,10 +89,77 @@ def validate_and_build_pipeline(request: ReportQueryRequest) -> List[Dict]:
 
     return [{"$match": match_stage}]
 
+def encode_cursor(row: Dict, dimensions: List[str]) -> str:
+    """Opaque token holding the sort key of the last row of a page."""
+    return base64.urlsafe_b64encode(json_util.dumps([row.get(dim) for dim in dimensions]).encode()).decode()
+
+def decode_cursor(cursor: str, dimensions: List[str]) -> List:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if not isinstance(values, list) or len(values) != len(dimensions):
+        raise HTTPException(status_code=400, detail="Cursor does not match the requested dimensions.")
+    return values
+
+def keyset_stage(dimensions: List[str], values: List) -> Dict:
+    """$match selecting the rows that sort after ``values`` on ``dimensions``."""
+    branches = []
+    for i, dim in enumerate(dimensions):
+        branch = {prev: values[j] for j, prev in enumerate(dimensions[:i])}
+        # Nulls sort first, so anything non-null comes after a null key
+        branch[dim] = {"$ne": None} if values[i] is None else {"$gt": values[i]}
+        branches.append(branch)
+    return {"$match": {"$or": branches}}
+
+def sort_key(dimensions: List[str]):
+    """Python equivalent of the pipeline's sort on ``dimensions``."""
+    return lambda row: tuple((row.get(dim) is not None, row.get(dim)) for dim in dimensions)
+
+async def require_data():
+    """Turn an empty result into the "no data" error when nothing was imported yet."""
+    if not await meta.has_data():
+        raise HTTPException(status_code=400, detail="No data available. Please upload data first.")
+
+def query_fields(request: ReportQueryRequest) -> set:
+    """Fields a request groups or filters on, used to pick a rollup."""
+    fields = set(request.dimensions)
+    if request.filters:
+        fields |= {key for key, values in request.filters.items() if key in DIMENSIONS and values}
+    if request.date_range:
+        fields.add("date")
+    return fields
+
+def stores_codes() -> bool:
+    """Whether aggregation results carry dimension codes that need decoding (compact storage)."""
+    return dictionaries.compact() and not olap.enabled()
+
+async def source_collection(fields: set):
+    """Return the smallest rollup covering ``fields``, falling back to the raw rows."""
+    collection = await rollups.route(fields)
+    if collection is None:
+        collection = AdReport.get_pymongo_collection()
+    return collection
+
 @router.get("/dimensions")
 async def get_dimensions():
     return DIMENSIONS
 
+@router.get("/dimensions/{dimension}/values")
+async def get_dimension_values(dimension: str, prefix: str = "", limit: int = Query(20, ge=1, le=1000),
+                               report_id: Optional[str] = None):
+    """Values of a dimension for filter pickers, most frequent first, optionally starting with ``prefix``."""
+    if dimension not in DIMENSIONS:
+        raise HTTPException(status_code=400, detail="Invalid dimension requested.")
+    if dimension not in catalog.CATALOG_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"{dimension} has no value catalog, filter it with date_range.")
+    values, matches = await catalog.search(dimension, prefix, limit, report_id)
+    return {
+        "dimension": dimension,
+        "values": [{"value": value, "count": count} for value, count in values],
+        "matches": matches,
+    }
+
 @router.get("/metrics")
 async def get_metrics():
     return METRICS
@@ -75,9 +167,7 @@ async def get_metrics():
 @router.get("/has_data")
 async def has_data():
     """Check if there's any data in the collection."""
-    collection = AdReport.get_pymongo_collection()
-    data_count = await collection.count_documents({})
-    return {"has_data": data_count > 0}
+    return {"has_data": await meta.has_data()}
 
 import logging
 
@@ -85,101 +175,233 @@ logger = logging.getLogger("uvicorn.error")
 
 @router.post("/query")
 async def query_reports(request: ReportQueryRequest, base_pipeline: List[Dict] = Depends(validate_and_build_pipeline)):
-
-    # Check if there's any data in the collection
-    collection = AdReport.get_pymongo_collection()
-    data_count = await collection.count_documents({})
-    if data_count == 0:
-        raise HTTPException(status_code=400, detail="No data available. Please upload data first.")
-
-    # Separate countable metrics from calculated rates
-    sum_metrics = [m for m in request.metrics if m not in ["ad_exchange_match_rate", "ad_exchange_line_item_level_ctr", "average_ecpm"]]
-
-    # 2. Group stage for aggregation
-    group_stage = {
-        "_id": {dim: f"${dim}" for dim in request.dimensions},
-        # Sum only requested metrics
-        **{metric: {"$sum": f"${metric}"} for metric in sum_metrics},
-    }
-
-    # Add base components for calculated fields only if requested
-    if "ad_exchange_match_rate" in request.metrics:
-        group_stage["ad_exchange_total_requests"] = {"$sum": "$ad_exchange_total_requests"}
-        group_stage["ad_exchange_responses_served"] = {"$sum": "$ad_exchange_responses_served"}
-    if "ad_exchange_line_item_level_ctr" in request.metrics or "average_ecpm" in request.metrics:
-        group_stage["ad_exchange_line_item_level_impressions"] = {"$sum": "$ad_exchange_line_item_level_impressions"}
-        group_stage["ad_exchange_line_item_level_clicks"] = {"$sum": "$ad_exchange_line_item_level_clicks"}
-        group_stage["payout"] = {"$sum": "$payout"}
-
-    # 3. AddFields stage to calculate the rates correctly after grouping
-    add_fields_stage = {}
-    if "ad_exchange_match_rate" in request.metrics:
-        add_fields_stage["ad_exchange_match_rate"] = {
-            "$cond": [{"$eq": ["$ad_exchange_total_requests", 0]}, 0, {"$divide": ["$ad_exchange_responses_served", "$ad_exchange_total_requests"]}]
-        }
-    if "ad_exchange_line_item_level_ctr" in request.metrics:
-        add_fields_stage["ad_exchange_line_item_level_ctr"] = {
-            "$cond": [{"$eq": ["$ad_exchange_line_item_level_impressions", 0]}, 0, {"$divide": ["$ad_exchange_line_item_level_clicks", "$ad_exchange_line_item_level_impressions"]}]
-        }
-    if "average_ecpm" in request.metrics:
-        add_fields_stage["average_ecpm"] = {
-            "$cond": [{"$eq": ["$ad_exchange_line_item_level_impressions", 0]}, 0, {"$multiply": [{"$divide": ["$payout", "$ad_exchange_line_item_level_impressions"]}, 1000]}]
-        }
-
-    # 4. Project stage to flatten the output and select final fields
-    project_stage = {
-        "_id": 0,
-        **{dim: f"$_id.{dim}" for dim in request.dimensions},
-        **{metric: f"${metric}" for metric in request.metrics}
-    }
-
-    # 5. Facet stage for pagination and total count in one query
-    facet_stage = {
-        "$facet": {
-            "metadata": [{"$count": "total"}],
-            "data": [
-                {"$skip": (request.page - 1) * request.limit},
-                {"$limit": request.limit}
-            ]
-        }
-    }
-
-    pipeline = base_pipeline + [
-        {"$group": group_stage},
-    ]
-
-    if add_fields_stage:
-        pipeline.append({"$addFields": add_fields_stage})
-
-    pipeline.append({"$project": project_stage})
-
-    # Add sort stage only if dimensions are provided
-    if request.dimensions:
-        pipeline.append({"$sort": {request.dimensions[0]: 1}})
-
-    pipeline.append(facet_stage)
-
-    logger.info(f"Aggregation pipeline: {pipeline}")
-
-    cursor = collection.aggregate(pipeline)
-    results = await cursor.to_list(length=None)
-
-    logger.info(f"Aggregation results count: {len(results)}")
-
-    if not results or not results[0]["metadata"]:
-        return {"data": [], "total": 0, "page": request.page, "limit": request.limit}
-
+    # Identical requests arriving together share one aggregation
+    key = (fingerprint(request), request.page, request.limit, request.cursor, await meta.get_generation())
+    return await query_flights.do(key, lambda: run_query(request, base_pipeline))
+
+async def run_query(request: ReportQueryRequest, base_pipeline: List[Dict]) -> Dict:
+    if stores_codes():
+        base_pipeline = await dictionaries.translate_match(base_pipeline)
+    pipeline = base_pipeline + group_stages(request.dimensions, request.metrics)
+
+    # Sort on every dimension so each row has a unique key to page from
+    sort = sort_stage(request.dimensions)
+    cursor_values = decode_cursor(request.cursor, request.dimensions) if request.cursor else None
+
+    # One cached grouped result serves every page of the same query
+    generation = await meta.get_generation()
+    query_cache.sync_generation(generation)
+    total_cache.sync_generation(generation)
+    cache_key = fingerprint(request)
+    start = (request.page - 1) * request.limit
+    cached = query_cache.get(cache_key)
+    if cached is None and olap.enabled():
+        # The columnar engine computes the full result in process, cache it like one from MongoDB
+        engine_generation = olap.engine.generation
+        rows = await olap.engine.query(request)
+        cached = {"rows": rows, "total": len(rows)}
+        # Only once the engine has loaded this generation, and didn't move on while answering
+        if (engine_generation == olap.engine.generation == generation == query_cache.generation
+                and len(rows) <= QUERY_CACHE_MAX_ROWS):
+            query_cache.set(cache_key, cached)
+    if cached is not None:
+        if not cached["total"]:
+            await require_data()
+        rows = cached["rows"]
+        if cursor_values is not None:
+            key = sort_key(request.dimensions)
+            start = bisect.bisect_right(rows, key(dict(zip(request.dimensions, cursor_values))), key=key)
+        return await page_response(request, rows[start:start + request.limit], cached["total"], start)
+
+    source = await source_collection(query_fields(request))
+    pipeline = await partitions.visible(source, pipeline)
+    total = total_cache.get(cache_key)
+    if sort:
+        pipeline.append(sort)
+    started = time.perf_counter()
+    rows = None
+
+    if total is None:
+        # One aggregation: a result up to the cache cap comes back whole and serves every page
+        capped = pipeline + [{"$limit": QUERY_CACHE_MAX_ROWS + 1}]
+        rows = await source.aggregate(capped, allowDiskUse=True).to_list(length=None)
+        metrics.observe_aggregation("query", source, capped, time.perf_counter() - started)
+        if len(rows) <= QUERY_CACHE_MAX_ROWS:
+            total = len(rows)
+            # Skip caching if an import landed while the aggregation ran
+            if query_cache.generation == generation:
+                query_cache.set(cache_key, {"rows": rows, "total": total})
+            index_advisor.record(source.name, base_pipeline[0]["$match"], (time.perf_counter() - started) * 1000)
+            if not total:
+                await require_data()
+                return {"data": [], "total": 0, "page": request.page, "limit": request.limit, "next_cursor": None}
+            if cursor_values is not None:
+                key = sort_key(request.dimensions)
+                start = bisect.bisect_right(rows, key(dict(zip(request.dimensions, cursor_values))), key=key)
+            return await page_response(request, rows[start:start + request.limit], total, start)
+        # Too large to cache, only then is it counted
+        count = await partitions.visible(source, count_pipeline(base_pipeline, request.dimensions))
+        count_started = time.perf_counter()
+        counted = await source.aggregate(count).to_list(length=None)
+        metrics.observe_aggregation("query", source, count, time.perf_counter() - count_started)
+        total = counted[0]["total"] if counted else 0
+        if total_cache.generation == generation:
+            total_cache.set(cache_key, total)
+
+    if cursor_values is not None:
+        # Keyset pagination: deep pages cost the same as the first one
+        if request.dimensions:
+            pipeline[-1:-1] = [keyset_stage(request.dimensions, cursor_values)]
+        pipeline.append({"$limit": request.limit})
+        start = None
+    elif rows is not None and start + request.limit <= len(rows):
+        # The page is within the rows fetched to find out the result is too large
+        pipeline = None
+    else:
+        pipeline += [{"$skip": start}, {"$limit": request.limit}]
+    if pipeline is None:
+        data = rows[start:start + request.limit]
+    else:
+        fetch_started = time.perf_counter()
+        data = await source.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+        metrics.observe_aggregation("query", source, pipeline, time.perf_counter() - fetch_started)
+    index_advisor.record(source.name, base_pipeline[0]["$match"], (time.perf_counter() - started) * 1000)
+    return await page_response(request, data, total, start)
+
+async def page_response(request: ReportQueryRequest, data: List[Dict], total: int, start: Optional[int]) -> Dict:
+    """Build a /query response with the cursor for the page after ``data``."""
+    has_more = len(data) == request.limit and (start is None or start + len(data) < total)
+    next_cursor = encode_cursor(data[-1], request.dimensions) if has_more and request.dimensions else None
+    if stores_codes():
+        # Rows were grouped and sorted on codes, only the page itself gets names
+        data = await dictionaries.decode_rows(data, request.dimensions)
     return {
-        "data": results[0]["data"],
-        "total": results[0]["metadata"][0]["total"],
+        "data": data,
+        "total": total,
         "page": request.page,
-        "limit": request.limit
+        "limit": request.limit,
+        "next_cursor": next_cursor
     }
 
+@router.post("/query/batch")
+async def query_reports_batch(batch: BatchQueryRequest):
+    """Answer several /query requests, with one aggregation per distinct filter set.
+
+    Requests with the same $match on the same source collection become the
+    branches of a single $facet, so the matched documents are read once for
+    all of them. Each branch returns the rows up to the end of its page plus
+    the total. The whole $facet result is a single document, so a group is
+    split over several $facet aggregations of at most QUERY_BATCH_FACET_ROWS
+    rows, and a request paging deeper than that goes through /query on its
+    own. Aggregations run concurrently. Cached results are served as /query
+    would serve them. Cursor pages and the columnar engine go through /query
+    itself.
+    """
+    if len(batch.queries) > QUERY_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {QUERY_BATCH_MAX_QUERIES} queries per batch.")
+
+    generation = await meta.get_generation()
+    query_cache.sync_generation(generation)
+    total_cache.sync_generation(generation)
+    results: List[Optional[Dict]] = [None] * len(batch.queries)
+    singles = []
+    # (collection, $match) -> (source, base pipeline, indexes of the requests sharing it)
+    groups: Dict[tuple, tuple] = {}
+    known_totals: Dict[int, int] = {}
+
+    for i, request in enumerate(batch.queries):
+        try:
+            base_pipeline = validate_and_build_pipeline(request)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"Query {i}: {e.detail}")
+        if olap.enabled() or request.cursor or request.page * request.limit > QUERY_BATCH_FACET_ROWS:
+            singles.append((i, request, base_pipeline))
+            continue
+        cache_key = fingerprint(request)
+        start = (request.page - 1) * request.limit
+        cached = query_cache.get(cache_key)
+        if cached is not None:
+            if not cached["total"]:
+                await require_data()
+            results[i] = await page_response(request, cached["rows"][start:start + request.limit], cached["total"], start)
+            continue
+        total = total_cache.get(cache_key)
+        if total is not None:
+            known_totals[i] = total
+        if stores_codes():
+            base_pipeline = await dictionaries.translate_match(base_pipeline)
+        source = await source_collection(query_fields(request))
+        group_key = (source.name, json_util.dumps(base_pipeline[0]["$match"], sort_keys=True))
+        groups.setdefault(group_key, (source, base_pipeline, []))[2].append(i)
+
+    async def run_single(i: int, request: ReportQueryRequest, base_pipeline: List[Dict]):
+        results[i] = await query_reports(request, base_pipeline)
+
+    async def run_group(source, base_pipeline: List[Dict], indexes: List[int]):
+        facet = {}
+        for i in indexes:
+            request = batch.queries[i]
+            sort = sort_stage(request.dimensions)
+            facet[f"rows_{i}"] = group_stages(request.dimensions, request.metrics) + ([sort] if sort else []) + [
+                {"$limit": request.page * request.limit}]
+            if i not in known_totals:
+                facet[f"total_{i}"] = count_pipeline([], request.dimensions)
+        pipeline = await partitions.visible(source, base_pipeline + [{"$facet": facet}])
+        started = time.perf_counter()
+        branches = (await source.aggregate(pipeline).to_list(length=None))[0]
+        elapsed = time.perf_counter() - started
+        metrics.observe_aggregation("query_batch", source, pipeline, elapsed)
+        index_advisor.record(source.name, base_pipeline[0]["$match"], elapsed * 1000)
+
+        for i in indexes:
+            request = batch.queries[i]
+            rows = branches[f"rows_{i}"]
+            if i in known_totals:
+                total = known_totals[i]
+            else:
+                counted = branches[f"total_{i}"]
+                total = counted[0]["total"] if counted else 0
+            # Skip caching if an import landed while the aggregation ran
+            if query_cache.generation == generation:
+                if total <= QUERY_CACHE_MAX_ROWS and len(rows) >= total:
+                    query_cache.set(fingerprint(request), {"rows": rows, "total": total})
+                elif total > QUERY_CACHE_MAX_ROWS:
+                    total_cache.set(fingerprint(request), total)
+            if not total:
+                await require_data()
+            start = (request.page - 1) * request.limit
+            results[i] = await page_response(request, rows[start:], total, start)
+
+    def facets(indexes: List[int]):
+        """Split a group's requests into runs returning at most QUERY_BATCH_FACET_ROWS rows each."""
+        chunk, rows = [], 0
+        for i in indexes:
+            wanted = batch.queries[i].page * batch.queries[i].limit
+            if chunk and rows + wanted > QUERY_BATCH_FACET_ROWS:
+                yield chunk
+                chunk, rows = [], 0
+            chunk.append(i)
+            rows += wanted
+        if chunk:
+            yield chunk
+
+    await asyncio.gather(
+        *[run_group(source, base_pipeline, chunk)
+          for source, base_pipeline, indexes in groups.values() for chunk in facets(indexes)],
+        *[run_single(*single) for single in singles],
+    )
+    return {"results": results}
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """Hit/miss statistics of this process's query result, total and compiled pipeline caches, and request coalescing."""
+    return {**query_cache.stats(), "totals": total_cache.stats(), "pipelines": pipeline_cache_stats(),
+            "single_flight": {"query": query_flights.stats(), "summary": summary_flights.stats()}}
+
 @router.get("/latest_report_id")
 async def get_latest_report_id():
     collection = AdReport.get_pymongo_collection()
-    result = await collection.find_one(sort=[("_id", -1)])
+    result = await collection.find_one(await partitions.hidden_match(), sort=[("_id", -1)])
     if result:
         return {"report_id": result["report_id"]}
     return {"report_id": None}
@@ -187,62 +409,39 @@ async def get_latest_report_id():
 @router.get("/report_ids")
 async def get_report_ids():
     collection = AdReport.get_pymongo_collection()
-    cursor = collection.distinct("report_id")
+    cursor = collection.distinct("report_id", await partitions.hidden_match())
     report_ids = await cursor.to_list(length=None)
     return {"report_ids": report_ids}
 
 @router.get("/summary")
 async def get_dashboard_summary(report_id: str = None):
     """Get summary metrics for dashboard overview."""
+    generation = await meta.get_generation()
+    return await summary_flights.do((report_id, generation), lambda: dashboard_summary(report_id, generation))
+
+async def dashboard_summary(report_id: Optional[str], generation: int) -> Dict:
+    # Totals stored by the last import, valid until the data changes again
+    stored = await summaries.get(report_id, generation)
+    if stored is not None:
+        metrics.SUMMARY_REQUESTS.inc(source="materialized")
+        return summaries.metrics_of(stored, SUMMARY_METRICS)
+    metrics.SUMMARY_REQUESTS.inc(source="live")
+
     match_stage = {}
     if report_id:
         match_stage["report_id"] = report_id
 
-    pipeline = [
-        {"$match": match_stage} if match_stage else {},
-        {
-            "$group": {
-                "_id": None,
-                "ad_exchange_total_requests": {"$sum": "$ad_exchange_total_requests"},
-                "ad_exchange_line_item_level_impressions": {"$sum": "$ad_exchange_line_item_level_impressions"},
-                "ad_exchange_line_item_level_clicks": {"$sum": "$ad_exchange_line_item_level_clicks"},
-                "payout": {"$sum": "$payout"},
-                "total_impressions_for_ecpm": {"$sum": "$ad_exchange_line_item_level_impressions"},
-                "total_payout_for_ecpm": {"$sum": "$payout"}
-            }
-        },
-        {
-            "$addFields": {
-                "average_ecpm": {
-                    "$cond": [
-                        {"$eq": ["$total_impressions_for_ecpm", 0]},
-                        0,
-                        {"$multiply": [{"$divide": ["$total_payout_for_ecpm", "$total_impressions_for_ecpm"]}, 1000]}
-                    ]
-                }
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "ad_exchange_total_requests": 1,
-                "ad_exchange_line_item_level_impressions": 1,
-                "ad_exchange_line_item_level_clicks": 1,
-                "payout": 1,
-                "average_ecpm": 1
-            }
-        }
-    ]
+    match_stages = [{"$match": match_stage}] if match_stage else []
+    pipeline = build_pipeline(match_stages, [], SUMMARY_METRICS)
 
-    if not match_stage:
-        pipeline = pipeline[1:]  # Remove empty match
-
-    collection = AdReport.get_pymongo_collection()
+    # Every rollup keeps report_id, so any of them can answer the summary
+    collection = await source_collection(set())
+    pipeline = await partitions.visible(collection, pipeline)
+    started = time.perf_counter()
     cursor = collection.aggregate(pipeline)
     results = await cursor.to_list(length=None)
-
-    logger.info(f"Summary pipeline: {pipeline}")
-    logger.info(f"Summary results: {results}")
+    metrics.observe_aggregation("summary", collection, pipeline, time.perf_counter() - started)
+    metrics.sampled_debug(logger, "Summary results: %s", results)
 
     if not results:
         return {
@@ -255,77 +454,115 @@ async def get_dashboard_summary(report_id: str = None):
 
     return results[0]
 
-@router.post("/export")
-async def export_reports(request: ReportQueryRequest, base_pipeline: List[Dict] = Depends(validate_and_build_pipeline)):
-
-    # Check if there's any data in the collection
-    collection = AdReport.get_pymongo_collection()
-    data_count = await collection.count_documents({})
-    if data_count == 0:
-        raise HTTPException(status_code=400, detail="No data available. Please upload data first.")
-
-    sum_metrics = [m for m in request.metrics if m not in ["ad_exchange_match_rate", "ad_exchange_line_item_level_ctr", "average_ecpm"]]
-
-    group_stage = {
-        "_id": {dim: f"${dim}" for dim in request.dimensions},
-        **{metric: {"$sum": f"${metric}"} for metric in sum_metrics},
-    }
-
-    if "ad_exchange_match_rate" in request.metrics:
-        group_stage["ad_exchange_total_requests"] = {"$sum": "$ad_exchange_total_requests"}
-        group_stage["ad_exchange_responses_served"] = {"$sum": "$ad_exchange_responses_served"}
-    if "ad_exchange_line_item_level_ctr" in request.metrics or "average_ecpm" in request.metrics:
-        group_stage["ad_exchange_line_item_level_impressions"] = {"$sum": "$ad_exchange_line_item_level_impressions"}
-        group_stage["ad_exchange_line_item_level_clicks"] = {"$sum": "$ad_exchange_line_item_level_clicks"}
-        group_stage["payout"] = {"$sum": "$payout"}
-
-    add_fields_stage = {}
-    if "ad_exchange_match_rate" in request.metrics:
-        add_fields_stage["ad_exchange_match_rate"] = {
-            "$cond": [{"$eq": ["$ad_exchange_total_requests", 0]}, 0, {"$divide": ["$ad_exchange_responses_served", "$ad_exchange_total_requests"]}]
-        }
-    if "ad_exchange_line_item_level_ctr" in request.metrics:
-        add_fields_stage["ad_exchange_line_item_level_ctr"] = {
-            "$cond": [{"$eq": ["$ad_exchange_line_item_level_impressions", 0]}, 0, {"$divide": ["$ad_exchange_line_item_level_clicks", "$ad_exchange_line_item_level_impressions"]}]
-        }
-    if "average_ecpm" in request.metrics:
-        add_fields_stage["average_ecpm"] = {
-            "$cond": [{"$eq": ["$ad_exchange_line_item_level_impressions", 0]}, 0, {"$multiply": [{"$divide": ["$payout", "$ad_exchange_line_item_level_impressions"]}, 1000]}]
-        }
-
-    project_stage = {
-        "_id": 0,
-        **{dim: f"$_id.{dim}" for dim in request.dimensions},
-        **{metric: f"${metric}" for metric in request.metrics}
-    }
-
-    pipeline = base_pipeline + [
-        {"$group": group_stage},
-    ]
-
-    if add_fields_stage:
-        pipeline.append({"$addFields": add_fields_stage})
-
-    pipeline.append({"$project": project_stage})
-
-    if request.dimensions:
-        pipeline.append({"$sort": {request.dimensions[0]: 1}})
-
-    cursor = collection.aggregate(pipeline)
-    results = await cursor.to_list(length=None)
-
-    if not results:
-        # Return empty CSV with headers
-        df = pd.DataFrame(columns=request.dimensions + request.metrics)
+def validate_export_format(format: str = Query("csv")) -> str:
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid export format, expected one of: {', '.join(EXPORT_FORMATS)}.")
+    if format in COLUMNAR_FORMATS and pa is None:
+        raise HTTPException(status_code=400, detail=f"The {format} export format requires pyarrow to be installed.")
+    return format
+
+async def open_export(request: ReportQueryRequest, base_pipeline: List[Dict]) -> Tuple[List[Dict], AsyncIterator[List[Dict]]]:
+    """Start an export's aggregation, returns its first batch and every batch with names decoded."""
+    if olap.enabled():
+        cursor = ListCursor(await olap.engine.query(request))
+        first = await cursor.to_list(length=EXPORT_BATCH_ROWS)
     else:
-        df = pd.DataFrame(results)
+        if stores_codes():
+            base_pipeline = await dictionaries.translate_match(base_pipeline)
+        pipeline = build_pipeline(base_pipeline, request.dimensions, request.metrics)
+        source = await source_collection(query_fields(request))
+        pipeline = await partitions.visible(source, pipeline)
+        started = time.perf_counter()
+        cursor = source.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_ROWS)
+        # Fetch the first batch up front so an empty database still gets a proper error
+        first = await cursor.to_list(length=EXPORT_BATCH_ROWS)
+        elapsed = time.perf_counter() - started
+        metrics.observe_aggregation("export", source, pipeline, elapsed)
+        index_advisor.record(source.name, base_pipeline[0]["$match"], elapsed * 1000)
+    rows = batches(first, cursor)
+    if stores_codes():
+        rows = dictionaries.decode_batches(rows, request.dimensions)
+    return first, rows
 
-    stream = StringIO()
-    df.to_csv(stream, index=False)
+@router.post("/export")
+async def export_reports(request: ReportQueryRequest, http_request: Request, format: str = Depends(validate_export_format),
+                         base_pipeline: List[Dict] = Depends(validate_and_build_pipeline)):
+    first, rows = await open_export(request, base_pipeline)
+    if not first:
+        await require_data()
+
+    media_type, extension, compressible = EXPORT_FORMATS[format]
+    body = WRITERS[format](rows, request.dimensions + request.metrics)
+    headers = {"Content-Disposition": f"attachment; filename=report.{extension}", "Vary": "Accept-Encoding"}
+    if compressible and accepts_gzip(http_request.headers.get("accept-encoding")):
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+def export_job_response(job: Dict, http_request: Request) -> Dict:
+    completed = job["status"] == "completed"
+    return {
+        "export_id": job["export_id"],
+        "status": job["status"],
+        "format": job["format"],
+        "rows": job.get("rows", 0),
+        "bytes": job.get("bytes", 0),
+        "created_at": job["created_at"],
+        "completed_at": job.get("completed_at"),
+        "error": job.get("error"),
+        "download_url": str(http_request.url_for("download_export", export_id=job["export_id"])) if completed else None,
+    }
 
-    response = StreamingResponse(iter([stream.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=report.csv"
-    return response
+@router.post("/export/jobs")
+async def create_export_job(request: ReportQueryRequest, http_request: Request, format: str = Depends(validate_export_format),
+                            base_pipeline: List[Dict] = Depends(validate_and_build_pipeline)):
+    """Run an export in the background, or return the one already made of this query on the current data."""
+    await require_data()
+
+    async def produce():
+        _, rows = await open_export(request, base_pipeline)
+        return rows
+
+    job, started = await export_jobs.submit(fingerprint(request), format, produce)
+    return {**export_job_response(job, http_request), "reused": not started}
+
+@router.get("/export/jobs/{export_id}")
+async def get_export_job(export_id: str, http_request: Request):
+    job = await export_jobs.get_job(export_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export not found")
+    return export_job_response(job, http_request)
+
+@router.get("/export/jobs/{export_id}/download", name="download_export")
+async def download_export(export_id: str, range_header: Optional[str] = Header(None, alias="range"),
+                          if_range: Optional[str] = Header(None)):
+    """The finished artifact of an export, honouring a single ``Range: bytes=`` request."""
+    job = await export_jobs.get_job(export_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Export is {job['status']}, not ready for download")
+    try:
+        size = os.path.getsize(job["path"])
+    except OSError:
+        raise HTTPException(status_code=410, detail="Export artifact has expired, request the export again")
+
+    media_type, extension, _ = EXPORT_FORMATS[job["format"]]
+    etag = f'"{export_id}"'
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Content-Disposition": f"attachment; filename=report.{extension}"}
+    # A resumed download of a different artifact must start over
+    if if_range and if_range != etag:
+        range_header = None
+    try:
+        span = export_jobs.byte_range(range_header, size)
+    except export_jobs.RangeNotSatisfiable:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    first, last = span or (0, size - 1)
+    headers["Content-Length"] = str(last - first + 1)
+    if span:
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    return StreamingResponse(export_jobs.read(job["path"], first, last), status_code=206 if span else 200,
+                             media_type=media_type, headers=headers)
 
 # Saved Reports endpoints
 class SaveReportRequest(BaseModel):
@@ -337,9 +574,7 @@ class SaveReportRequest(BaseModel):
 @router.post("/saved-reports")
 async def save_report(request: SaveReportRequest):
     # Check if there's any data in the collection
-    collection = AdReport.get_pymongo_collection()
-    data_count = await collection.count_documents({})
-    if data_count == 0:
+    if not await meta.has_data():
         raise HTTPException(status_code=400, detail="No data available. Please upload data first")
 
     saved_report = SavedReport(
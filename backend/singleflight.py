@@ -0,0 +1,60 @@
+"""In-process coalescing of identical concurrent report requests.
+
+A shared dashboard, or every open dashboard right after an import, sends
+the same /query or /summary many times within a second. While the first
+one is still aggregating, every identical request that arrives awaits the
+same task and gets its result instead of starting another aggregation.
+Once the task finishes, later requests are answered by the result caches
+or start a new flight.
+
+Keys include the data generation, so a request never joins a flight that
+started on older data than it would have read itself. The coroutine runs
+as its own task: a client disconnecting cancels only its wait, never the
+flight other requests share. Results are shared objects and must not be
+mutated.
+"""
+from typing import Awaitable, Callable, Dict, Hashable
+from .metrics import SINGLE_FLIGHT_REQUESTS
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._flights: Dict[Hashable, asyncio.Task] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, run: Callable[[], Awaitable]):
+        """Await ``run()``, or the flight already running under ``key``."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(run())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._land(key, done))
+            self.leaders += 1
+            SINGLE_FLIGHT_REQUESTS.inc(endpoint=self.endpoint, outcome="leader")
+        else:
+            self.shared += 1
+            SINGLE_FLIGHT_REQUESTS.inc(endpoint=self.endpoint, outcome="shared")
+        return await asyncio.shield(flight)
+
+    def _land(self, key: Hashable, flight: asyncio.Task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Retrieve the error even if every waiter went away, it was raised to any that remained
+        if not flight.cancelled():
+            flight.exception()
+
+    def stats(self) -> dict:
+        requests = self.leaders + self.shared
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "shared": self.shared,
+            "shared_rate": self.shared / requests if requests else 0.0,
+        }
+
+
+query_flights = SingleFlight("query")
+summary_flights = SingleFlight("summary")
@@ -0,0 +1,159 @@
+"""On-disk column snapshots of ad_reports for the columnar engine.
+
+Import jobs write one snapshot per report_id under SNAPSHOT_DIR while they
+load the rows into MongoDB:
+
+    <SNAPSHOT_DIR>/<report_id>/
+        manifest.json       report_id, rows, version, column dtypes
+        dictionaries.json   values of each string dimension, by code
+        <column>.bin        raw little-endian array, one file per column
+
+The manifest is written last and the directory is renamed into place, so a
+snapshot either exists completely or not at all. The columnar engine
+(olap.py) opens the .bin files with np.memmap instead of reading the
+collection, which makes a cold start take milliseconds. The pages are shared
+through the OS page cache by every process on the host that maps them,
+instead of each uvicorn worker holding a private copy.
+
+A snapshot carries the report version (meta.py) of the import that wrote
+it and is only used while the report_id still has that version. Any later
+import that changes the report's rows stamps a new version, and the engine
+falls back to loading from the collection. Snapshots are disabled unless
+SNAPSHOT_DIR is set. With separate import workers it must point at storage
+shared with the API hosts.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from .ingest import STRING_FIELDS
+from .rollups import ADDITIVE_METRICS
+import json
+import logging
+import numpy as np
+import os
+import re
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "")
+
+COLUMN_DTYPES = {
+    **{field: "<i4" for field in STRING_FIELDS},
+    "date": "<i4",  # days since 1970-01-01
+    **{field: "<f8" if field == "payout" else "<i8" for field in ADDITIVE_METRICS},
+}
+
+
+def enabled() -> bool:
+    return bool(SNAPSHOT_DIR)
+
+
+def _segment_dir(report_id: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^A-Za-z0-9_.-]", "_", report_id))
+
+
+class SnapshotWriter:
+    """Append import blocks (from ``ingest.block_columns``) to a new snapshot."""
+
+    def __init__(self, report_id: str):
+        self.report_id = report_id
+        self.path = f"{_segment_dir(report_id)}.partial-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.path)
+        self.rows = 0
+        self._values: Dict[str, List] = {field: [] for field in STRING_FIELDS}
+        self._codes: Dict[str, Dict] = {field: {} for field in STRING_FIELDS}
+        self._files = {name: open(os.path.join(self.path, f"{name}.bin"), "wb") for name in COLUMN_DTYPES}
+
+    def _encode(self, field: str, values: List) -> np.ndarray:
+        codes, known = self._codes[field], self._values[field]
+        for value in values:
+            if value not in codes:
+                codes[value] = len(known)
+                known.append(value)
+        return np.fromiter((codes[value] for value in values), dtype=np.int32, count=len(values))
+
+    def append(self, columns: Dict):
+        for field in STRING_FIELDS:
+            block_codes, values = columns[field]
+            self._encode(field, values)[block_codes].astype("<i4").tofile(self._files[field])
+        for name in ["date"] + ADDITIVE_METRICS:
+            np.asarray(columns[name]).astype(COLUMN_DTYPES[name]).tofile(self._files[name])
+        self.rows += columns["rows"]
+
+    def _close(self):
+        for fh in self._files.values():
+            fh.close()
+
+    def commit(self, version: str, exclusive: bool = False):
+        """Publish the snapshot as ``version`` of the report, replacing any earlier one for the report_id.
+
+        With ``exclusive`` the snapshots of every other report_id are removed
+        first, for imports that replace all data.
+        """
+        self._close()
+        if exclusive:
+            clear(keep=self.report_id)
+        with open(os.path.join(self.path, "dictionaries.json"), "w") as fh:
+            json.dump(self._values, fh)
+        manifest = {
+            "report_id": self.report_id,
+            "rows": self.rows,
+            "version": version,
+            "columns": COLUMN_DTYPES,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as fh:
+            json.dump(manifest, fh)
+        final = _segment_dir(self.report_id)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(self.path, final)
+        logger.info(f"Wrote column snapshot for {self.report_id}: {self.rows} rows")
+
+    def discard(self):
+        self._close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def load(manifest: Dict) -> Tuple[Dict[str, np.ndarray], Dict[str, List]]:
+    """Memory-map a snapshot's columns; returns (columns, dictionaries)."""
+    columns = {}
+    for name, dtype in manifest["columns"].items():
+        path = os.path.join(manifest["path"], f"{name}.bin")
+        if manifest["rows"]:
+            columns[name] = np.memmap(path, dtype=dtype, mode="r", shape=(manifest["rows"],))
+        else:
+            columns[name] = np.empty(0, dtype=dtype)  # mmap can't map an empty file
+    with open(os.path.join(manifest["path"], "dictionaries.json")) as fh:
+        dictionaries = json.load(fh)
+    return columns, dictionaries
+
+
+def find(report_id: str, version: str) -> Optional[Dict]:
+    """Manifest of the report_id's snapshot if it is of ``version``."""
+    if not enabled():
+        return None
+    path = os.path.join(_segment_dir(report_id), "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        manifest = json.load(fh)
+    if manifest["report_id"] != report_id or manifest.get("version") != version:
+        return None
+    manifest["path"] = os.path.dirname(path)
+    return manifest
+
+
+def clear(keep: str = None):
+    """Remove every committed snapshot (except the one of report_id ``keep``), used when ad_reports is emptied.
+
+    Partial directories belong to imports still writing them and are left alone.
+    """
+    if enabled() and os.path.isdir(SNAPSHOT_DIR):
+        kept = os.path.abspath(_segment_dir(keep)) if keep is not None else None
+        for name in os.listdir(SNAPSHOT_DIR):
+            path = os.path.join(SNAPSHOT_DIR, name)
+            if not os.path.isfile(os.path.join(path, "manifest.json")) or os.path.abspath(path) == kept:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
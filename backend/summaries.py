@@ -0,0 +1,141 @@
+"""Materialized dashboard totals, one row per report_id plus a global one.
+
+Import jobs write the rows to the report_summaries collection when they
+finish, stamped with the data generation (meta.py) their final bump
+produced. A replace import sums its blocks in the parse pool as it goes,
+since the upload is the whole dataset. Upsert and partition imports change
+existing reports on the dates they touch only, so they sum those dates per
+report_id before writing to them (``totals_on``) and again at the end, and
+add the difference to the stored rows (``apply``). That is only exact when
+the rows were current when the import started and no other import bumped
+the generation meanwhile; otherwise the job re-sums everything (``refresh``),
+from the smallest ready rollup when there is one.
+
+``/api/reports/summary`` reads its row by _id and derives the ratio metrics
+from the stored sums. A row whose generation is not the current one (an
+import or delete landed since, or one is still finishing) is never served;
+the endpoint aggregates live instead.
+"""
+from pymongo import UpdateOne
+from typing import Dict, List, Optional
+from .models import AdReport
+from .pipeline import RATIO_METRICS
+from .rollups import ADDITIVE_METRICS
+from . import partitions, rollups
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_COLLECTION = "report_summaries"
+
+# _id of the row holding the totals over every report
+ALL_REPORTS = "__all__"
+
+# Rows of the current generation already read by this process
+_rows = {"generation": None, "by_id": {}}
+
+
+def _collection():
+    return AdReport.get_pymongo_collection().database[SUMMARY_COLLECTION]
+
+
+def add(totals: Dict[str, float], sums: Dict[str, float]):
+    """Add one block's ``sums`` to the running ``totals``."""
+    for field in ADDITIVE_METRICS:
+        totals[field] = totals.get(field, 0) + sums.get(field, 0)
+
+
+async def store(totals_by_report: Dict[str, Dict[str, float]], generation: int):
+    """Replace every summary row with ``totals_by_report`` and their global sum, valid for ``generation``."""
+    overall: Dict[str, float] = {}
+    requests = []
+    for report_id, totals in totals_by_report.items():
+        add(overall, totals)
+        requests.append(UpdateOne({"_id": report_id}, {"$set": {**totals, "generation": generation}}, upsert=True))
+    requests.append(UpdateOne({"_id": ALL_REPORTS}, {"$set": {**{field: overall.get(field, 0) for field in ADDITIVE_METRICS},
+                                                                   "generation": generation}}, upsert=True))
+    await _collection().bulk_write(requests, ordered=False)
+    await _collection().delete_many({"_id": {"$nin": list(totals_by_report) + [ALL_REPORTS]}})
+    logger.info(f"Stored summaries of {len(totals_by_report)} reports for generation {generation}")
+
+
+def add_reports(deltas: Dict[str, Dict[str, float]], totals_by_report: Dict[str, Dict[str, float]], sign: int = 1):
+    """Add (or with ``sign=-1`` subtract) per report ``totals_by_report`` to the running ``deltas``."""
+    for report_id, totals in totals_by_report.items():
+        add(deltas.setdefault(report_id, {}), {field: sign * totals.get(field, 0) for field in ADDITIVE_METRICS})
+
+
+async def totals_on(dates) -> Dict[str, Dict[str, float]]:
+    """Sums per report_id of the stored rows on ``dates``."""
+    source = AdReport.get_pymongo_collection()
+    cursor = source.aggregate(await partitions.visible(source, [
+        {"$match": {"date": {"$in": list(dates)}}},
+        {"$group": {"_id": "$report_id", **{field: {"$sum": f"${field}"} for field in ADDITIVE_METRICS}}},
+    ]), allowDiskUse=True)
+    return {doc.pop("_id"): doc for doc in await cursor.to_list(length=None)}
+
+
+async def apply(deltas: Dict[str, Dict[str, float]], start_generation: int, generation: int, bumps: int) -> bool:
+    """Add per report ``deltas`` to the rows and stamp every row with ``generation``.
+
+    Only when the rows were stored for ``start_generation`` and the job's
+    own ``bumps`` are the only ones since. Returns False otherwise, and the
+    caller has to ``refresh``.
+    """
+    if generation != start_generation + bumps or \
+            await _collection().find_one({"_id": ALL_REPORTS, "generation": start_generation}) is None:
+        return False
+    overall: Dict[str, float] = {}
+    requests = []
+    for report_id, totals in deltas.items():
+        add(overall, totals)
+        requests.append(UpdateOne({"_id": report_id}, {"$inc": totals}, upsert=True))
+    requests.append(UpdateOne({"_id": ALL_REPORTS}, {"$inc": {field: overall.get(field, 0) for field in ADDITIVE_METRICS}},
+                              upsert=True))
+    await _collection().bulk_write(requests, ordered=False)
+    # Reports whose every row was written over by the import
+    emptied = [report_id for report_id in deltas
+               if await AdReport.get_pymongo_collection().find_one({"report_id": report_id}, {"_id": 1}) is None]
+    if emptied:
+        await _collection().delete_many({"_id": {"$in": emptied}})
+    await _collection().update_many({}, {"$set": {"generation": generation}})
+    logger.info(f"Applied summary changes of {len(deltas)} reports for generation {generation}")
+    return True
+
+
+async def refresh(generation: int):
+    """Re-sum every report from the stored data and store the result for ``generation``."""
+    source = await rollups.route(set())
+    if source is None:
+        source = AdReport.get_pymongo_collection()
+    cursor = source.aggregate(await partitions.visible(source, [
+        {"$group": {"_id": "$report_id", **{field: {"$sum": f"${field}"} for field in ADDITIVE_METRICS}}},
+    ]), allowDiskUse=True)
+    totals = {doc.pop("_id"): doc for doc in await cursor.to_list(length=None)}
+    await store(totals, generation)
+
+
+async def get(report_id: Optional[str], generation: int) -> Optional[Dict]:
+    """The stored sums of ``report_id`` (all reports when None), None unless they are for ``generation``."""
+    if _rows["generation"] != generation:
+        _rows.update(generation=generation, by_id={})
+    key = report_id or ALL_REPORTS
+    if key not in _rows["by_id"]:
+        row = await _collection().find_one({"_id": key, "generation": generation})
+        if row is None:
+            # Not cached: the import that bumped the generation may be about to store it
+            return None
+        _rows["by_id"][key] = row
+    return _rows["by_id"][key]
+
+
+def metrics_of(sums: Dict, metrics: List[str]) -> Dict:
+    """``metrics`` computed from stored sums, ratios the way the aggregation pipeline derives them."""
+    result = {}
+    for metric in metrics:
+        if metric in RATIO_METRICS:
+            numerator, denominator, scale = RATIO_METRICS[metric]
+            result[metric] = sums.get(numerator, 0) / sums[denominator] * (scale or 1) if sums.get(denominator) else 0
+        else:
+            result[metric] = sums.get(metric, 0)
+    return result
@@ -0,0 +1,351 @@
+"""Import worker: claims queued CSV imports and loads them into ad_reports.
+
+Each job has an import mode:
+
+- replace (default): the upload becomes the whole dataset, loaded next to
+  the live data and swapped in at the end (bluegreen.py)
+- upsert: rows are replaced or added by ingest.NATURAL_KEY, the rest is kept
+- partition: every date in the upload is replaced as a whole (partitions.py)
+
+upsert and partition cost grows with the upload, not with the stored
+history. They can't update rollups with $inc partials, so the rollups stop
+serving queries during the import and the affected dates are rebuilt at the
+end.
+
+Before each generation bump, every report_id whose rows changed (the job's
+own, plus in upsert and partition mode those found on the touched dates)
+gets a new version (meta.stamp_reports) for the columnar engine.
+
+Run standalone with ``python -m backend.worker`` (one process per worker, as
+many as import throughput needs), or embedded in the API process, which is
+the default unless IMPORT_EMBEDDED_WORKER=0.
+"""
+from .models import AdReport, SavedReport, ImportJob, ExportJob
+from .ingest import IMPORT_CHUNK_BYTES, get_executor, iter_csv_blocks, parse_block, shutdown_executor
+from .ingest import NATURAL_KEY
+from .writer import BulkWriter, UpsertWriter
+from . import bluegreen, catalog, dictionaries, jobs, meta, metrics, partitions, rollups, snapshots, summaries
+from .metrics import IMPORT_ROWS, IMPORT_STAGE_SECONDS
+from starlette.concurrency import run_in_threadpool
+from beanie import init_beanie
+from dotenv import load_dotenv
+import motor.motor_asyncio
+import asyncio
+import contextlib
+import os
+import socket
+import tempfile
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMPORT_POLL_SECONDS = float(os.getenv("IMPORT_POLL_SECONDS", 2))
+
+
+async def process_csv(job: dict, path: str):
+    """Load one spooled CSV into ad_reports, saving progress on ``job`` as it goes."""
+    job_id = job['job_id']
+    mode = job.get('mode') or "replace"
+    logger.info(f"Starting processing for job {job_id} ({mode})")
+    published = False
+    # Whether ad_reports was written to (upsert) or had a date swapped (partition)
+    changed = False
+    # Staged collections are per attempt, a worker that lost the job must not touch its successor's
+    load_id = bluegreen.load_id(job)
+    lease_lost = False
+    staging = partitions.staging_collection(load_id) if mode == "partition" else None
+    if mode == "upsert":
+        writer = UpsertWriter(AdReport.get_pymongo_collection(), job['errors'], NATURAL_KEY)
+    elif mode == "partition":
+        writer = BulkWriter(staging, job['errors'])
+    else:
+        writer = BulkWriter(bluegreen.staged_collection(load_id), job['errors'])
+    dates = set()
+    # Report_ids whose rows this job changes, and the version they get
+    touched = {job_id}
+    version = uuid.uuid4().hex
+    totals = {}
+    # Upsert and partition: per report_id change of the summary sums on the touched dates
+    summary_deltas = {}
+    catalog_deltas = {}
+    start_generation = None
+    values = {}
+    snapshot = None
+    started = time.perf_counter()
+    try:
+        if mode == "replace":
+            await bluegreen.prepare(load_id)
+        if staging is not None:
+            await staging.drop()
+        if mode != "replace":
+            start_generation = await meta.current_generation()
+        if snapshots.enabled():
+            snapshot = snapshots.SnapshotWriter(job_id)
+        job['processed_records'] = 0
+        size = os.path.getsize(path) or 1
+        rollup_failed = False
+        loop = asyncio.get_running_loop()
+        with open(path, 'rb') as fh:
+            blocks = iter_csv_blocks(fh, IMPORT_CHUNK_BYTES)
+            block = await run_in_threadpool(next, blocks, None)
+            while block:
+                header, data, first_row, consumed = block
+                # Parse and coerce in the process pool, read the next block meanwhile
+                parsing = loop.run_in_executor(get_executor(), parse_block, header, data, job_id, first_row,
+                                               snapshots.enabled())
+                block = await run_in_threadpool(next, blocks, None)
+                records, row_errors, aggregates = await parsing
+                for stage, seconds in aggregates["timings"].items():
+                    IMPORT_STAGE_SECONDS.observe(seconds, stage=stage)
+                summaries.add(totals, aggregates["totals"])
+                catalog.add(values, aggregates["values"])
+                IMPORT_ROWS.inc(len(records), outcome="parsed")
+                IMPORT_ROWS.inc(len(row_errors), outcome="rejected")
+                job['errors'].extend(row_errors)
+                for error_msg in row_errors:
+                    logger.error(error_msg)
+
+                if dictionaries.compact():
+                    with IMPORT_STAGE_SECONDS.time(stage="encode"):
+                        await dictionaries.encode_records(records)
+                        for rows in aggregates["rollups"].values():
+                            await dictionaries.encode_records(rows)
+                if mode != "replace":
+                    new_dates = {record['date'] for record in records} - dates
+                    if new_dates:
+                        touched.update(await AdReport.get_pymongo_collection().distinct(
+                            "report_id", {"date": {"$in": list(new_dates)}}))
+                        summaries.add_reports(summary_deltas, await summaries.totals_on(new_dates), sign=-1)
+                        catalog.add_reports(catalog_deltas, await catalog.counts_on(new_dates), sign=-1)
+                        await rollups.invalidate(new_dates)
+                        dates |= new_dates
+                await writer.write(records)
+                changed = changed or mode == "upsert"
+                if mode == "replace":
+                    try:
+                        with IMPORT_STAGE_SECONDS.time(stage="rollups"):
+                            await rollups.apply(aggregates["rollups"], bluegreen.suffix(load_id))
+                    except Exception as e:
+                        rollup_failed = True
+                        error_msg = f"Rollup update failed: {str(e)}"
+                        job['errors'].append(error_msg)
+                        logger.error(error_msg)
+                if snapshot:
+                    with IMPORT_STAGE_SECONDS.time(stage="snapshot"):
+                        await run_in_threadpool(snapshot.append, aggregates["columns"])
+
+                job['inserted'] = writer.inserted
+                job['processed_records'] += len(records) + len(row_errors)
+                job['bytes_processed'] = consumed
+                job['progress'] = int((consumed / size) * 100)
+                await jobs.save_progress(job)
+                logger.info(f"Progress for job {job_id}: {job['progress']}%, {job['processed_records']} rows")
+
+        await writer.flush()
+        job['inserted'] = writer.inserted
+        if mode == "upsert" and writer.duplicates:
+            logger.warning(f"Job {job_id} repeated {writer.duplicates} keys within a block, the last rows were kept")
+
+        if mode == "replace":
+            if writer.failed_batches:
+                raise RuntimeError(f"{writer.failed_batches} insert batches failed, the previous data was kept")
+            with IMPORT_STAGE_SECONDS.time(stage="swap"):
+                await bluegreen.publish(load_id)
+            published = True
+
+        if staging is not None:
+            if writer.failed_batches:
+                raise RuntimeError("Staging the upload failed, no dates were replaced")
+            for date in sorted(dates):
+                with IMPORT_STAGE_SECONDS.time(stage="swap"):
+                    changed = True
+                    swapped = await partitions.swap(staging, date, load_id)
+                await meta.stamp_reports(touched, uuid.uuid4().hex)
+                await meta.bump_generation(has_data=True)
+                logger.info(f"Job {job_id} replaced {date:%Y-%m-%d} with {swapped} rows")
+
+        # Rollups are only used for queries while they match the raw rows exactly
+        if writer.failed_batches or rollup_failed:
+            logger.warning(f"Job {job_id} had failed writes, queries will use raw data")
+        elif mode == "replace":
+            await rollups.mark_ready()
+        else:
+            with IMPORT_STAGE_SECONDS.time(stage="rebuild"):
+                await rollups.rebuild()
+        if snapshot:
+            # A snapshot of rows that didn't all make it into MongoDB would never match anyway, nor
+            # one of an upsert upload that repeated keys (its rows were written over each other)
+            if writer.failed_batches or mode == "upsert" and \
+                    await AdReport.get_pymongo_collection().count_documents({"report_id": job_id}) != snapshot.rows:
+                await run_in_threadpool(snapshot.discard)
+            else:
+                try:
+                    await run_in_threadpool(snapshot.commit, version, mode == "replace")
+                except Exception as e:
+                    # The data is in MongoDB already, the engine loads the report from there instead
+                    logger.warning(f"Could not write the column snapshot for job {job_id}: {str(e)}")
+                    await run_in_threadpool(snapshot.discard)
+            snapshot = None
+        try:
+            # Before the bump, so lookups re-reading the catalog after it see the new values
+            with IMPORT_STAGE_SECONDS.time(stage="catalog"):
+                if mode == "replace":
+                    await catalog.write(job_id, counts_by_report={job_id: values} if writer.inserted else {})
+                else:
+                    catalog.add_reports(catalog_deltas, await catalog.counts_on(dates))
+                    await catalog.write(job_id, deltas=catalog_deltas, start_generation=start_generation,
+                                        bumps=len(dates) if staging is not None else 0)
+        except Exception as e:
+            logger.warning(f"Could not update the dimension value catalog for job {job_id}: {str(e)}")
+        await meta.stamp_reports(touched, version, exclusive=mode == "replace")
+        if mode == "replace":
+            generation = await meta.bump_generation(has_data=writer.inserted > 0)
+        else:
+            generation = await meta.bump_generation(has_data=True if writer.inserted else None)
+        try:
+            with IMPORT_STAGE_SECONDS.time(stage="summaries"):
+                if mode != "replace":
+                    summaries.add_reports(summary_deltas, await summaries.totals_on(dates))
+                    # Partition imports bumped once per date before the final bump
+                    bumps = len(dates) + 1 if staging is not None else 1
+                    if not await summaries.apply(summary_deltas, start_generation, generation, bumps):
+                        await summaries.refresh(generation)
+                else:
+                    # The upload is the whole dataset, so its block totals are the summary
+                    await summaries.store({job_id: totals} if writer.inserted else {}, generation)
+        except Exception as e:
+            # /summary aggregates live until the next import stores them
+            logger.warning(f"Could not store summaries for job {job_id}: {str(e)}")
+
+        job['total_records'] = job['processed_records']
+        job['status'] = "completed"
+        job['progress'] = 100
+        IMPORT_ROWS.inc(writer.inserted, outcome="written")
+        metrics.IMPORT_ROWS_PER_SECOND.set(job['processed_records'] / (time.perf_counter() - started))
+        logger.info(f"Job {job_id} completed successfully, inserted {job['inserted']} records")
+
+    except (jobs.LeaseLost, asyncio.CancelledError):
+        # The job belongs to another worker now, which cleans up after every attempt
+        lease_lost = True
+        raise
+    except Exception as e:
+        error_msg = f"A critical error occurred: {str(e)}"
+        job['status'] = "failed"
+        job['errors'].append(error_msg)
+        logger.error(f"Critical error for job {job_id}: {error_msg}")
+        # Whatever was written before the failure must not be served from caches
+        if published or changed:
+            with contextlib.suppress(Exception):
+                await meta.stamp_reports(touched, uuid.uuid4().hex, exclusive=published)
+            with contextlib.suppress(Exception):
+                # Counts of the rows written so far would be missing, re-counted on the next lookup
+                await catalog.invalidate(job_id)
+        with contextlib.suppress(Exception):
+            await meta.bump_generation(has_data=writer.inserted > 0 if published else None)
+    finally:
+        if snapshot:
+            snapshot.discard()
+        if not lease_lost:
+            await _drop_staged(job, mode, published)
+    await jobs.save_progress(job)
+
+
+async def _drop_staged(job: dict, mode: str, published: bool):
+    """Settle the date swaps and drop the staged collections of this attempt and of earlier ones that lost the job."""
+    attempts = job.get('attempts', 1)
+    for attempt in range(1, attempts + 1):
+        load_id = bluegreen.load_id({**job, 'attempts': attempt})
+        with contextlib.suppress(Exception):
+            await partitions.abandon(load_id)
+        with contextlib.suppress(Exception):
+            await partitions.staging_collection(load_id).drop()
+        if attempt < attempts or mode == "replace" and not published:
+            await bluegreen.discard(load_id)
+
+
+async def _keep_alive(job: dict):
+    while True:
+        await asyncio.sleep(jobs.IMPORT_LEASE_SECONDS / 3)
+        try:
+            await jobs.heartbeat(job['job_id'], job['worker_id'])
+        except jobs.LeaseLost:
+            raise
+        except Exception as e:
+            # A missed beat is fine as long as a later one lands before the lease ends
+            logger.warning(f"Heartbeat failed for job {job['job_id']}: {str(e)}")
+
+
+async def run_job(job: dict):
+    """Download a claimed job's upload, process it and clean up."""
+    heartbeat = asyncio.create_task(_keep_alive(job))
+    fd, path = tempfile.mkstemp(prefix="adreport-import-", suffix=".csv")
+    metrics.BACKGROUND_JOBS.inc(kind="import")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            await jobs.download(job, fh)
+        work = asyncio.create_task(process_csv(job, path))
+        # Stop as soon as either the import finishes or the lease is lost
+        await asyncio.wait([work, heartbeat], return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            work.cancel()
+            # Let it unwind (close the spool file) before the file is removed
+            await asyncio.wait([work])
+            heartbeat.result()
+        work.result()
+        await jobs.discard_upload(job)
+    except jobs.LeaseLost:
+        logger.warning(f"Lost lease on job {job['job_id']}, another worker took it over")
+    finally:
+        metrics.BACKGROUND_JOBS.dec(kind="import")
+        heartbeat.cancel()
+        os.remove(path)
+
+
+async def run_worker(worker_id: str = None):
+    """Claim and run import jobs until cancelled."""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    logger.info(f"Import worker {worker_id} started")
+    while True:
+        try:
+            await jobs.fail_exhausted()
+            job = await jobs.claim(worker_id)
+        except Exception as e:
+            logger.error(f"Import worker {worker_id} could not claim a job: {str(e)}")
+            job = None
+        if not job:
+            await asyncio.sleep(IMPORT_POLL_SECONDS)
+            continue
+        logger.info(f"Worker {worker_id} claimed job {job['job_id']} (attempt {job['attempts']})")
+        try:
+            await run_job(job)
+        except Exception as e:
+            logger.error(f"Job {job['job_id']} crashed on worker {worker_id}: {str(e)}")
+
+
+async def main():
+    load_dotenv()
+    mongodb_url = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
+    logger.info(f"Connecting to MongoDB at {mongodb_url}")
+    client = motor.motor_asyncio.AsyncIOMotorClient(mongodb_url)
+    await init_beanie(database=client.get_database("adtech_reports"), document_models=[AdReport, SavedReport, ImportJob, ExportJob])
+    # Same models and indexes as the API startup (main.py), a worker may be the first process to run
+    await rollups.ensure_indexes()
+    await dictionaries.ensure_indexes()
+    await catalog.ensure_indexes()
+    server = await metrics.serve()
+    monitor = asyncio.create_task(metrics.monitor_event_loop())
+    try:
+        await run_worker()
+    finally:
+        monitor.cancel()
+        if server:
+            server.close()
+        shutdown_executor()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(main())
@@ -0,0 +1,126 @@
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from typing import Dict, List
+from .metrics import IMPORT_STAGE_SECONDS
+import asyncio
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Documents per insert_many call and how many of those may be in flight at once
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 5000))
+IMPORT_MAX_IN_FLIGHT = int(os.getenv("IMPORT_MAX_IN_FLIGHT", 4))
+
+
+class BulkWriter:
+    """Insert already-coerced dicts straight through the driver.
+
+    Skips Beanie model validation, so records must come from
+    ``ingest.coerce_frame``. Batches are written with ``ordered=False`` and up
+    to ``max_in_flight`` of them run concurrently; ``write`` waits for a free
+    slot, which keeps memory bounded when the database is the bottleneck.
+    Failures are appended to ``errors`` (usually the job's error list).
+    """
+
+    def __init__(self, collection, errors: List[str], batch_size: int = IMPORT_BATCH_SIZE,
+                 max_in_flight: int = IMPORT_MAX_IN_FLIGHT):
+        self.collection = collection
+        self.errors = errors
+        self.batch_size = batch_size
+        self.inserted = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._pending = set()
+
+    async def write(self, records: List[Dict]):
+        for i in range(0, len(records), self.batch_size):
+            await self._submit(records[i:i+self.batch_size])
+
+    async def _submit(self, batch: List[Dict]):
+        await self._slots.acquire()
+        self.batches += 1
+        task = asyncio.create_task(self._insert(self.batches, batch))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def flush(self):
+        """Wait for every in-flight batch to finish."""
+        if self._pending:
+            await asyncio.gather(*self._pending)
+
+    async def _write(self, batch: List[Dict]) -> int:
+        result = await self.collection.insert_many(batch, ordered=False)
+        return len(result.inserted_ids)
+
+    @staticmethod
+    def _written(details: Dict) -> int:
+        return details.get('nInserted', 0)
+
+    async def _insert(self, number: int, batch: List[Dict]):
+        try:
+            with IMPORT_STAGE_SECONDS.time(stage="insert"):
+                self.inserted += await self._write(batch)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            self.inserted += self._written(e.details)
+            self.failed_batches += 1
+            first = write_errors[0].get('errmsg') if write_errors else str(e)
+            error_msg = f"Insert failed for batch {number}: {len(write_errors)} documents rejected, first error: {first}"
+            self.errors.append(error_msg)
+            logger.error(error_msg)
+        except Exception as e:
+            self.failed_batches += 1
+            error_msg = f"Insert failed for batch {number}: {str(e)}"
+            self.errors.append(error_msg)
+            logger.error(error_msg)
+        finally:
+            self._slots.release()
+
+
+class UpsertWriter(BulkWriter):
+    """Replace rows matching each record's ``key`` fields, inserting the new ones.
+
+    ``inserted`` counts every row written, replaced or new. When an upload
+    repeats a key, its last row wins. Within one ``write`` the earlier rows
+    are dropped (counted in ``duplicates``). Across writes, each key always
+    goes to the same lane (one of ``max_in_flight``), and a lane writes its
+    batches one at a time in order. So two upserts of one key are never in
+    flight together, and concurrent batches can't both insert it.
+    """
+
+    def __init__(self, collection, errors: List[str], key: List[str], **kwargs):
+        super().__init__(collection, errors, **kwargs)
+        self.key = key
+        self.duplicates = 0
+        self._lanes = [asyncio.Lock() for _ in range(kwargs.get("max_in_flight", IMPORT_MAX_IN_FLIGHT))]
+
+    def _lane(self, record: Dict) -> int:
+        return hash(tuple(record[field] for field in self.key)) % len(self._lanes)
+
+    async def write(self, records: List[Dict]):
+        rows = {}
+        for record in records:
+            rows[tuple(record[field] for field in self.key)] = record
+        self.duplicates += len(records) - len(rows)
+        lanes = [[] for _ in self._lanes]
+        for record in rows.values():
+            lanes[self._lane(record)].append(record)
+        for lane in lanes:
+            for i in range(0, len(lane), self.batch_size):
+                await self._submit(lane[i:i+self.batch_size])
+
+    async def _insert(self, number: int, batch: List[Dict]):
+        # Lock waiters are woken in order, so a lane's batches land in the order they were submitted
+        async with self._lanes[self._lane(batch[0])]:
+            await super()._insert(number, batch)
+
+    async def _write(self, batch: List[Dict]) -> int:
+        ops = [ReplaceOne({field: record[field] for field in self.key}, record, upsert=True) for record in batch]
+        result = await self.collection.bulk_write(ops, ordered=False)
+        return result.upserted_count + result.matched_count
+
+    @staticmethod
+    def _written(details: Dict) -> int:
+        return details.get('nUpserted', 0) + details.get('nMatched', 0)
@@ -0,0 +1,84 @@
+"""Dashboard-style report requests: separate /query calls against one /query/batch.
+
+Usage: python -m benchmarks.bench_batch [rows] [iterations]
+
+Seeds the scratch database on MONGODB_URI (see bench_precheck), then times a
+set of requests that share a date range and filters but group by different
+dimensions, the way the Reports and Dashboard pages ask for them. They run
+one after another through /query, all at once through /query (the browser
+fires them in parallel), and as one /query/batch call. Result caches are
+cleared before every run, so each one aggregates from scratch.
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import date
+
+import motor.motor_asyncio
+from beanie import init_beanie
+
+from backend.cache import query_cache, total_cache
+from backend.models import AdReport, SavedReport, ImportJob
+from backend.routers.reports import (BatchQueryRequest, DateRange, ReportQueryRequest, query_reports,
+                                     query_reports_batch, validate_and_build_pipeline)
+from benchmarks.bench_precheck import DATABASE, _seed
+
+DATE_RANGE = DateRange(start=date(2024, 1, 1), end=date(2024, 1, 31))
+FILTERS = {"inventory_format_name": ["Banner", "Interstitial", "Rewarded"]}
+METRICS = ["ad_exchange_total_requests", "ad_exchange_line_item_level_impressions", "payout", "average_ecpm"]
+DIMENSION_SETS = [
+    ["mobile_app_name"],
+    ["inventory_format_name"],
+    ["operating_system_version_name"],
+    ["date"],
+    ["domain"],
+    [],
+]
+
+REQUESTS = [ReportQueryRequest(dimensions=dims, metrics=METRICS, filters=FILTERS, date_range=DATE_RANGE, limit=50)
+            for dims in DIMENSION_SETS]
+
+
+async def sequential():
+    for request in REQUESTS:
+        await query_reports(request, validate_and_build_pipeline(request))
+
+
+async def concurrent():
+    await asyncio.gather(*[query_reports(request, validate_and_build_pipeline(request)) for request in REQUESTS])
+
+
+async def batched():
+    await query_reports_batch(BatchQueryRequest(queries=REQUESTS))
+
+
+async def _time(run, iterations: int) -> float:
+    timings = []
+    for _ in range(iterations + 1):
+        query_cache.clear()
+        total_cache.clear()
+        start = time.perf_counter()
+        await run()
+        timings.append(time.perf_counter() - start)
+    timings = sorted(timings[1:])  # the first run warms the server caches
+    return timings[len(timings) // 2] * 1000
+
+
+async def main(rows: int = 1_000_000, iterations: int = 10):
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    db = client[DATABASE]
+    await _seed(db.ad_reports, rows)
+    await db.app_meta.update_one({"_id": "data"}, {"$set": {"has_data": True}}, upsert=True)
+    await init_beanie(database=db, document_models=[AdReport, SavedReport, ImportJob])
+
+    print(f"{len(REQUESTS)} requests sharing one filter set, median of {iterations} runs")
+    baseline = await _time(sequential, iterations)
+    for label, run in (("sequential /query", sequential), ("concurrent /query", concurrent), ("/query/batch", batched)):
+        elapsed = baseline if run is sequential else await _time(run, iterations)
+        print(f"{label:<20} {elapsed:9.1f} ms  {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    args = [int(float(a)) for a in sys.argv[1:3]]
+    asyncio.run(main(*args))
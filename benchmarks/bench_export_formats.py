@@ -0,0 +1,66 @@
+"""Size and encode/decode time of the /api/reports/export formats.
+
+Usage: python -m benchmarks.bench_export_formats [rows]
+
+Rows go straight from memory through the export writers (no database), in
+EXPORT_BATCH_ROWS batches like the cursor would deliver them. Decode time is
+what a downstream consumer pays to load the result: pandas.read_csv,
+pandas.read_json(lines=True), pyarrow.parquet.read_table, or the IPC reader.
+"""
+import asyncio
+import gzip
+import io
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from backend.export import EXPORT_BATCH_ROWS, WRITERS
+from backend.ingest import coerce_frame
+from benchmarks.datagen import generate_frame
+
+COLUMNS = [
+    "date", "mobile_app_name", "ad_unit_name",
+    "ad_exchange_total_requests", "ad_exchange_line_item_level_impressions",
+    "ad_exchange_line_item_level_clicks", "ad_exchange_line_item_level_ctr", "average_ecpm", "payout",
+]
+
+DECODERS = {
+    "csv": lambda data: pd.read_csv(io.BytesIO(data)),
+    "ndjson": lambda data: pd.read_json(io.BytesIO(data), lines=True),
+    "parquet": lambda data: pq.read_table(io.BytesIO(data)),
+    "arrow": lambda data: pa.ipc.open_stream(data).read_all(),
+}
+
+
+async def _batches(records):
+    for i in range(0, len(records), EXPORT_BATCH_ROWS):
+        yield records[i:i+EXPORT_BATCH_ROWS]
+
+
+async def encode(format: str, records) -> bytes:
+    return b"".join([chunk async for chunk in WRITERS[format](_batches(records), COLUMNS)])
+
+
+def main(rows: int = 500_000):
+    records, _ = coerce_frame(generate_frame(rows), "bench")
+
+    print(f"rows: {rows}")
+    print(f"{'format':<8} {'bytes':>12} {'gzip bytes':>12} {'encode':>9} {'decode':>9}")
+    for format, decode in DECODERS.items():
+        start = time.perf_counter()
+        data = asyncio.run(encode(format, records))
+        encode_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decode(data)
+        decode_secs = time.perf_counter() - start
+
+        gzipped = len(gzip.compress(data, 6)) if format in ("csv", "ndjson") else len(data)
+        print(f"{format:<8} {len(data):>12,} {gzipped:>12,} {encode_secs:>8.2f}s {decode_secs:>8.2f}s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500_000)
@@ -0,0 +1,83 @@
+"""Report latency before and after applying the index advisor's recommendations.
+
+Usage: python -m benchmarks.bench_indexes [rows] [iterations]
+
+Seeds the scratch database on MONGODB_URI (see bench_precheck) and initialises
+Beanie on it, so ad_reports carries the indexes declared on AdReport. Drops
+any esr_* indexes from earlier runs and times a few typical filtered reports,
+recording their shapes. Then it applies backend.index_advisor's
+recommendations and times the same reports again.
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+import motor.motor_asyncio
+from beanie import init_beanie
+
+from backend import index_advisor
+from backend.models import AdReport, SavedReport, ImportJob
+from backend.pipeline import build_pipeline
+from benchmarks.bench_precheck import DATABASE, _seed
+
+RANGE = {"$gte": datetime(2024, 1, 10), "$lte": datetime(2024, 1, 20, 23, 59, 59)}
+
+WORKLOAD = {
+    "format + date range": (
+        {"inventory_format_name": {"$in": ["Rewarded"]}, "date": RANGE},
+        ["date", "mobile_app_name"],
+    ),
+    "app + format + date range": (
+        {"mobile_app_name": {"$in": ["App 7", "App 42"]}, "inventory_format_name": {"$in": ["Banner"]}, "date": RANGE},
+        ["date", "ad_unit_name"],
+    ),
+    "report_id + OS + date range": (
+        {"report_id": "bench", "operating_system_version_name": {"$in": ["iOS 17"]}, "date": RANGE},
+        ["date"],
+    ),
+}
+METRICS = ["ad_exchange_total_requests", "payout", "average_ecpm"]
+
+
+async def _time_workload(collection, iterations: int) -> dict:
+    timings = {}
+    for label, (match, dimensions) in WORKLOAD.items():
+        pipeline = build_pipeline([{"$match": match}], dimensions, METRICS)
+        await collection.aggregate(pipeline).to_list(length=None)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            query_start = time.perf_counter()
+            await collection.aggregate(pipeline).to_list(length=None)
+            index_advisor.record(collection.name, match, (time.perf_counter() - query_start) * 1000)
+        timings[label] = (time.perf_counter() - start) / iterations * 1000
+    return timings
+
+
+async def main(rows: int = 1_000_000, iterations: int = 20):
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    db = client[DATABASE]
+    await _seed(db.ad_reports, rows)
+    await init_beanie(database=db, document_models=[AdReport, SavedReport, ImportJob])
+    collection = AdReport.get_pymongo_collection()
+    for name in await collection.index_information():
+        if name.startswith("esr_"):
+            await collection.drop_index(name)
+    await db[index_advisor.SHAPES_COLLECTION].delete_many({})
+    print(f"documents: {await collection.estimated_document_count()}")
+
+    before = await _time_workload(collection, iterations)
+    created = await index_advisor.apply(await index_advisor.recommend(min_queries=1))
+    for index in created:
+        print(f"created {index['name']}: {index['plan']}")
+    after = await _time_workload(collection, iterations)
+
+    print(f"{'report':<30} {'before':>10} {'after':>10}")
+    for label in WORKLOAD:
+        print(f"{label:<30} {before[label]:>8.1f}ms {after[label]:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    args = [int(float(a)) for a in sys.argv[1:3]]
+    asyncio.run(main(*args))
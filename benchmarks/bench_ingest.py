@@ -0,0 +1,69 @@
+"""Rows/sec of CSV coercion: legacy iterrows loop vs backend.ingest.coerce_frame.
+
+Usage: python -m benchmarks.bench_ingest [rows]
+
+The legacy path is the per-row loop that process_csv used before the
+vectorized path, without building the AdReport models (that needs an
+initialised Beanie), so its numbers are an upper bound.
+"""
+import io
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from backend.ingest import COLUMN_MAPPING, STRING_FIELDS, INT_FIELDS, FLOAT_FIELDS, coerce_frame
+from benchmarks.datagen import generate_frame
+
+
+def legacy_coerce(df: pd.DataFrame, report_id: str):
+    df = df.rename(columns=COLUMN_MAPPING)
+    records = []
+    for index, row in df.iterrows():
+        date_val = row.get('date')
+        if pd.isna(date_val) or date_val == '':
+            date_parsed = datetime.now().date()
+        else:
+            date_parsed = pd.to_datetime(date_val, errors='coerce')
+            date_parsed = datetime.now().date() if pd.isna(date_parsed) else date_parsed.date()
+        record = {'report_id': report_id, 'date': date_parsed}
+        for field in STRING_FIELDS:
+            value = row.get(field, '')
+            record[field] = '' if pd.isna(value) else str(value)
+        for field in INT_FIELDS:
+            value = row.get(field, 0)
+            record[field] = 0 if pd.isna(value) else int(value)
+        for field in FLOAT_FIELDS:
+            value = row.get(field, 0.0)
+            record[field] = 0.0 if pd.isna(value) else float(value)
+        records.append(record)
+    return records
+
+
+def _read(csv_bytes: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(csv_bytes), header=0, encoding='utf-8-sig')
+
+
+def main(rows: int = 200_000):
+    buffer = io.StringIO()
+    generate_frame(rows).to_csv(buffer, index=False)
+    csv_bytes = buffer.getvalue().encode()
+
+    start = time.perf_counter()
+    legacy = legacy_coerce(_read(csv_bytes), "bench")
+    legacy_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records, errors = coerce_frame(_read(csv_bytes), "bench")
+    vectorized_secs = time.perf_counter() - start
+
+    assert len(records) == len(legacy) and not errors
+    print(f"rows:        {rows}")
+    print(f"legacy:      {legacy_secs:.2f}s  {rows / legacy_secs:,.0f} rows/sec")
+    print(f"vectorized:  {vectorized_secs:.2f}s  {rows / vectorized_secs:,.0f} rows/sec")
+    print(f"speedup:     {legacy_secs / vectorized_secs:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
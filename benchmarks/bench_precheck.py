@@ -0,0 +1,54 @@
+"""Per-request cost of the "is there any data" check.
+
+Usage: python -m benchmarks.bench_precheck [rows] [iterations]
+
+Loads ``rows`` synthetic documents into a scratch database on MONGODB_URI
+(default mongodb://localhost:27017) if it holds fewer, then times the old
+count_documents({}) precheck against estimated_document_count() and the
+app_meta has_data lookup used by the API now.
+"""
+import asyncio
+import os
+import sys
+import time
+
+import motor.motor_asyncio
+
+from backend.ingest import coerce_frame
+from benchmarks.datagen import generate_frame
+
+DATABASE = "adtech_reports_bench"
+
+
+async def _seed(collection, rows: int):
+    have = await collection.estimated_document_count()
+    for start in range(have, rows, 100_000):
+        records, _ = coerce_frame(generate_frame(min(100_000, rows - start), seed=start), "bench")
+        await collection.insert_many(records, ordered=False)
+
+
+async def _time(label: str, check, iterations: int):
+    await check()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await check()
+    per_call = (time.perf_counter() - start) / iterations
+    print(f"{label:<28} {per_call * 1000:9.3f} ms/request")
+
+
+async def main(rows: int = 1_000_000, iterations: int = 50):
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    db = client[DATABASE]
+    await _seed(db.ad_reports, rows)
+    await db.app_meta.update_one({"_id": "data"}, {"$set": {"has_data": True}}, upsert=True)
+    print(f"documents: {await db.ad_reports.estimated_document_count()}")
+
+    await _time("count_documents({})", lambda: db.ad_reports.count_documents({}), iterations)
+    await _time("estimated_document_count()", lambda: db.ad_reports.estimated_document_count(), iterations)
+    await _time("app_meta has_data", lambda: db.app_meta.find_one({"_id": "data"}), iterations)
+    print("the API additionally caches the app_meta read for GENERATION_POLL_SECONDS")
+
+
+if __name__ == "__main__":
+    args = [int(float(a)) for a in sys.argv[1:3]]
+    asyncio.run(main(*args))
@@ -0,0 +1,90 @@
+"""On-disk size and report latency of the strings and compact storage modes.
+
+Usage: python -m benchmarks.bench_storage_modes [rows] [iterations]
+
+Loads the same generated rows into two scratch collections on MONGODB_URI,
+one with string dimensions and one dictionary-encoded the way import jobs do
+with STORAGE_MODE=compact. Prints collStats (data, storage and index sizes)
+for both, then times a few grouped reports. The compact timings include
+translating the filters to codes and decoding the first page back to names.
+"""
+import asyncio
+import os
+import sys
+import time
+
+import motor.motor_asyncio
+from beanie import init_beanie
+from pymongo import ASCENDING, IndexModel
+
+from backend import dictionaries
+from backend.ingest import coerce_frame
+from backend.models import AdReport, SavedReport, ImportJob
+from backend.pipeline import build_pipeline
+from benchmarks.bench_precheck import DATABASE
+from benchmarks.datagen import generate_frame
+
+COLLECTIONS = {"strings": "bench_storage_strings", "compact": "bench_storage_compact"}
+PAGE_ROWS = 100
+
+WORKLOAD = {
+    "by app": ({}, ["mobile_app_name"]),
+    "by app + format": ({}, ["mobile_app_name", "inventory_format_name"]),
+    "ad units of two apps": ({"mobile_app_name": {"$in": ["App 7", "App 42"]}}, ["mobile_app_name", "ad_unit_name"]),
+    "Banner by domain + OS": ({"inventory_format_name": {"$in": ["Banner"]}}, ["domain", "operating_system_version_name"]),
+}
+METRICS = ["ad_exchange_total_requests", "payout", "average_ecpm"]
+
+
+async def _seed(db, rows: int):
+    for name in COLLECTIONS.values():
+        await db[name].drop()
+    for start in range(0, rows, 100_000):
+        records, _ = coerce_frame(generate_frame(min(100_000, rows - start), seed=start), "bench")
+        await db[COLLECTIONS["strings"]].insert_many(records, ordered=False)
+        await dictionaries.encode_records(records)
+        await db[COLLECTIONS["compact"]].insert_many(records, ordered=False)
+    for name in COLLECTIONS.values():
+        await db[name].create_indexes([IndexModel([("report_id", ASCENDING), ("date", ASCENDING)])])
+
+
+async def _time_report(collection, mode: str, match: dict, dimensions: list, iterations: int) -> float:
+    async def run():
+        pipeline = build_pipeline([{"$match": match}], dimensions, METRICS)
+        if mode == "compact":
+            pipeline = await dictionaries.translate_match(pipeline)
+        rows = await collection.aggregate(pipeline).to_list(length=None)
+        if mode == "compact":
+            await dictionaries.decode_rows(rows[:PAGE_ROWS], dimensions)
+
+    await run()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await run()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+async def main(rows: int = 1_000_000, iterations: int = 10):
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    db = client[DATABASE]
+    await init_beanie(database=db, document_models=[AdReport, SavedReport, ImportJob])
+    await db[dictionaries.DICTIONARY_COLLECTION].drop()
+    await db.app_meta.delete_one({"_id": "dimension_codes"})
+    await dictionaries.ensure_indexes()
+    await _seed(db, rows)
+
+    print(f"{'mode':<10} {'documents':>10} {'size':>10} {'storage':>10} {'indexes':>10}")
+    for mode, name in COLLECTIONS.items():
+        stats = await db.command("collStats", name, scale=1024 * 1024)
+        print(f"{mode:<10} {stats['count']:>10} {stats['size']:>8.1f}MB {stats['storageSize']:>8.1f}MB "
+              f"{stats['totalIndexSize']:>8.1f}MB")
+
+    print(f"{'report':<25} {'strings':>10} {'compact':>10}")
+    for label, (match, dimensions) in WORKLOAD.items():
+        timings = [await _time_report(db[name], mode, match, dimensions, iterations) for mode, name in COLLECTIONS.items()]
+        print(f"{label:<25} {timings[0]:>8.1f}ms {timings[1]:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    args = [int(float(a)) for a in sys.argv[1:3]]
+    asyncio.run(main(*args))
@@ -0,0 +1,59 @@
+"""Synthetic AdReport data for benchmarks.
+
+Cardinalities roughly follow a real ad exchange export: a few hundred apps,
+each with a handful of ad units, a few inventory formats and OS versions.
+"""
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+
+CSV_COLUMNS = [
+    "date", "mobile_app_resolved_id", "mobile_app_name", "domain", "ad_unit_name",
+    "ad_unit_id", "inventory_format_name", "operating_system_version_name",
+    "ad_exchange_total_requests", "ad_exchange_responses_served", "ad_exchange_match_rate",
+    "ad_exchange_line_item_level_impressions", "ad_exchange_line_item_level_clicks",
+    "ad_exchange_line_item_level_ctr", "average_ecpm", "payout"
+]
+
+FORMATS = ["Banner", "Interstitial", "Rewarded", "Native", "App open"]
+OS_VERSIONS = [f"Android {v}" for v in range(8, 15)] + [f"iOS {v}" for v in range(13, 18)]
+
+
+def generate_frame(rows: int, seed: int = 42, apps: int = 500, units_per_app: int = 8,
+                   days: int = 90, start: date = date(2024, 1, 1)) -> pd.DataFrame:
+    """Build a DataFrame with the same columns as an uploaded report CSV."""
+    rng = np.random.default_rng(seed)
+    app = rng.integers(0, apps, rows)
+    unit = app * units_per_app + rng.integers(0, units_per_app, rows)
+    day = rng.integers(0, days, rows)
+    requests = rng.integers(100, 100_000, rows)
+    responses = (requests * rng.uniform(0.3, 1.0, rows)).astype("int64")
+    impressions = (responses * rng.uniform(0.5, 1.0, rows)).astype("int64")
+    clicks = (impressions * rng.uniform(0.0, 0.05, rows)).astype("int64")
+    payout = impressions * rng.uniform(0.2, 5.0, rows) / 1000
+
+    dates = np.array([(start + timedelta(days=int(d))).isoformat() for d in range(days)])
+    return pd.DataFrame({
+        "date": dates[day],
+        "mobile_app_resolved_id": np.char.add("ca-app-pub-", app.astype(str)),
+        "mobile_app_name": np.char.add("App ", app.astype(str)),
+        "domain": np.char.add(np.char.add("app", (app % (apps // 2 or 1)).astype(str)), ".example.com"),
+        "ad_unit_name": np.char.add("Unit ", unit.astype(str)),
+        "ad_unit_id": unit.astype(str),
+        "inventory_format_name": np.array(FORMATS)[unit % len(FORMATS)],
+        "operating_system_version_name": np.array(OS_VERSIONS)[rng.integers(0, len(OS_VERSIONS), rows)],
+        "ad_exchange_total_requests": requests,
+        "ad_exchange_responses_served": responses,
+        "ad_exchange_match_rate": np.round(responses / requests, 4),
+        "ad_exchange_line_item_level_impressions": impressions,
+        "ad_exchange_line_item_level_clicks": clicks,
+        "ad_exchange_line_item_level_ctr": np.round(np.divide(clicks, impressions, out=np.zeros(rows), where=impressions > 0), 4),
+        "average_ecpm": np.round(np.divide(payout * 1000, impressions, out=np.zeros(rows), where=impressions > 0), 4),
+        "payout": np.round(payout, 2),
+    }, columns=CSV_COLUMNS)
+
+
+def generate_csv(rows: int, path: str, seed: int = 42, **kwargs) -> str:
+    """Write a synthetic report CSV to ``path`` and return the path."""
+    generate_frame(rows, seed=seed, **kwargs).to_csv(path, index=False)
+    return path
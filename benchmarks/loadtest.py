@@ -0,0 +1,356 @@
+"""Load generator and latency benchmark for the reports API.
+
+Usage:
+    python -m benchmarks.loadtest seed --rows 1e7
+    python -m benchmarks.loadtest run --base-url http://localhost:8000 --duration 60 --concurrency 16 \\
+        --mix query=70,summary=15,export=10,import=5 --server-pid <uvicorn pid> --out results.json
+    python -m benchmarks.loadtest compare before.json after.json
+
+``seed`` writes synthetic rows (benchmarks.datagen) straight into the
+database the API reads, MONGODB_URI / adtech_reports by default. Parsing
+runs in the import process pool and writes go through the import
+BulkWriter, which makes 1e8 rows practical. Afterwards it does what an
+import would: it rebuilds the rollups for the seeded dates, re-counts the
+dimension value catalog, stamps a new report version (for the columnar
+engine), bumps the data generation and re-sums the stored summaries. Apps, ad units and days scale with ``--rows`` unless they are given,
+so the cardinalities stay realistic at every size. The existing rows are
+deleted first unless ``--append`` is passed.
+
+``run`` drives a running API with ``--concurrency`` clients for
+``--duration`` seconds. Each request picks an endpoint at random, weighted
+by ``--mix``:
+
+- query: random dimensions, metrics, filters and date ranges
+- summary: the dashboard summary
+- export: a CSV export of a random report, streamed to the end
+- import: an upload of ``--import-rows`` generated rows, timed until the job
+  completes. The default ``--import-mode upsert`` keeps the seeded data.
+
+Every client draws its requests from its own fixed seed, so two runs send
+the same requests. Results are written as JSON: per endpoint p50/p95/p99/max
+latency, requests and rows per second, and errors. They also hold the peak
+RSS of the harness and, with ``--server-pid``, of the API process (VmHWM,
+Linux only), plus the git commit. ``compare`` prints the change between two
+result files.
+
+Requires httpx (``pip install httpx``).
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from backend.ingest import coerce_frame, get_executor, shutdown_executor
+from benchmarks.datagen import FORMATS, OS_VERSIONS, generate_frame
+
+START = date(2024, 1, 1)
+SEED_CHUNK_ROWS = 100_000
+DEFAULT_MIX = "query=70,summary=15,export=10,import=5"
+
+DIMENSIONS = [
+    "mobile_app_resolved_id", "mobile_app_name", "domain", "ad_unit_name",
+    "ad_unit_id", "inventory_format_name", "operating_system_version_name", "date"
+]
+METRICS = [
+    "ad_exchange_total_requests", "ad_exchange_responses_served", "ad_exchange_match_rate",
+    "ad_exchange_line_item_level_impressions", "ad_exchange_line_item_level_clicks",
+    "ad_exchange_line_item_level_ctr", "average_ecpm", "payout"
+]
+
+
+def scale(rows: int, apps: int = None, days: int = None) -> dict:
+    """Cardinalities for a dataset of ``rows``: about 2000 rows per app, up to a year of days."""
+    return {
+        "apps": apps or int(np.clip(rows // 2000, 20, 20_000)),
+        "days": days or int(np.clip(rows // 10_000, 7, 365)),
+    }
+
+
+def _seed_chunk(rows: int, seed: int, apps: int, days: int):
+    records, _ = coerce_frame(generate_frame(rows, seed=seed, apps=apps, days=days, start=START), "loadtest")
+    return records
+
+
+async def seed(args):
+    import motor.motor_asyncio
+    from beanie import init_beanie
+    from backend import catalog, dictionaries, meta, rollups, summaries
+    from backend.models import AdReport, SavedReport, ImportJob
+    from backend.writer import BulkWriter
+
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    await init_beanie(database=client[args.database], document_models=[AdReport, SavedReport, ImportJob])
+    await rollups.ensure_indexes()
+    await dictionaries.ensure_indexes()
+    await catalog.ensure_indexes()
+    collection = AdReport.get_pymongo_collection()
+    if not args.append:
+        await collection.delete_many({})
+        await rollups.clear()
+    shape = scale(args.rows, args.apps, args.days)
+    print(f"seeding {args.rows} rows into {args.database}: {shape['apps']} apps, {shape['days']} days")
+
+    errors = []
+    writer = BulkWriter(collection, errors)
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    chunks = [(min(SEED_CHUNK_ROWS, args.rows - start), args.seed + start) for start in range(0, args.rows, SEED_CHUNK_ROWS)]
+    pending = [loop.run_in_executor(get_executor(), _seed_chunk, rows, chunk_seed, shape["apps"], shape["days"])
+               for rows, chunk_seed in chunks[:2]]
+    for i in range(len(chunks)):
+        records = await pending.pop(0)
+        if i + 2 < len(chunks):
+            rows, chunk_seed = chunks[i + 2]
+            pending.append(loop.run_in_executor(get_executor(), _seed_chunk, rows, chunk_seed, shape["apps"], shape["days"]))
+        if dictionaries.compact():
+            await dictionaries.encode_records(records)
+        await writer.write(records)
+        print(f"  {writer.inserted} rows, {writer.inserted / (time.perf_counter() - started):.0f} rows/s", end="\r")
+    await writer.flush()
+    print(f"\ninserted {writer.inserted} rows in {time.perf_counter() - started:.1f}s, {len(errors)} failed batches")
+
+    dates = [datetime.combine(START + timedelta(days=d), datetime.min.time()) for d in range(shape["days"])]
+    await rollups.invalidate(dates)
+    await rollups.rebuild()
+    await catalog.write("loadtest")  # re-counts, holding the writer lease like an import
+    await meta.stamp_reports(["loadtest"], uuid.uuid4().hex, exclusive=not args.append)
+    generation = await meta.bump_generation(has_data=writer.inserted > 0 or None)
+    await summaries.refresh(generation)
+    shutdown_executor()
+
+
+class Workload:
+    """Random requests from a fixed seed, shaped like the seeded data."""
+
+    def __init__(self, args, client: int = 0):
+        self.random = random.Random(args.seed * 1000 + client)
+        self.client = client
+        self.shape = scale(args.rows, args.apps, args.days)
+        self.args = args
+        self.imports = 0
+
+    def report(self, limit: int = 50) -> dict:
+        rnd = self.random
+        request = {
+            "dimensions": rnd.sample(DIMENSIONS, rnd.randint(1, 3)),
+            "metrics": rnd.sample(METRICS, rnd.randint(1, 4)),
+            "limit": limit,
+        }
+        filters = {}
+        if rnd.random() < 0.4:
+            filters["mobile_app_name"] = [f"App {rnd.randrange(self.shape['apps'])}" for _ in range(rnd.randint(1, 5))]
+        if rnd.random() < 0.3:
+            filters["inventory_format_name"] = rnd.sample(FORMATS, rnd.randint(1, 2))
+        if rnd.random() < 0.2:
+            filters["operating_system_version_name"] = rnd.sample(OS_VERSIONS, rnd.randint(1, 3))
+        if filters:
+            request["filters"] = filters
+        if rnd.random() < 0.5:
+            first = rnd.randrange(self.shape["days"])
+            last = min(self.shape["days"] - 1, first + rnd.randint(0, 30))
+            request["date_range"] = {"start": (START + timedelta(days=first)).isoformat(),
+                                     "end": (START + timedelta(days=last)).isoformat()}
+        return request
+
+    def upload(self) -> bytes:
+        self.imports += 1
+        frame = generate_frame(self.args.import_rows, seed=hash((self.args.seed, self.client, self.imports)) % 2**32,
+                               apps=self.shape["apps"], days=self.shape["days"], start=START)
+        return frame.to_csv(index=False).encode()
+
+
+async def _query(client, workload: Workload) -> int:
+    response = await client.post("/api/reports/query", json=workload.report())
+    response.raise_for_status()
+    return len(response.json()["data"])
+
+
+async def _summary(client, workload: Workload) -> int:
+    response = await client.get("/api/reports/summary")
+    response.raise_for_status()
+    return 1
+
+
+async def _export(client, workload: Workload) -> int:
+    lines = 0
+    async with client.stream("POST", "/api/reports/export", params={"format": "csv"}, json=workload.report()) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            lines += chunk.count(b"\n")
+    return max(lines - 1, 0)
+
+
+async def _import(client, workload: Workload) -> int:
+    files = {"file": ("loadtest.csv", io.BytesIO(workload.upload()), "text/csv")}
+    response = await client.post("/api/data/import", params={"mode": workload.args.import_mode}, files=files)
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        await asyncio.sleep(0.5)
+        status = (await client.get(f"/api/data/import/{job_id}")).json()
+        if status["status"] == "completed":
+            return status.get("inserted", 0)
+        if status["status"] == "failed":
+            raise RuntimeError(f"import {job_id} failed: {status.get('errors', [])[-1:]}")
+
+
+OPERATIONS = {"query": _query, "summary": _summary, "export": _export, "import": _import}
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise SystemExit(f"unknown operation in --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def peak_rss_bytes(pid: int = None) -> int:
+    """Peak resident set size of ``pid`` (VmHWM), or of this process."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with open(f"/proc/{pid}/status") as fh:
+        for line in fh:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    latencies = np.array([s[0] for s in samples if s[2] is None]) * 1000
+    rows = sum(s[1] for s in samples if s[2] is None)
+    errors = [s[2] for s in samples if s[2] is not None]
+    result = {
+        "requests": len(samples),
+        "errors": len(errors),
+        "requests_per_sec": len(latencies) / elapsed,
+        "rows": rows,
+        "rows_per_sec": rows / elapsed,
+    }
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        result.update(p50_ms=p50, p95_ms=p95, p99_ms=p99, max_ms=latencies.max(), mean_ms=latencies.mean())
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    import httpx
+
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    samples = {name: [] for name in names}
+    deadline = time.monotonic() + args.duration
+
+    async def client_loop(client, workload: Workload):
+        while time.monotonic() < deadline:
+            name = workload.random.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                rows, error = await OPERATIONS[name](client, workload), None
+            except Exception as e:
+                rows, error = 0, f"{type(e).__name__}: {e}"
+            samples[name].append((time.perf_counter() - started, rows, error))
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        (await client.get("/health")).raise_for_status()
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, Workload(args, i)) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    output = {
+        "commit": _commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("func", "out")},
+        "elapsed_seconds": elapsed,
+        "endpoints": {name: summarize(samples[name], elapsed) for name in names},
+        "peak_rss_bytes": {"harness": peak_rss_bytes(), "server": peak_rss_bytes(args.server_pid) if args.server_pid else None},
+    }
+    text = json.dumps(output, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(text)
+    print(text)
+
+
+def compare(args):
+    with open(args.before) as fh:
+        before = json.load(fh)
+    with open(args.after) as fh:
+        after = json.load(fh)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    print(f"{'endpoint':<10} {'metric':<16} {'before':>12} {'after':>12} {'change':>8}")
+    for name, new in after["endpoints"].items():
+        old = before["endpoints"].get(name, {})
+        for metric in ["p50_ms", "p95_ms", "p99_ms", "requests_per_sec", "rows_per_sec", "errors"]:
+            if metric not in new or metric not in old:
+                continue
+            change = f"{(new[metric] - old[metric]) / old[metric] * 100:+.1f}%" if old[metric] else ""
+            print(f"{name:<10} {metric:<16} {old[metric]:>12.2f} {new[metric]:>12.2f} {change:>8}")
+    for process in ["harness", "server"]:
+        old, new = before["peak_rss_bytes"].get(process), after["peak_rss_bytes"].get(process)
+        if old and new:
+            print(f"{'rss':<10} {process:<16} {old / 2**20:>10.0f}MB {new / 2**20:>10.0f}MB {(new - old) / old * 100:+.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadtest")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def dataset_options(command):
+        command.add_argument("--rows", type=lambda v: int(float(v)), default=1_000_000, help="rows in the dataset, e.g. 1e7")
+        command.add_argument("--apps", type=int, help="distinct apps (default scales with --rows)")
+        command.add_argument("--days", type=int, help="distinct days (default scales with --rows)")
+        command.add_argument("--seed", type=int, default=42)
+
+    seed_command = commands.add_parser("seed", help="write a synthetic dataset into MongoDB")
+    dataset_options(seed_command)
+    seed_command.add_argument("--database", default="adtech_reports")
+    seed_command.add_argument("--append", action="store_true", help="keep the existing rows")
+    seed_command.set_defaults(func=lambda args: asyncio.run(seed(args)))
+
+    run_command = commands.add_parser("run", help="drive a running API and report latencies")
+    dataset_options(run_command)
+    run_command.add_argument("--base-url", default="http://localhost:8000")
+    run_command.add_argument("--duration", type=float, default=60)
+    run_command.add_argument("--concurrency", type=int, default=16)
+    run_command.add_argument("--mix", default=DEFAULT_MIX, help="weights per operation, e.g. query=70,summary=15,export=10,import=5")
+    run_command.add_argument("--import-rows", type=int, default=10_000)
+    run_command.add_argument("--import-mode", default="upsert", choices=["replace", "upsert", "partition"])
+    run_command.add_argument("--timeout", type=float, default=120)
+    run_command.add_argument("--server-pid", type=int, help="API process whose peak RSS to report")
+    run_command.add_argument("--out", help="write the JSON results here as well")
+    run_command.set_defaults(func=lambda args: asyncio.run(run(args)))
+
+    compare_command = commands.add_parser("compare", help="compare two result files")
+    compare_command.add_argument("before")
+    compare_command.add_argument("after")
+    compare_command.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
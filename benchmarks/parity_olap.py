@@ -0,0 +1,195 @@
+"""Parity and latency of the columnar engine against MongoDB aggregation.
+
+Usage: python -m benchmarks.parity_olap [rows] [queries] [--offline]
+
+Seeds the scratch database on MONGODB_URI (see bench_precheck), then runs
+random report requests through the Mongo pipeline and through
+backend.olap.engine and compares every row. Integer sums must match
+exactly. Float sums may differ in the last bits, because MongoDB's $sum adds
+in a different order, so they are compared to a relative 1e-9.
+
+With --offline no database is needed: the engine loads snapshots written
+to a temporary SNAPSHOT_DIR and its rows are compared with pandas. One
+report is then rewritten in place (same rows, other payouts) under a new
+version, which the engine must pick up.
+"""
+import asyncio
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import motor.motor_asyncio
+import pandas as pd
+from beanie import init_beanie
+
+from backend import snapshots
+from backend.ingest import STRING_FIELDS, block_columns, coerce_columns
+from backend.models import AdReport, SavedReport, ImportJob
+from backend.olap import ColumnarEngine, engine
+from backend.pipeline import RATIO_METRICS, build_pipeline, summed_fields
+from backend.routers.reports import DIMENSIONS, METRICS, ReportQueryRequest, validate_and_build_pipeline
+from benchmarks.bench_precheck import DATABASE, _seed
+from benchmarks.datagen import FORMATS, OS_VERSIONS, generate_frame
+
+FILTER_VALUES = {
+    "inventory_format_name": FORMATS,
+    "operating_system_version_name": OS_VERSIONS,
+    "mobile_app_name": [f"App {i}" for i in range(50)],
+}
+
+
+def random_request(rng: random.Random) -> ReportQueryRequest:
+    filters = {}
+    for key in rng.sample(sorted(FILTER_VALUES), rng.randint(0, 2)):
+        filters[key] = rng.sample(FILTER_VALUES[key], rng.randint(1, 3))
+    date_range = None
+    if rng.random() < 0.5:
+        start = date(2024, 1, 1) + timedelta(days=rng.randint(0, 80))
+        date_range = {"start": start, "end": start + timedelta(days=rng.randint(0, 20))}
+    return ReportQueryRequest(
+        dimensions=rng.sample(DIMENSIONS, rng.randint(0, 3)),
+        metrics=rng.sample(METRICS, rng.randint(1, len(METRICS))),
+        filters=filters or None,
+        date_range=date_range,
+    )
+
+
+def rows_equal(expected: list, actual: list) -> bool:
+    if len(expected) != len(actual):
+        return False
+    for want, got in zip(expected, actual):
+        if want.keys() != got.keys():
+            return False
+        for key, value in want.items():
+            if isinstance(value, float) or isinstance(got[key], float):
+                if not math.isclose(value, got[key], rel_tol=1e-9, abs_tol=1e-12):
+                    return False
+            elif value != got[key]:
+                return False
+    return True
+
+
+def mongo_rows(collection):
+    """Expected rows from the Mongo pipeline on ``collection``."""
+    async def run(request: ReportQueryRequest) -> list:
+        pipeline = build_pipeline(validate_and_build_pipeline(request), request.dimensions, request.metrics)
+        return await collection.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+    return run
+
+
+def reference_rows(frame: pd.DataFrame, request: ReportQueryRequest) -> list:
+    """Expected rows computed with pandas from coerced report columns."""
+    for key, values in (request.filters or {}).items():
+        if values and key in STRING_FIELDS:
+            frame = frame[frame[key].isin(values)]
+    if request.date_range:
+        start, end = pd.Timestamp(request.date_range.start), pd.Timestamp(request.date_range.end)
+        frame = frame[(frame["date"] >= start) & (frame["date"] <= end)]
+    if frame.empty:
+        return []
+    dimensions, sums = list(request.dimensions), summed_fields(request.metrics)
+    if dimensions:
+        groups = frame.groupby(dimensions, sort=True)[sums].sum().reset_index().to_dict("records")
+    else:
+        groups = [{field: frame[field].sum().item() for field in sums}]
+    rows = []
+    for group in groups:
+        row = {dim: group[dim].to_pydatetime() if dim == "date" else group[dim] for dim in dimensions}
+        for metric in request.metrics:
+            if metric in RATIO_METRICS:
+                numerator, denominator, scale = RATIO_METRICS[metric]
+                value = group[numerator] / group[denominator] if group[denominator] else 0
+                row[metric] = value * scale if scale is not None and value else value
+            else:
+                row[metric] = group[metric]
+        rows.append(row)
+    return rows
+
+
+async def compare(expected_rows, queries: int, seed: int = 7, columnar: ColumnarEngine = engine) -> int:
+    """Run ``queries`` random requests through ``expected_rows`` and the engine, return the mismatch count."""
+    rng = random.Random(seed)
+    expected_secs = columnar_secs = 0.0
+    mismatches = 0
+    for _ in range(queries):
+        request = random_request(rng)
+
+        start = time.perf_counter()
+        expected = await expected_rows(request)
+        expected_secs += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = await columnar.query(request)
+        columnar_secs += time.perf_counter() - start
+
+        if not rows_equal(expected, actual):
+            mismatches += 1
+            print(f"MISMATCH {request.model_dump_json()}: {len(expected)} vs {len(actual)} rows")
+    print(f"queries: {queries}  mismatches: {mismatches}")
+    print(f"expected: {expected_secs / queries * 1000:8.1f} ms/query")
+    print(f"columnar: {columnar_secs / queries * 1000:8.1f} ms/query")
+    return mismatches
+
+
+def _write_snapshot(report_id: str, frame: pd.DataFrame, version: str, block_rows: int = 5000):
+    writer = snapshots.SnapshotWriter(report_id)
+    for start in range(0, len(frame), block_rows):
+        writer.append(block_columns(frame.iloc[start:start + block_rows]))
+    writer.commit(version)
+
+
+async def offline(rows: int = 20000, queries: int = 100, reports: int = 3) -> int:
+    """Parity against pandas on snapshots only, including an in-place change; returns the mismatch count."""
+    frame, _ = coerce_columns(generate_frame(rows))
+    parts = {f"report-{i}": frame.iloc[i::reports].reset_index(drop=True) for i in range(reports)}
+    columnar = ColumnarEngine()
+    configured = snapshots.SNAPSHOT_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        snapshots.SNAPSHOT_DIR = directory
+        try:
+            for report_id, part in parts.items():
+                _write_snapshot(report_id, part, "v1")
+            versions = {report_id: "v1" for report_id in parts}
+            await columnar.load(versions)
+            columnar.generation = 1
+
+            async def expected(request):
+                return reference_rows(pd.concat(parts.values(), ignore_index=True), request)
+
+            mismatches = await compare(expected, queries, columnar=columnar)
+
+            # Same row count and request totals, only the payouts change
+            changed = next(iter(parts))
+            parts[changed] = parts[changed].assign(payout=parts[changed]["payout"] * 2 + 0.5)
+            _write_snapshot(changed, parts[changed], "v2")
+            reloaded = await columnar.load({**versions, changed: "v2"})
+            if reloaded != 1:
+                print(f"expected 1 reloaded segment, got {reloaded}")
+                mismatches += 1
+            mismatches += await compare(expected, queries, seed=8, columnar=columnar)
+        finally:
+            snapshots.SNAPSHOT_DIR = configured
+    return mismatches
+
+
+async def main(rows: int = 1_000_000, queries: int = 200):
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    db = client[DATABASE]
+    await _seed(db.ad_reports, rows)
+    await init_beanie(database=db, document_models=[AdReport, SavedReport, ImportJob])
+    start = time.perf_counter()
+    await engine.refresh(force=True)
+    print(f"loaded {engine.stats()['rows']} rows in {time.perf_counter() - start:.1f}s")
+    mismatches = await compare(mongo_rows(AdReport.get_pymongo_collection()), queries)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    args = [int(float(a)) for a in sys.argv[1:3] if not a.startswith("--")]
+    if "--offline" in sys.argv:
+        sys.exit(1 if asyncio.run(offline(*args)) else 0)
+    asyncio.run(main(*args))
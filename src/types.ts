@@ -21,6 +21,7 @@ export interface ReportQueryRequest {
   date_range?: DateRange;
   page?: number;
   limit?: number;
+  cursor?: string;
   group_by?: string[];
 }
 
@@ -33,6 +34,7 @@ export interface ReportResponse {
   total: number;
   page: number;
   limit: number;
+  next_cursor?: string | null;
 }
 
 export interface DashboardData {
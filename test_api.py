@@ -3,10 +3,25 @@ import time
 import json
 import csv
 import io
+import sys
+import threading
+import uuid
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 # Base URL for the API (adjust if running on a different port)
 BASE_URL = "https://adtech-reporting-system-production.up.railway.app"
 
+# The load tests replace the imported data, so they only run against an API on this machine
+LOAD_TEST_URL = os.getenv("LOAD_TEST_URL", "")
+
+def load_test_url():
+    """LOAD_TEST_URL, refusing to go on unless it points at a local API."""
+    if urlparse(LOAD_TEST_URL).hostname not in ("localhost", "127.0.0.1", "::1"):
+        sys.exit("The load tests replace all imported data, set LOAD_TEST_URL to a local API (e.g. http://localhost:8000)")
+    return LOAD_TEST_URL.rstrip("/")
+
 def test_import_csv():
     """Test POST /api/data/import: Upload CSV file and return import job ID"""
     print("Testing POST /api/data/import...")
@@ -144,6 +159,40 @@ def test_export_reports():
     else:
         print(f"Failed to export reports: {response.status_code} - {response.text}")
 
+def test_export_job():
+    """Test POST /api/reports/export/jobs: Background export, reuse and ranged download"""
+    print("Testing POST /api/reports/export/jobs...")
+
+    payload = {
+        "dimensions": ["date", "mobile_app_name"],
+        "metrics": ["ad_exchange_total_requests", "payout"],
+        "date_range": {"start": "2023-01-01", "end": "2023-12-31"}
+    }
+
+    response = requests.post(f"{BASE_URL}/api/reports/export/jobs", json=payload)
+    if response.status_code != 200:
+        print(f"Failed to start export: {response.status_code} - {response.text}")
+        return
+    export_id = response.json()["export_id"]
+
+    while True:
+        job = requests.get(f"{BASE_URL}/api/reports/export/jobs/{export_id}").json()
+        print(f"Export status: {job['status']}, rows: {job['rows']}, bytes: {job['bytes']}")
+        if job["status"] in ("completed", "failed"):
+            break
+        time.sleep(1)
+    assert job["status"] == "completed", f"Export failed: {job['error']}"
+
+    # The same report on unchanged data reuses the finished artifact
+    again = requests.post(f"{BASE_URL}/api/reports/export/jobs", json=payload).json()
+    assert again["export_id"] == export_id and again["reused"], "Repeated export was not reused"
+
+    full = requests.get(job["download_url"])
+    assert full.status_code == 200 and len(full.content) == job["bytes"], "Download does not match the job"
+    part = requests.get(job["download_url"], headers={"Range": "bytes=10-"})
+    assert part.status_code == 206 and part.content == full.content[10:], "Ranged download does not resume"
+    print(f"Downloaded {len(full.content)} bytes, resumed download OK")
+
 def test_get_summary():
     """Test GET /api/reports/summary: Get dashboard summary metrics"""
     print("Testing GET /api/reports/summary...")
@@ -241,7 +290,96 @@ def test_delete_saved_report(report_id):
     else:
         print(f"Failed to delete report: {response.status_code} - {response.text}")
 
+def _sample_latency(base_url, method, path, samples, **kwargs):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        requests.request(method, f"{base_url}{path}", **kwargs)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95) - 1]
+
+def test_latency_during_import(rows=500000):
+    """Test that /health and /api/reports/query stay responsive while a large CSV imports"""
+    base_url = load_test_url()
+    print(f"Testing /health and /query latency during a {rows}-row import...")
+    from benchmarks.datagen import generate_frame
+
+    query = {"dimensions": ["mobile_app_name"], "metrics": ["ad_exchange_total_requests", "payout"], "page": 1, "limit": 10}
+    baseline_health = _sample_latency(base_url, "GET", "/health", 20)
+    baseline_query = _sample_latency(base_url, "POST", "/api/reports/query", 20, json=query)
+    print(f"Baseline p50/p95 health: {baseline_health}, query: {baseline_query}")
+
+    csv_data = generate_frame(rows).to_csv(index=False)
+    files = {'file': ('large.csv', io.StringIO(csv_data), 'text/csv')}
+    job_id = requests.post(f"{base_url}/api/data/import", files=files).json()['job_id']
+
+    health, query_latency = [], []
+    while requests.get(f"{base_url}/api/data/import/{job_id}").json()['status'] in ("pending", "processing"):
+        health.append(_sample_latency(base_url, "GET", "/health", 5)[1])
+        query_latency.append(_sample_latency(base_url, "POST", "/api/reports/query", 5, json=query)[1])
+
+    worst_health = max(health, default=0)
+    worst_query = max(query_latency, default=0)
+    print(f"Worst p95 during import health: {worst_health:.3f}s, query: {worst_query:.3f}s")
+    # Allow for network jitter, but a blocked event loop shows up as whole seconds
+    assert worst_health < baseline_health[1] * 3 + 0.1, "Health latency spiked during import"
+    assert worst_query < baseline_query[1] * 3 + 0.25, "Query latency spiked during import"
+
+def _metric_total(text, name, **labels):
+    """Sum of a Prometheus metric's samples having ``labels``."""
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + "{") and all(f'{key}="{value}"' in line for key, value in labels.items()):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+def test_single_flight(concurrency=50):
+    """Test that a burst of identical /api/reports/query requests runs one aggregation.
+
+    Metrics are per process, so point LOAD_TEST_URL at a single API process.
+    """
+    base_url = load_test_url()
+    print(f"Testing {concurrency} identical concurrent /query requests...")
+
+    # A filter value no row has keeps the report unchanged but its cache key new
+    formats = ["Banner", "Interstitial", "Rewarded", "Native", "App open", f"herd-{uuid.uuid4()}"]
+    # Few groups, so the result fits the query cache and a single /query runs exactly one aggregation
+    query = {"dimensions": ["inventory_format_name", "operating_system_version_name"], "metrics": ["ad_exchange_total_requests", "payout"],
+             "filters": {"inventory_format_name": formats}, "page": 1, "limit": 50}
+    barrier = threading.Barrier(concurrency)
+
+    def send(_):
+        barrier.wait()
+        return requests.post(f"{base_url}/api/reports/query", json=query)
+
+    before = requests.get(f"{base_url}/metrics").text
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        responses = list(pool.map(send, range(concurrency)))
+    after = requests.get(f"{base_url}/metrics").text
+
+    assert all(r.status_code == 200 for r in responses), "Some requests failed"
+    assert all(r.json() == responses[0].json() for r in responses), "Coalesced requests got different results"
+    name = "adreport_aggregation_duration_seconds_count"
+    aggregations = _metric_total(after, name, endpoint="query") - _metric_total(before, name, endpoint="query")
+    name = "adreport_single_flight_requests_total"
+    shared = _metric_total(after, name, endpoint="query", outcome="shared") - _metric_total(before, name, endpoint="query", outcome="shared")
+    print(f"Aggregations: {aggregations:.0f}, requests sharing one in flight: {shared:.0f}")
+    # One flight aggregates; late arrivals are served from the result cache it filled
+    assert aggregations == 1, f"Expected one aggregation, got {aggregations:.0f}"
+
+def test_columnar_parity():
+    """Test the columnar engine against pandas, including a report rewritten in place (no server needed)"""
+    print("Testing columnar engine parity on snapshots...")
+    import asyncio
+    from benchmarks.parity_olap import offline
+
+    mismatches = asyncio.run(offline())
+    assert mismatches == 0, f"{mismatches} columnar results differ from the reference"
+
 if __name__ == "__main__":
+    if "--load" in sys.argv:
+        load_test_url()  # before any other test, not after them
     print("Starting API tests...\n")
 
     # Test import
@@ -261,6 +399,8 @@ if __name__ == "__main__":
     print()
     test_export_reports()
     print()
+    test_export_job()
+    print()
 
     # Test summary and report IDs
     test_get_summary()
@@ -278,5 +418,15 @@ if __name__ == "__main__":
 
     # Test delete saved report
     test_delete_saved_report(saved_report_id)
+    print()
+
+    test_columnar_parity()
+
+    # Load tests replace the imported data with a large synthetic dataset
+    if "--load" in sys.argv:
+        print()
+        test_latency_during_import()
+        print()
+        test_single_flight()
 
     print("\nAPI tests completed.")